@@ -1,11 +1,16 @@
 #!/usr/bin/env python
 # coding: utf-8
 
+from glob import glob
 import cofactors
 
 organisms = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
 sabio_path = '../generated_data/sabiork_queries/'
 brenda_path = '../generated_data/brenda_queries/'
-cofactors.brenda_fetch(outpath = brenda_path)
-for organism in organisms:
-	cofactors.sabio_fetch(organisms = [organism], outpath = sabio_path)
+store_path = '../generated_data/kms.parquet'
+# queries fetched within the last week are kept, so rerunning after a failure only sends the missing ones
+max_age = 7 * 24 * 3600
+cofactors.brenda_fetch(organisms = organisms, outpath = brenda_path, max_age = max_age)
+cofactors.sabio_fetch(organisms = organisms, outpath = sabio_path, max_age = max_age)
+# normalized Kms of both sources in one file, see cofactors.read_km_store
+cofactors.build_km_store(store_path, sabio_files = glob(sabio_path + '*'), brenda_files = glob(brenda_path + '*'))
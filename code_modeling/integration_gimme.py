@@ -0,0 +1,23 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# GIMME models of both cell lines, replaces integration_gimme.m
+
+import cobra
+import pandas as pd
+import cofactors
+
+model = cofactors.load_model('../external_data/mitocore/mitocore_v1.01.xml')
+model.objective = 'OF_ATP_MitoCore'
+
+proteomics = pd.read_csv('../external_data/293parp_abundance_ratios_mapped.csv', index_col = 0)
+proteomics = proteomics.rename(columns = {'mp': 'mito'})[['control', 'mito']]
+mapped = cofactors.map_expression(model, proteomics)
+# same layout as the tables written by MATLAB, read by graphing_gimme_mapping.ipynb. The _py suffix keeps the MATLAB
+# tables and models next to these instead of overwriting them.
+for condition in mapped:
+    mapped[condition].rename_axis('Var1').rename('Var2').to_csv(f'../generated_data/mapped_{condition}_py.csv', na_rep = 'NaN')
+
+family = cofactors.gimme(model, mapped, [.8], solver = 'highs', tag = 'gimme_{condition}')
+for tag in family:
+    cobra.io.write_sbml_model(family.to_model(tag), f'../generated_models/{tag}_py.xml')
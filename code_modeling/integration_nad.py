@@ -0,0 +1,12 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# runs the stages of integration_nad.ipynb for all cell lines and NAD conditions in integration_nad.json,
+# only redoing stages whose inputs changed since the last run
+
+import sys
+import cofactors
+
+config = sys.argv[1] if len(sys.argv) > 1 else 'integration_nad.json'
+results = cofactors.run_pipeline(config, n_jobs = -1)
+print(results['export']['objective'])
@@ -0,0 +1,20 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+# scan GIMME over the fraction of the optimum, replaces paramscan_gimme.m
+
+import pandas as pd
+import cofactors
+
+model = cofactors.load_model('../external_data/mitocore/mitocore_v1.01.xml')
+model.objective = 'OF_ATP_MitoCore'
+
+proteomics = pd.read_csv('../external_data/293parp_abundance_ratios_mapped.csv', index_col = 0)
+proteomics = proteomics.rename(columns = {'mp': 'mito'})[['control', 'mito']]
+mapped = cofactors.map_expression(model, proteomics)
+
+# variants are named like the SBML files written by the MATLAB script, e.g. control_objfrac_0.80
+fractions = [i / 100 for i in range(1, 101)]
+family = cofactors.gimme(model, mapped, fractions, solver = 'highs', n_jobs = -1)
+# next to, not over, the family converted from the MATLAB models
+family.save('../generated_models/models_paramscan_gimme_py_family/')
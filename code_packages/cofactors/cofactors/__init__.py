@@ -1,4 +1,15 @@
 from cofactors.fetch import sabio_fetch, brenda_fetch
-from cofactors.mapping import read_sabiork, read_brenda, create_mappings_ec_mitocore, create_mappings_ec_mitocore_from_xml, load_mappings
-from cofactors.integration import create_models_fva, scan_reaction, scan_all_fluxes, scan_total_flux, scan_all_reactions, scan_reaction_variance, scan_all_variance
+from cofactors.mapping import read_sabiork, read_brenda, create_mappings_ec_mitocore, create_mappings_ec_mitocore_from_xml, read_sbml_reactions, load_mappings, map_expression, GPRProgram
+from cofactors.integration import create_models_fva, create_models_decisions, fva_fractions, AdjustmentPlan, BoundVariant, ConcentrationScan, clear_reference_cache, scan_reaction, scan_all_fluxes, scan_total_flux, scan_all_reactions, scan_reaction_variance, scan_all_variance
+from cofactors.kms import KmIndex
+from cofactors.kmstore import build_km_store, read_km_store, km_store_provenance
+from cofactors.lp import PersistentLP, HighsLP
+from cofactors.sensitivity import sensitivity
+from cofactors.uncertainty import monte_carlo, sample_kms
+from cofactors.models import load_model
+from cofactors.family import ModelFamily
+from cofactors.gimme import gimme, gimme_threshold
+from cofactors.results import ResultStore
+from cofactors.pipeline import Pipeline, Stage, build_pipeline, load_config, run_pipeline
+from cofactors.cache import enable_cache, disable_cache, ResultCache
 from cofactors.helpers import read_subsystems, plot_flux_with_var
\ No newline at end of file
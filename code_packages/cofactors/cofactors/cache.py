@@ -0,0 +1,244 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+CACHE_ENV = 'COFACTORS_CACHE'
+CACHE_SIZE_ENV = 'COFACTORS_CACHE_SIZE'
+DEFAULT_MAX_SIZE = 1024 # MB
+
+_cache = None
+
+
+class ResultCache:
+	"""
+	Content-addressed store of results on disk.
+	Every entry is one compressed .npz file named by the hash of the inputs it was computed from. Entries are evicted
+	least recently used first once the cache grows beyond its maximum size.
+	"""
+
+	def __init__(self, path, max_size=DEFAULT_MAX_SIZE):
+		"""
+		:param path: Folder to keep the entries in. Created if missing.
+		:param max_size: Maximum size of all entries in MB.
+		"""
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		self.max_size = max_size
+
+	def _file(self, key):
+		return self.path / f'{key}.npz'
+
+	def get(self, key):
+		"""
+		Loads an entry.
+		:param key: Hash as returned by content_hash.
+		:return: Dictionary of Series, dataframes and floats, or None if there is no such entry.
+		"""
+		file = self._file(key)
+		try:
+			with np.load(file, allow_pickle=False) as data:
+				entry = _unpack(data)
+		except (OSError, ValueError, KeyError):
+			return None
+		os.utime(file)
+		return entry
+
+	def put(self, key, entry):
+		"""
+		Stores an entry and evicts old ones if the cache got too large.
+		:param key: Hash as returned by content_hash.
+		:param entry: Dictionary of Series, dataframes and numbers.
+		"""
+		arrays = _pack(entry)
+		fd, tmp = tempfile.mkstemp(suffix='.npz', dir=self.path)
+		try:
+			with os.fdopen(fd, 'wb') as f:
+				np.savez_compressed(f, **arrays)
+			os.replace(tmp, self._file(key))
+		except BaseException:
+			os.unlink(tmp)
+			raise
+		self.evict()
+
+	def evict(self):
+		"""
+		Deletes least recently used entries until the cache is within its maximum size.
+		"""
+		files = sorted(self.path.glob('*.npz'), key=lambda f: f.stat().st_mtime)
+		sizes = [f.stat().st_size for f in files]
+		total = sum(sizes)
+		for file, size in zip(files, sizes):
+			if total <= self.max_size * 1024**2:
+				break
+			file.unlink(missing_ok=True)
+			total -= size
+
+	def clear(self):
+		"""
+		Deletes all entries.
+		"""
+		for file in self.path.glob('*.npz'):
+			file.unlink(missing_ok=True)
+
+	@property
+	def size(self):
+		"""
+		:return: Size of all entries in bytes.
+		"""
+		return sum(f.stat().st_size for f in self.path.glob('*.npz'))
+
+	def __len__(self):
+		return len(list(self.path.glob('*.npz')))
+
+	def __repr__(self):
+		return f'<ResultCache at {self.path} with {len(self)} entries>'
+
+
+def enable_cache(path=None, max_size=None):
+	"""
+	Caches reference solutions and scan results on disk, so unchanged inputs are not solved again in later sessions.
+	Setting the environment variable COFACTORS_CACHE to a folder does the same without calling this function,
+	COFACTORS_CACHE_SIZE sets the maximum size in MB.
+	:param path: Folder of the cache. Defaults to COFACTORS_CACHE or ~/.cache/cofactors.
+	:param max_size: Maximum size in MB. Defaults to COFACTORS_CACHE_SIZE or 1024.
+	:return: ResultCache.
+	"""
+	global _cache
+	if path is None:
+		path = os.environ.get(CACHE_ENV) or Path.home() / '.cache' / 'cofactors'
+	if max_size is None:
+		max_size = float(os.environ.get(CACHE_SIZE_ENV, DEFAULT_MAX_SIZE))
+	_cache = ResultCache(path, max_size)
+	return _cache
+
+
+def disable_cache():
+	"""
+	Stops using the on-disk cache. Its entries are kept.
+	"""
+	global _cache
+	_cache = False
+
+
+def get_cache():
+	"""
+	:return: The active ResultCache or None.
+	"""
+	if _cache is None and os.environ.get(CACHE_ENV):
+		enable_cache()
+	return _cache if isinstance(_cache, ResultCache) else None
+
+
+def content_hash(*parts):
+	"""
+	Hash of the content of the inputs of a computation.
+	Models are hashed by reactions, stoichiometry, bounds and objective, so copies and re-read files hash the same.
+	:param parts: Models, KmIndex objects, dictionaries, sequences, arrays, pandas objects, strings or numbers.
+	:return: Hex digest.
+	"""
+	h = hashlib.sha256()
+	for part in parts:
+		_feed(h, part)
+	return h.hexdigest()
+
+
+def _feed(h, obj):
+	"""
+	Adds an object to a hash, tagged by its type so that e.g. 1 and '1' differ.
+	:param h: hashlib object.
+	:param obj: Object to add.
+	"""
+	# imported here as integration imports this module
+	from cobra import Model
+	from cofactors.kms import KmIndex
+	if obj is None or isinstance(obj, (bool, int, float, str)):
+		h.update(f'{type(obj).__name__}:{obj!r};'.encode())
+	elif isinstance(obj, Model):
+		h.update(b'model:')
+		for rxn in obj.reactions:
+			stoichiometry = sorted((m.id, c) for m, c in rxn.metabolites.items())
+			h.update(f'{rxn.id}|{rxn.lower_bound!r}|{rxn.upper_bound!r}|{stoichiometry};'.encode())
+		h.update(f'{obj.objective.direction}|{obj.objective.expression};'.encode())
+	elif isinstance(obj, KmIndex):
+		h.update(b'kms:')
+		_feed(h, dict(obj.items()))
+	elif isinstance(obj, dict):
+		h.update(b'dict:')
+		for key in sorted(obj, key=repr):
+			_feed(h, key)
+			_feed(h, obj[key])
+	elif isinstance(obj, (pd.Series, pd.DataFrame)):
+		h.update(b'pandas:')
+		h.update(pd.util.hash_pandas_object(obj).to_numpy().tobytes())
+		_feed(h, list(getattr(obj, 'columns', [obj.name])))
+	elif isinstance(obj, np.ndarray):
+		h.update(f'array:{obj.dtype}{obj.shape};'.encode())
+		h.update(np.ascontiguousarray(obj).tobytes())
+	elif isinstance(obj, (list, tuple, set, frozenset)):
+		h.update(f'{type(obj).__name__}:'.encode())
+		for item in (sorted(obj, key=repr) if isinstance(obj, (set, frozenset)) else obj):
+			_feed(h, item)
+		h.update(b';')
+	elif callable(obj):
+		h.update(f'callable:{getattr(obj, "__module__", "")}.{getattr(obj, "__qualname__", repr(obj))};'.encode())
+	else:
+		raise TypeError(f'Cannot hash objects of type {type(obj).__name__}.')
+
+
+def _pack(entry):
+	"""
+	Turns a dictionary of results into arrays for np.savez.
+	:param entry: Dictionary of Series, dataframes and numbers.
+	:return: Dictionary of arrays, '__meta__' describing how to rebuild the entry.
+	"""
+	arrays = {}
+	meta = {}
+	for i, (key, value) in enumerate(entry.items()):
+		if isinstance(value, pd.DataFrame):
+			meta[key] = {'kind': 'frame', 'index': value.index.name}
+			arrays[f'{i}_values'] = value.to_numpy()
+			arrays[f'{i}_columns'] = _labels(value.columns)
+		elif isinstance(value, pd.Series):
+			meta[key] = {'kind': 'series', 'index': value.index.name, 'name': value.name}
+			arrays[f'{i}_values'] = value.to_numpy()
+		else:
+			meta[key] = {'kind': 'scalar'}
+			arrays[f'{i}_values'] = np.asarray(value)
+			continue
+		arrays[f'{i}_index'] = _labels(value.index)
+	arrays['__meta__'] = np.array(json.dumps(meta))
+	return arrays
+
+
+def _unpack(data):
+	"""
+	Rebuilds a dictionary of results written by _pack.
+	:param data: NpzFile.
+	:return: Dictionary of Series, dataframes and floats.
+	"""
+	entry = {}
+	for i, (key, meta) in enumerate(json.loads(str(data['__meta__'])).items()):
+		values = data[f'{i}_values']
+		if meta['kind'] == 'scalar':
+			entry[key] = values.item()
+			continue
+		index = pd.Index(data[f'{i}_index'], name=meta['index'])
+		if meta['kind'] == 'frame':
+			entry[key] = pd.DataFrame(values, index=index, columns=pd.Index(data[f'{i}_columns']))
+		else:
+			entry[key] = pd.Series(values, index=index, name=meta['name'])
+	return entry
+
+
+def _labels(index):
+	"""
+	Index labels as an array that needs no pickling.
+	:param index: pandas Index.
+	:return: Numeric or unicode array.
+	"""
+	labels = index.to_numpy()
+	return labels if labels.dtype.kind in 'biuf' else labels.astype(str)
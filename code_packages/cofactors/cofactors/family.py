@@ -0,0 +1,216 @@
+import gzip
+import json
+import numpy as np
+import pandas as pd
+import cobra
+from copy import deepcopy
+from pathlib import Path
+from cobra.exceptions import OptimizationError
+from cobra.util.solver import linear_reaction_coefficients
+from cofactors.lp import PersistentLP
+from cofactors.models import load_model
+
+FAMILY_FORMAT = 1
+BASE_FILE = 'base.xml'
+DELTAS_FILE = 'deltas.json.gz'
+
+
+class ModelFamily:
+	"""
+	Many variants of one model, e.g. the GIMME models of a parameter scan, stored as one base model plus per-variant
+	deltas of removed reactions and changed bounds.
+	Variants are evaluated by setting their bounds on a single LP of the base model, removed reactions being blocked.
+	"""
+
+	def __init__(self, base, deltas):
+		"""
+		:param base: Model containing the reactions of all variants.
+		:param deltas: Dictionary of variant tags to dictionaries with 'removed' (list of reaction IDs) and 'bounds'
+			(dictionary of reaction IDs to (lower, upper) bounds differing from the base model).
+		"""
+		self.base = base
+		self.deltas = {tag: {'removed': list(d.get('removed', [])), 'bounds': {r: tuple(b) for r, b in d.get('bounds', {}).items()}}
+			for tag, d in deltas.items()}
+		self._index = {r.id: i for i, r in enumerate(base.reactions)}
+		self._lower = np.array([r.lower_bound for r in base.reactions], dtype=float)
+		self._upper = np.array([r.upper_bound for r in base.reactions], dtype=float)
+
+	@classmethod
+	def from_models(cls, models, tags=None):
+		"""
+		Builds a family from complete models. The base model is the first one, extended by the reactions only found in others.
+		:param models: List of Model objects sharing their objective.
+		:param tags: List of variant names. Defaults to the models' IDs.
+		:return: ModelFamily.
+		"""
+		if tags is None:
+			tags = [m.id for m in models]
+		if len(set(tags)) != len(tags):
+			raise ValueError('Tags of the variants need to be unique.')
+		base = deepcopy(models[0])
+		objective = _objective(base)
+		for model in models[1:]:
+			if _objective(model) != objective:
+				raise ValueError(f'Model {model.id} does not share the objective of {base.id}.')
+			known = set(r.id for r in base.reactions)
+			missing = [r.copy() for r in model.reactions if r.id not in known]
+			if missing:
+				base.add_reactions(missing)
+
+		deltas = {}
+		for tag, model in zip(tags, models):
+			reactions = model.reactions
+			bounds = {}
+			for rxn in reactions:
+				base_rxn = base.reactions.get_by_id(rxn.id)
+				if rxn.bounds != base_rxn.bounds:
+					bounds[rxn.id] = rxn.bounds
+			removed = [r.id for r in base.reactions if r.id not in reactions]
+			deltas[tag] = {'removed': removed, 'bounds': bounds}
+		return cls(base, deltas)
+
+	@classmethod
+	def from_files(cls, files, tags=None):
+		"""
+		Builds a family from SBML files, e.g. to convert a folder of models once.
+		:param files: Paths to SBML files.
+		:param tags: List of variant names. Defaults to the file names without suffix.
+		:return: ModelFamily.
+		"""
+		files = [Path(f) for f in files]
+		if tags is None:
+			tags = [f.stem for f in files]
+		models = [cobra.io.read_sbml_model(str(f)) for f in files]
+		return cls.from_models(models, tags)
+
+	@classmethod
+	def load(cls, path):
+		"""
+		Loads a family written by save.
+		:param path: Folder of the family.
+		:return: ModelFamily.
+		"""
+		path = Path(path)
+		with gzip.open(path / DELTAS_FILE, 'rt') as f:
+			data = json.load(f)
+		if data.get('format') != FAMILY_FORMAT:
+			raise ValueError(f'Unsupported model family format {data.get("format")!r} in {path}.')
+		return cls(load_model(path / BASE_FILE), data['variants'])
+
+	def save(self, path):
+		"""
+		Writes the base model as SBML and the deltas as compressed JSON into a folder.
+		:param path: Folder to write to. Created if missing.
+		"""
+		path = Path(path)
+		path.mkdir(parents=True, exist_ok=True)
+		cobra.io.write_sbml_model(self.base, str(path / BASE_FILE))
+		variants = {tag: {'removed': d['removed'], 'bounds': {r: list(b) for r, b in d['bounds'].items()}}
+			for tag, d in self.deltas.items()}
+		with gzip.open(path / DELTAS_FILE, 'wt') as f:
+			json.dump({'format': FAMILY_FORMAT, 'variants': variants}, f)
+
+	@property
+	def tags(self):
+		return list(self.deltas)
+
+	def bounds(self, tag):
+		"""
+		Bounds of all base reactions in a variant, removed reactions being blocked.
+		:param tag: Variant name.
+		:return: Tuple of arrays of lower and upper bounds, aligned with the base model's reactions.
+		"""
+		delta = self.deltas[tag]
+		lower = self._lower.copy()
+		upper = self._upper.copy()
+		for rxn_id, (lb, ub) in delta['bounds'].items():
+			i = self._index[rxn_id]
+			lower[i] = lb
+			upper[i] = ub
+		removed = [self._index[r] for r in delta['removed']]
+		lower[removed] = 0.
+		upper[removed] = 0.
+		return lower, upper
+
+	def n_reactions(self, tag):
+		"""
+		:param tag: Variant name.
+		:return: Number of reactions in the variant.
+		"""
+		return len(self._index) - len(self.deltas[tag]['removed'])
+
+	def reactions(self, tag):
+		"""
+		:param tag: Variant name.
+		:return: List of reaction IDs in the variant.
+		"""
+		removed = set(self.deltas[tag]['removed'])
+		return [r for r in self._index if r not in removed]
+
+	def to_model(self, tag):
+		"""
+		Materializes a variant as a model of its own.
+		:param tag: Variant name.
+		:return: Model object without the removed reactions and orphaned metabolites.
+		"""
+		delta = self.deltas[tag]
+		model = self.base.copy()
+		model.id = str(tag)
+		for rxn_id, bounds in delta['bounds'].items():
+			model.reactions.get_by_id(rxn_id).bounds = bounds
+		model.remove_reactions(delta['removed'], remove_orphans=True)
+		return model
+
+	def variants(self, tags=None, solver=None):
+		"""
+		Sets the variants' bounds one after the other on the same LP.
+		:param tags: Variant names. Defaults to all.
+		:param solver: Solver of the LP, see PersistentLP.
+		:return: Generator of tuples of tag and PersistentLP.
+		"""
+		lp = PersistentLP(self.base, solver)
+		indices = np.arange(len(self._index))
+		for tag in (self.tags if tags is None else tags):
+			lower, upper = self.bounds(tag)
+			lp.set_bounds(indices, lower, upper)
+			yield tag, lp
+
+	def evaluate(self, function=None, tags=None, solver=None):
+		"""
+		Evaluates all variants on one LP.
+		:param function: Function taking the PersistentLP of a variant. Defaults to FBA.
+		:param tags: Variant names. Defaults to all.
+		:param solver: Solver of the LP, see PersistentLP.
+		:return: Dictionary of tags to the function's results. Without function, a dataframe with the variants' 'objective'
+			(NaN if infeasible) and number of 'reactions', indexed by tag.
+		"""
+		if function is not None:
+			return {tag: function(lp) for tag, lp in self.variants(tags, solver)}
+		rows = {}
+		for tag, lp in self.variants(tags, solver):
+			try:
+				objective = lp.optimize().objective_value
+			except OptimizationError:
+				objective = np.nan
+			rows[tag] = (objective, self.n_reactions(tag))
+		return pd.DataFrame.from_dict(rows, orient='index', columns=['objective', 'reactions'])
+
+	def __len__(self):
+		return len(self.deltas)
+
+	def __contains__(self, tag):
+		return tag in self.deltas
+
+	def __iter__(self):
+		return iter(self.deltas)
+
+	def __repr__(self):
+		return f'<ModelFamily of {len(self)} variants of {self.base.id} with {len(self._index)} reactions>'
+
+
+def _objective(model):
+	"""
+	:param model: Model object.
+	:return: Dictionary of reaction IDs to objective coefficients.
+	"""
+	return {r.id: c for r, c in linear_reaction_coefficients(model).items()}
@@ -1,94 +1,398 @@
 #!usr/bin/python
 import requests
+import json
 import os
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+from functools import partial
 from zeep import Client
+from zeep.exceptions import TransportError
+from zeep.transports import Transport
 from hashlib import sha256
 from pathlib import Path
 import pandas as pd
 from io import StringIO
-from typing import List
+from typing import Callable, List, Optional, Union
+
+SABIO_URL = 'http://sabiork.h-its.org/sabioRestWebServices/kineticlawsExportTsv'
+BRENDA_WSDL = 'https://www.brenda-enzymes.org/soap/brenda_zeep.wsdl'
+DEFAULT_ORGANISMS = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
+DEFAULT_COFACTORS = ['NAD+', 'NADH', 'NADP+', 'NADPH']
+MANIFEST_NAME = '.manifest.json'
+
+
+class RateLimiter:
+    """
+    Spaces out the start of requests shared by several threads.
+    """
+
+    def __init__(self, rate: Optional[float] = None):
+        """
+        :param rate: Maximum number of requests per second. None for no limit.
+        :type rate: float, optional
+        """
+        self.interval = 1. / rate if rate else 0.
+        self._lock = threading.Lock()
+        self._next = 0.
+
+    def wait(self):
+        """
+        Blocks until the next request may start.
+        """
+        if not self.interval:
+            return
+        with self._lock:
+            now = time.monotonic()
+            start = max(now, self._next)
+            self._next = start + self.interval
+        time.sleep(start - now)
+
+
+def _is_transient(error: Exception) -> bool:
+    """
+    Whether a failed request is worth repeating: connection problems, timeouts, rate limiting and server errors.
+    Wrong credentials, bad queries and SOAP faults are not.
+    :param error: Exception raised by the request.
+    :type error: Exception
+    :rtype: bool
+    """
+    if isinstance(error, requests.HTTPError):
+        status = error.response.status_code if error.response is not None else None
+        return status is None or status == 429 or status >= 500
+    if isinstance(error, TransportError):
+        return error.status_code == 429 or error.status_code >= 500
+    return isinstance(error, (requests.ConnectionError, requests.Timeout))
+
+
+def _retry(func: Callable, retries: int = 3, backoff: float = 1., limiter: Optional[RateLimiter] = None):
+    """
+    Calls a function, repeating it with exponential backoff on transient errors.
+    :param func: Function without arguments sending one request.
+    :type func: Callable
+    :param retries: Number of repetitions after the first attempt.
+    :type retries: int
+    :param backoff: Seconds to wait before the first repetition, doubled for each further one.
+    :type backoff: float
+    :param limiter: Rate limiter to wait for before each attempt.
+    :type limiter: RateLimiter, optional
+    :return: The function's return value.
+    """
+    for attempt in range(retries + 1):
+        if limiter is not None:
+            limiter.wait()
+        try:
+            return func()
+        except Exception as error:
+            if attempt == retries or not _is_transient(error):
+                raise
+            time.sleep(backoff * 2**attempt)
+
+
+def _run_concurrently(tasks: List[Callable], max_workers: int) -> list:
+    """
+    Runs tasks on a bounded thread pool.
+    :param tasks: Functions without arguments.
+    :type tasks: List[Callable]
+    :param max_workers: Maximum number of concurrent tasks.
+    :type max_workers: int
+    :return: Results in the order of the tasks.
+    :rtype: list
+    """
+    if max_workers <= 1 or len(tasks) <= 1:
+        return [task() for task in tasks]
+    with ThreadPoolExecutor(max_workers=min(max_workers, len(tasks))) as executor:
+        futures = [executor.submit(task) for task in tasks]
+        return [future.result() for future in futures]
+
+
+def _atomic_write(path: Path, data: bytes):
+    """
+    Writes a file by replacing it with a complete temporary copy, so readers never see it half-written.
+    :param path: Path of the file.
+    :type path: Path
+    :param data: Content of the file.
+    :type data: bytes
+    """
+    fd, tmp = tempfile.mkstemp(prefix='.', suffix='.tmp', dir=path.parent)
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+class Manifest:
+    """
+    Record of the queries saved in a folder: their parameters, when they were fetched, and hash, size and number of
+    rows of the files. Kept as the hidden JSON file MANIFEST_NAME next to the files and rewritten after every query,
+    so an interrupted download can be resumed by skipping the queries already recorded.
+    """
+
+    def __init__(self, folder: Union[str, Path]):
+        """
+        :param folder: Folder of the query files.
+        :type folder: str or Path
+        """
+        self.folder = Path(folder)
+        self.path = self.folder / MANIFEST_NAME
+        self._lock = threading.Lock()
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except (FileNotFoundError, ValueError):
+            self.entries = {}
+
+    def is_fresh(self, filename: Union[str, Path], params: dict, max_age: Optional[float]) -> bool:
+        """
+        Whether a query does not need to be sent again: it was recorded with the same parameters less than max_age
+        seconds ago and its file is still there, unchanged in size and content (sha256).
+        :param filename: Name of the query's file in the folder.
+        :type filename: str or Path
+        :param params: Parameters of the query.
+        :type params: dict
+        :param max_age: Maximum age in seconds. None for never fresh.
+        :type max_age: float, optional
+        :rtype: bool
+        """
+        if max_age is None:
+            return False
+        entry = self.entries.get(Path(filename).name)
+        if entry is None or entry['params'] != params:
+            return False
+        path = self.folder / Path(filename).name
+        if not path.exists() or path.stat().st_size != entry['bytes']:
+            return False
+        if sha256(path.read_bytes()).hexdigest() != entry['sha256']:
+            return False
+        age = datetime.now(timezone.utc) - datetime.fromisoformat(entry['fetched'])
+        return age.total_seconds() <= max_age
+
+    def stale(self, filenames: List[Union[str, Path]], params: List[dict], max_age: Optional[float]) -> List[int]:
+        """
+        :param filenames: Names of the queries' files.
+        :type filenames: List[str]
+        :param params: Parameters of the queries.
+        :type params: List[dict]
+        :param max_age: Maximum age in seconds. None for never fresh.
+        :type max_age: float, optional
+        :return: Positions of the queries that need to be sent.
+        :rtype: List[int]
+        """
+        return [i for i, (f, p) in enumerate(zip(filenames, params)) if not self.is_fresh(f, p, max_age)]
+
+    def save(self, filename: Union[str, Path], params: dict, text: str, rows: int) -> Path:
+        """
+        Writes a query's result and records it. An unchanged result is not written again, only its timestamp updated.
+        :param filename: Name of the query's file in the folder.
+        :type filename: str or Path
+        :param params: Parameters of the query.
+        :type params: dict
+        :param text: Result of the query.
+        :type text: str
+        :param rows: Number of data rows in the result.
+        :type rows: int
+        :return: Path of the file.
+        :rtype: Path
+        """
+        path = self.folder / Path(filename).name
+        data = text.encode('utf-8')
+        digest = sha256(data).hexdigest()
+        with self._lock:
+            old = self.entries.get(path.name)
+            if old is None or old['sha256'] != digest or not path.exists() or sha256(path.read_bytes()).hexdigest() != digest:
+                _atomic_write(path, data)
+            self.entries[path.name] = {
+                'params': params,
+                'fetched': datetime.now(timezone.utc).isoformat(),
+                'sha256': digest,
+                'bytes': len(data),
+                'rows': rows,
+            }
+            _atomic_write(self.path, json.dumps(self.entries, indent=1, sort_keys=True).encode('utf-8'))
+        return path
+
 
 def sabio_fetch(
     outpath = './sabiork_queries',
-    organisms = []
+    organisms = [],
+    max_workers: int = 5,
+    retries: int = 3,
+    backoff: float = 1.,
+    rate: Optional[float] = None,
+    url: str = SABIO_URL,
+    session: Optional[requests.Session] = None,
+    max_age: Optional[float] = None,
     ) -> List[str]:
     """
     Queries SabioRK for the specified organisms, writes queries into appropriate files and returns paths to the files.
+    Organisms are queried concurrently over one HTTP session. Every file is recorded in the folder's Manifest once
+    written, so with max_age set, queries fetched recently are skipped and an interrupted run continues where it stopped.
     :param outpath: Path (folder) into which to save the results.
     :type outpath: str
     :param organisms: List of scientific names of organisms to be queried, e.g. "Homo sapiens"
     :type organisms: List[str]
+    :param max_workers: Maximum number of concurrent queries, defaults to 5
+    :type max_workers: int, optional
+    :param retries: Repetitions of queries failing with connection or server errors, defaults to 3
+    :type retries: int, optional
+    :param backoff: Seconds to wait before the first repetition, doubled for each further one, defaults to 1
+    :type backoff: float, optional
+    :param rate: Maximum number of queries started per second, defaults to no limit
+    :type rate: float, optional
+    :param url: URL of SabioRK's TSV export web service
+    :type url: str, optional
+    :param session: HTTP session to use, defaults to a new one
+    :type session: requests.Session, optional
+    :param max_age: Seconds after which a recorded query is fetched again, defaults to fetching all queries again
+    :type max_age: float, optional
     :return: List of the files the queries have been written into.
     :rtype: List[str]
     """
-    # TODO: only works for first entry in the list, 
-    # workaround: use a single element list, e.g. sabio_fetch(['Mus musculus'])
-    QUERY_URL = 'http://sabiork.h-its.org/sabioRestWebServices/kineticlawsExportTsv'
     # specify search fields and search terms
-    outfiles = []
     outpath = Path(outpath)
     if not os.path.exists(outpath):
         os.makedirs(outpath)
     if not organisms:
-        organisms = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
+        organisms = DEFAULT_ORGANISMS
+    manifest = Manifest(outpath)
+    filenames = []
+    queries = []
     for org in organisms:
         org_split = org.split(' ')
-        outfile = outpath / f'sabiork_{org_split[0]}_{org_split[1]}.tsv'
+        filenames.append(outpath / f'sabiork_{org_split[0]}_{org_split[1]}.tsv')
         query_dict = {"Organism": '"{}"'.format(org)}
         # left in for easier modification
         query_string = ' AND '.join(['%s:%s' % (k, v)
                                      for k, v in query_dict.items()])
-        # specify output fields and send request
-        query = {'fields[]': ['EntryID', 'Organism', 'UniprotID',
-                              'ECNumber', 'Parameter'], 'q': query_string}
-        request = requests.post(QUERY_URL, params=query)
-        request.raise_for_status()
-        with open(outfile, 'w') as f:
-            f.write(request.text)
-        outfiles.append(outfile)
+        # specify output fields
+        queries.append({'fields[]': ['EntryID', 'Organism', 'UniprotID',
+                                     'ECNumber', 'Parameter'], 'q': query_string})
+    params = [{'service': 'sabiork', 'url': url, 'query': query} for query in queries]
+    stale = manifest.stale(filenames, params, max_age)
+    if not stale:
+        return filenames
+
+    own_session = session is None
+    if own_session:
+        session = requests.Session()
+    limiter = RateLimiter(rate)
 
-        return outfiles
+    def fetch(i):
+        def post():
+            request = session.post(url, params=queries[i])
+            request.raise_for_status()
+            return request.text
+
+        text = _retry(post, retries, backoff, limiter)
+        rows = max(len(text.splitlines()) - 1, 0)
+        return manifest.save(filenames[i], params[i], text, rows)
+
+    try:
+        _run_concurrently([partial(fetch, i) for i in stale], max_workers)
+    finally:
+        if own_session:
+            session.close()
+    return filenames
 
 def brenda_fetch(
     organisms = [], 
     cofactors = [], 
     outpath = './brenda_queries', 
+    email: Optional[str] = None,
+    password: Optional[str] = None,
+    max_workers: int = 5,
+    retries: int = 3,
+    backoff: float = 1.,
+    rate: Optional[float] = None,
+    wsdl: str = BRENDA_WSDL,
+    client: Optional[Client] = None,
+    max_age: Optional[float] = None,
     ) -> List[str]:
     """
     Fetch Km values for given organisms and cofactors from Brenda and save them as tsv files.
+    All queries share one SOAP client and run concurrently. Every file is recorded in the folder's Manifest once
+    written, so with max_age set, queries fetched recently are skipped and an interrupted run continues where it stopped.
     :param organisms: Organisms for which to fetch Km, defaults to []
     :type organisms: List[str], optional
     :param cofactors: Cofactors for which to fetch Km, defaults to []
     :type cofactors: List[str], optional
     :param outpath: Path under which to save TSVs, defaults to './brenda_queries'
     :type outpath: str, optional
+    :param email: E-Mail Address of Brenda account, asked for if not given and any query needs to be sent
+    :type email: str, optional
+    :param password: Password of Brenda account, asked for if not given and any query needs to be sent
+    :type password: str, optional
+    :param max_workers: Maximum number of concurrent queries, defaults to 5
+    :type max_workers: int, optional
+    :param retries: Repetitions of queries failing with connection or server errors, defaults to 3
+    :type retries: int, optional
+    :param backoff: Seconds to wait before the first repetition, doubled for each further one, defaults to 1
+    :type backoff: float, optional
+    :param rate: Maximum number of queries started per second, defaults to no limit
+    :type rate: float, optional
+    :param wsdl: URL of Brenda's WSDL
+    :type wsdl: str, optional
+    :param client: SOAP client to use, defaults to a new one for wsdl
+    :type client: zeep.Client, optional
+    :param max_age: Seconds after which a recorded query is fetched again, defaults to fetching all queries again
+    :type max_age: float, optional
     :return: List of paths to all files created
     :rtype: List[str]
     """
     if not cofactors:
-        cofactors = ['NAD+', 'NADH', 'NADP+', 'NADPH']    
+        cofactors = DEFAULT_COFACTORS
     if not organisms:
-        organisms = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
-    email = input('Your Brenda account E-Mail\n')
-    password = input('Your Brenda account password\n')
-    password = sha256(password.encode("utf-8")).hexdigest()
+        organisms = DEFAULT_ORGANISMS
     outpath = Path(outpath)
     if not outpath.exists():
         outpath.mkdir()
-    outfiles = []
-    for organism in organisms:
-        organism_tag = organism.replace(' ', '_')
-        for cofactor in cofactors:
-            result = _brenda_fetch_single(email, password, organism, cofactor)
-            result = _brenda_parse_single(result)
-            filename = outpath / f'{cofactor.lower()}_{organism_tag}_brenda.tsv'
-            with open(filename, 'w') as f:
-                f.write(result)
-            outfiles.append(filename)
-    return outfiles
+    manifest = Manifest(outpath)
+    queries = [(organism, cofactor) for organism in organisms for cofactor in cofactors]
+    filenames = [outpath / f'{cofactor.lower()}_{organism.replace(" ", "_")}_brenda.tsv' for organism, cofactor in queries]
+    params = [{'service': 'brenda', 'wsdl': wsdl, 'organism': organism, 'cofactor': cofactor} for organism, cofactor in queries]
+    stale = manifest.stale(filenames, params, max_age)
+    if not stale:
+        return filenames
+
+    if email is None:
+        email = input('Your Brenda account E-Mail\n')
+    if password is None:
+        password = input('Your Brenda account password\n')
+    password = sha256(password.encode("utf-8")).hexdigest()
+    if client is None:
+        client = brenda_client(wsdl, retries, backoff)
+    limiter = RateLimiter(rate)
+
+    def fetch(i):
+        organism, cofactor = queries[i]
+        result = _retry(partial(_brenda_fetch_single, email, password, organism, cofactor, client), retries, backoff, limiter)
+        return manifest.save(filenames[i], params[i], _brenda_parse_single(result), len(result))
+
+    _run_concurrently([partial(fetch, i) for i in stale], max_workers)
+    return filenames
+
+
+def brenda_client(wsdl: str = BRENDA_WSDL, retries: int = 3, backoff: float = 1.) -> Client:
+    """
+    Creates a SOAP client for Brenda. Downloading and parsing the WSDL happens once here, the client is then shared by
+    all queries.
+    :param wsdl: URL of Brenda's WSDL
+    :type wsdl: str, optional
+    :param retries: Repetitions of the download on connection or server errors, defaults to 3
+    :type retries: int, optional
+    :param backoff: Seconds to wait before the first repetition, doubled for each further one, defaults to 1
+    :type backoff: float, optional
+    :rtype: zeep.Client
+    """
+    return _retry(lambda: Client(wsdl, transport=Transport(session=requests.Session())), retries, backoff)
 
         
-def _brenda_fetch_single(email:str , password: str, organism: str, cofactor: str):
+def _brenda_fetch_single(email:str , password: str, organism: str, cofactor: str, client: Optional[Client] = None):
     """
     Fetch a single set of Kms from Brenda.
     :param email: E-Mail Address of Brenda account
@@ -99,16 +403,20 @@ def _brenda_fetch_single(email:str , password: str, organism: str, cofactor: str
     :type organism: str
     :param cofactor: Cofactor string (e.g. "NAD+" or "NADPH")
     :type cofactor: str
+    :param client: SOAP client to reuse, defaults to a new one
+    :type client: zeep.Client, optional
     :return: Brenda API's response
     :rtype: Zeep return object (list-like)
+    :raises ValueError: If the response is empty or None.
     """
-    wsdl = "https://www.brenda-enzymes.org/soap/brenda_zeep.wsdl"
-    client = Client(wsdl)
+    if client is None:
+        client = brenda_client()
     parameters = (email, password, "ecNumber*", "kmValue*", "kmValueMaximum*", f"substrate*{cofactor}", 
                   "commentary*", f"organism*{organism}", "ligandStructureId*", "literature*")
     results = client.service.getKmValue(*parameters)
     if not results:
-        print(f'List of results is empty for {organism} and {cofactor}. Check correctness of login data.')
+        # Brenda answers wrong login data with an empty result, which must not be recorded as a fresh download
+        raise ValueError(f'List of results is empty for {organism} and {cofactor}. Check correctness of login data.')
     return results
 
 def _brenda_parse_single(result) -> str:
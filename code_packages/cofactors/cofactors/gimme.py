@@ -0,0 +1,97 @@
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+from cofactors.family import ModelFamily
+from cofactors.integration import _n_jobs
+from cofactors.lp import PersistentLP
+
+# flux above which a reaction counts as used by the GIMME solution
+FLUX_TOLERANCE = 1e-9
+# expression value of reactions without measured genes, as in the COBRA Toolbox
+FILL_VALUE = -1.
+TAG = '{condition}_objfrac_{fraction:.2f}'
+
+
+def gimme_threshold(expression):
+	"""
+	Default expression threshold: median of the conditions' medians. Only measured reactions count, as filling in the
+	others first would give the fill value whenever most reactions lack expression.
+	:param expression: Dataframe of expression values indexed by reaction ID, one column per condition, see map_expression.
+	:return: Float.
+	"""
+	return float(np.median(expression.median(skipna=True).to_numpy()))
+
+
+def gimme(model, expression, fractions=(.8,), threshold=None, fill_value=FILL_VALUE, solver=None, n_jobs=1, executor=None, tag=TAG):
+	"""
+	Builds GIMME context models of several conditions for several fractions of the optimum, like createTissueSpecificModel
+	of the COBRA Toolbox.
+	Reactions expressed below the threshold are weighted by their distance to it, and the weighted sum of all forward and
+	reverse fluxes is minimized while the objective keeps its fraction of the optimum. Reactions expressed above the
+	threshold, without expression, or carrying flux in that solution are kept, the others removed. All conditions and
+	fractions share one LP per worker, which only changes its weights and the bound on the objective in between. Where the
+	GIMME problem has alternative optima, reactions without weight that carry flux can depend on the solver and on how
+	the fractions are split over workers.
+	:param model: Model object to be used. It is not modified.
+	:param expression: Dataframe of expression values indexed by reaction ID, one column per condition, see map_expression.
+		Missing reactions and NaN count as not measured.
+	:param fractions: Fractions of the optimal objective flux the models need to retain. Defaults to 0.8 .
+	:param threshold: Expression threshold. Defaults to gimme_threshold of the expression.
+	:param fill_value: Value of reactions without expression. Defaults to -1.
+	:param solver: Solver of the LP, see PersistentLP.
+	:param n_jobs: Number of worker processes. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param tag: Format string of the variant names with fields condition and fraction.
+	:return: ModelFamily of the input model with one variant per condition and fraction, the removed reactions as deltas.
+	"""
+	expression = expression.reindex([r.id for r in model.reactions])
+	if threshold is None:
+		threshold = gimme_threshold(expression)
+	expression = expression.fillna(fill_value)
+	conditions = list(expression.columns)
+	values = expression.to_numpy(dtype=float)
+	weights = np.where((values > fill_value) & (values < threshold), threshold - values, 0.)
+	keep = (values > threshold) | (values == fill_value)
+
+	units = [(j, fraction) for j in range(len(conditions)) for fraction in sorted(fractions, reverse=True)]
+	tags = [tag.format(condition=conditions[j], fraction=fraction) for j, fraction in units]
+	if len(set(tags)) != len(tags):
+		raise ValueError('Tags of the variants need to be unique, pass a more precise tag format.')
+	n_jobs = _n_jobs(n_jobs, executor)
+	splits = np.array_split(np.arange(len(units)), min(n_jobs, len(units)))
+	chunks = [(model, solver, weights, [units[i] for i in split]) for split in splits]
+	if n_jobs == 1 and executor is None:
+		parts = [_gimme_chunk(chunk) for chunk in chunks]
+	else:
+		own_executor = executor is None
+		if own_executor:
+			executor = ProcessPoolExecutor(max_workers=len(chunks))
+		try:
+			parts = list(executor.map(_gimme_chunk, chunks))
+		finally:
+			if own_executor:
+				executor.shutdown()
+	used = np.concatenate(parts)
+
+	reaction_ids = np.array([r.id for r in model.reactions])
+	deltas = {}
+	for k, (j, fraction) in enumerate(units):
+		deltas[tags[k]] = {'removed': list(reaction_ids[~(keep[:, j] | used[k])])}
+	order = [tag.format(condition=c, fraction=f) for c in conditions for f in fractions]
+	return ModelFamily(deepcopy(model), {t: deltas[t] for t in order})
+
+
+def _gimme_chunk(args):
+	"""
+	Solves the GIMME problems of one chunk of conditions and fractions on a persistent LP.
+	:param args: Tuple of model, solver, array of weights (reactions x conditions) and list of (condition index, fraction).
+	:return: Boolean array of the reactions carrying flux, one row per unit.
+	"""
+	model, solver, weights, units = args
+	lp = PersistentLP(model, solver)
+	optimum = lp.optimize().objective_value
+	used = np.zeros((len(units), len(lp.reaction_ids)), dtype=bool)
+	for k, (j, fraction) in enumerate(units):
+		fluxes = lp.minimize_flux(weights[:, j], optimum * fraction)
+		used[k] = np.abs(fluxes) > FLUX_TOLERANCE
+	return used
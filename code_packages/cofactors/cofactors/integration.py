@@ -1,96 +1,457 @@
+import numpy as np
 import pandas as pd
 import cobra
-from copy import deepcopy
+from copy import copy, deepcopy
+from contextlib import contextmanager
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from functools import partial
+from itertools import chain
+import os
+from cobra.core import get_solution
+from cobra.util.solver import fix_objective_as_constraint
+from optlang.symbolics import Zero
+from scipy.optimize import brentq
 from statistics import median, mean
+from cofactors.kms import KmIndex, decision_name
+from cofactors.lp import PersistentLP, HighsLP, bound_sensitivity
+from cofactors.cache import get_cache, content_hash
 
 TOLERANCE = 10**(-5)
+# width below which scan intervals are not split further, see ConcentrationScan.run_adaptive
+MIN_INTERVAL = 10**(-6)
+REFERENCE_CACHE_SIZE = 16
+# solvers of reference solutions: cobra with the model's solver, or a HighsLP
+BACKENDS = (None, 'highs')
 
+# reference pFBA/FVA solutions of unchanged input models, see _reference_solution
+_reference_cache = OrderedDict()
 
-def _get_km(kms, reaction, mappings, id_type, decision, preference, verbose=False):
+
+def _km_index(mappings, kms, id_type, decision, preference):
 	"""
-	Pulls the KM for a given reaction.
-	:param kms: Dataframe containing SabioRK or Brenda data.
-	:param reaction: Reaction in question.
+	Builds a KmIndex unless one is passed already.
 	:param mappings: Dictionary associating reactions with their UniProt or EC identifiers.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex.
 	:param id_type: Type of ID used. Either 'ec' or 'up'
-	:param decision: How to choose one of the KMs. 'min', 'avg' or 'med'. Defaults to 'min'.
+	:param decision: How to choose one of the KMs. Callable or 'min', 'avg' or 'med'.
 	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
-	:return: A KM. Float.
+	:return: KmIndex.
+	"""
+	if isinstance(kms, KmIndex):
+		return kms
+	return KmIndex(kms, mappings, id_type, decision, preference)
+
+
+def _model_key(model):
+	"""
+	Key identifying the LP of a model by its reactions, bounds and objective.
+	:param model: Model object.
+	:return: Hashable key.
+	"""
+	bounds = tuple((rxn.id, rxn.lower_bound, rxn.upper_bound) for rxn in model.reactions)
+	return bounds, model.objective.direction, str(model.objective.expression)
+
+
+def _cold_start(model):
 	"""
+	Discards the basis the solver kept from earlier solves on the same model.
+	Degenerate LPs have alternative optimal fluxes, and warm starts would make those depend on what was solved before.
+	Starting from the solver's initial basis instead gives the same solution as a fresh copy of the model.
+	Only GLPK and Gurobi keep a basis to reset, other solvers are left as they are.
+	:param model: Model object.
+	"""
+	interface = model.problem.__name__
+	if interface in ('optlang.glpk_interface', 'optlang.glpk_exact_interface'):
+		# swiglpk is only installed along with GLPK
+		import swiglpk
+		swiglpk.glp_std_basis(model.solver.problem)
+	elif interface == 'optlang.gurobi_interface':
+		model.solver.problem.reset()
+
+
+def _replay_reference(model, plan, lower, upper):
+	"""
+	Leaves the solver of a scan point's model in the state the reference pFBA leaves a fresh copy of the input model in,
+	as create_models did for every point on its own copy. Alternative optimal fluxes and reduced costs depend on that
+	state, so the point's solves then give the same ones as with a copy per point. Costs one extra pFBA per point.
+	:param model: Model with the point's bounds applied.
+	:param plan: AdjustmentPlan of the model.
+	:param lower: Array of the input model's lower bounds, aligned with plan.reaction_ids.
+	:param upper: Array of the input model's upper bounds, aligned with plan.reaction_ids.
+	"""
+	with model:
+		plan.apply(model, lower, upper)
+		_cold_start(model)
+		cobra.flux_analysis.parsimonious.pfba(model)
+
+
+def _reference_solution(model, method, obj_frac=None, reaction_ids=None, backend=None):
+	"""
+	Solves the reference pFBA or FVA of a model, reusing earlier results for models with identical bounds and objective.
+	Scans and comparisons of decision functions build many models from the same input model, which all share this solution.
+	With the on-disk cache enabled (see cofactors.cache.enable_cache), solutions are also kept across sessions.
+	:param model: Model object to be used.
+	:param method: 'pfba' or 'fva'.
+	:param obj_frac: Fraction of optimal objective flux that needs to be retained in FVA.
+	:param reaction_ids: Reactions to run FVA on. Defaults to all reactions.
+	:param backend: None solves with cobra, 'highs' directly on a HighsLP.
+	:return: Series of pFBA fluxes or dataframe of FVA minima and maxima.
+	"""
+	key = _reference_key(model, method, obj_frac, reaction_ids, backend)
 	try:
-		ids = mappings[reaction]
+		_reference_cache.move_to_end(key)
+		return _reference_cache[key]
 	except KeyError:
-		return None
-	if verbose:
-		print(f'Getting Kms for {ids}')
-	kms = kms[kms[id_type].isin(ids)]
-	organisms = list(kms.index.unique())
-	organisms = [o.lower() for o in organisms]
-	preference = [o.lower() for o in preference]
-	if kms.empty: # empty dataframes not being caught would lead to weird errors
-		return None
-	if verbose:
-		print('All Kms mapped:')
-		print(kms)
-	for org in preference:
-		if org in organisms:
-			kms = kms[kms.index == org]
-			kms = list(kms['value'])
-			kms = [float(x) for x in kms]
-			if verbose:
-				print(f'Organism {org} found')
-				print(f'Picking from Kms {sorted(kms)}')
-			break
-	#todo: Implement alternative decisions
-	return decision(kms)
-
-
-def create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec', decision=min, preference=None):
+		pass
+	if method not in ('pfba', 'fva'):
+		raise ValueError(f'Unknown method {method!r}. Use "pfba" or "fva".')
+	reaction_ids, model_key = key[2], key[4]
+	full = _reference_cache.get((method, obj_frac, None, backend, model_key)) if reaction_ids is not None else None
+	if full is not None:
+		sol = full.loc[list(reaction_ids)]
+	else:
+		sol = _solve_reference(model, method, obj_frac, reaction_ids, backend)
+	_reference_cache[key] = sol
+	while len(_reference_cache) > REFERENCE_CACHE_SIZE:
+		_reference_cache.popitem(last=False)
+	return sol
+
+
+def _reference_key(model, method, obj_frac=None, reaction_ids=None, backend=None):
+	"""
+	Key of a reference solution in _reference_cache.
+	:param model: Model object to be used.
+	:param method: 'pfba' or 'fva'.
+	:param obj_frac: Fraction of optimal objective flux that needs to be retained in FVA.
+	:param reaction_ids: Reactions to run FVA on. Defaults to all reactions.
+	:param backend: None solves with cobra, 'highs' directly on a HighsLP.
+	:return: Hashable key.
+	"""
+	if backend not in BACKENDS:
+		raise ValueError(f'Unknown backend {backend!r}. Use one of {BACKENDS}.')
+	if reaction_ids is not None:
+		reaction_ids = tuple(reaction_ids)
+	return method, obj_frac, reaction_ids, backend, _model_key(model)
+
+
+def _solve_reference(model, method, obj_frac, reaction_ids, backend=None):
+	"""
+	Solves a reference pFBA or FVA, or loads it from the on-disk cache.
+	:param model: Model object to be used.
+	:param method: 'pfba' or 'fva'.
+	:param obj_frac: Fraction of optimal objective flux that needs to be retained in FVA.
+	:param reaction_ids: Tuple of reactions to run FVA on, or None for all reactions.
+	:param backend: None solves with cobra, 'highs' directly on a HighsLP.
+	:return: Series of pFBA fluxes or dataframe of FVA minima and maxima.
+	"""
+	disk_cache = get_cache()
+	if disk_cache is not None:
+		parts = ['reference', method, obj_frac, model]
+		if reaction_ids is not None:
+			parts.append(list(reaction_ids))
+		if backend is not None:
+			parts.append(backend)
+		disk_key = content_hash(*parts)
+		stored = disk_cache.get(disk_key)
+		if stored is not None:
+			return stored['solution']
+	if backend == 'highs':
+		sol = _solve_reference_highs(model, method, obj_frac, reaction_ids)
+	elif method == 'pfba':
+		_cold_start(model)
+		sol = cobra.flux_analysis.parsimonious.pfba(model).fluxes
+	elif reaction_ids is None:
+		_cold_start(model)
+		sol = cobra.flux_analysis.flux_variability_analysis(model, fraction_of_optimum=obj_frac)
+	elif reaction_ids:
+		_cold_start(model)
+		sol = cobra.flux_analysis.flux_variability_analysis(model, reaction_list=list(reaction_ids), fraction_of_optimum=obj_frac)
+	else:
+		sol = pd.DataFrame(columns=['minimum', 'maximum'], dtype=float)
+	if disk_cache is not None:
+		disk_cache.put(disk_key, {'solution': sol})
+	return sol
+
+
+def _solve_reference_highs(model, method, obj_frac, reaction_ids):
+	"""
+	Solves a reference pFBA or FVA on a HighsLP, without cobra's solution objects.
+	:param model: Model object to be used.
+	:param method: 'pfba' or 'fva'.
+	:param obj_frac: Fraction of optimal objective flux that needs to be retained in FVA.
+	:param reaction_ids: Tuple of reactions to run FVA on, or None for all reactions.
+	:return: Series of pFBA fluxes or dataframe of FVA minima and maxima.
+	"""
+	lp = HighsLP(model)
+	if method == 'pfba':
+		return pd.Series(lp.pfba()[2], index=lp.reaction_ids, name='fluxes')
+	if reaction_ids is None:
+		reaction_ids = lp.reaction_ids
+	index = {r: i for i, r in enumerate(lp.reaction_ids)}
+	ranges = lp.fva([index[r] for r in reaction_ids], obj_frac)
+	return pd.DataFrame(ranges, index=list(reaction_ids), columns=['minimum', 'maximum'])
+
+
+def clear_reference_cache():
+	"""
+	Drops all cached reference pFBA and FVA solutions.
+	"""
+	_reference_cache.clear()
+
+
+def fva_fractions(model, fractions, reaction_ids=None, solver=None):
+	"""
+	Flux ranges of a model for a whole list of fractions of the optimum, e.g. to scan obj_frac of create_models_fva.
+	The optimum is solved once and all min/max problems run on one persistent LP, moving only the objective constraint
+	between fractions (see PersistentLP.fva_fractions). With the on-disk cache enabled, results are kept across sessions.
+	:param model: Model object to be used. It is not modified.
+	:param fractions: Fractions of optimal objective flux that need to be retained.
+	:param reaction_ids: Reaction IDs to compute the ranges of. Defaults to all reactions.
+	:param solver: Solver of the LP, see PersistentLP.
+	:return: Dictionary of fractions to dataframes with columns 'minimum' and 'maximum', reaction IDs as index. Can be
+		passed to create_models_fva as fva_ranges.
+	"""
+	fractions = [float(f) for f in fractions]
+	if reaction_ids is not None:
+		reaction_ids = list(reaction_ids)
+	disk_cache = get_cache()
+	disk_key = content_hash('fva_fractions', fractions, reaction_ids, solver, model) if disk_cache is not None else None
+	stored = disk_cache.get(disk_key) if disk_cache is not None else None
+	if stored is not None:
+		return {f: stored[str(k)] for k, f in enumerate(fractions)}
+	ranges = PersistentLP(model, solver).fva_fractions(fractions, reaction_ids)
+	if disk_cache is not None:
+		disk_cache.put(disk_key, {str(k): ranges[f] for k, f in enumerate(fractions)})
+	return ranges
+
+
+class AdjustmentPlan:
+	"""
+	Reactions of a model whose bounds get rescaled, i.e. those with a resolvable Km and compartment, along with their
+	Kms and compartments.
+	Built once per model and Km index, so the Michaelis-Menten rescaling of all bounds can be done as array operations.
+	The create_models* functions take a plan to reuse, and FVA based integration only runs FVA on its reactions.
+	"""
+
+	def __init__(self, model, km_index):
+		"""
+		:param model: Model object to be used.
+		:param km_index: KmIndex resolving reactions to Kms.
+		"""
+		self.km_index = km_index
+		self.reaction_ids = []
+		self.indices = []
+		kms = []
+		compartments = []
+		for i, rxn in enumerate(model.reactions):
+			km = km_index.get(rxn.id)
+			if km is None or not rxn.compartments:
+				continue
+			self.reaction_ids.append(rxn.id)
+			self.indices.append(i)
+			kms.append(km)
+			compartments.append(_compartment(rxn))
+		self.kms = np.array(kms, dtype=float)
+		self.compartments = np.array(compartments, dtype=object)
+		self._comp_names, self._comp_codes = np.unique(np.array(compartments, dtype=str), return_inverse=True)
+
+	def __len__(self):
+		return len(self.reaction_ids)
+
+	def with_index(self, km_index):
+		"""
+		The same plan with the Kms of another index over the same values, e.g. one with a different decision.
+		:param km_index: KmIndex with Kms for all of the plan's reactions.
+		:return: AdjustmentPlan.
+		"""
+		plan = copy(self)
+		plan.km_index = km_index
+		plan.kms = np.array([km_index[r] for r in self.reaction_ids], dtype=float)
+		return plan
+
+	def check(self, model):
+		"""
+		Makes sure a model has the plan's reactions at the plan's positions.
+		:param model: Model object.
+		"""
+		reactions = model.reactions
+		if any(i >= len(reactions) or reactions[i].id != rxn_id for i, rxn_id in zip(self.indices, self.reaction_ids)):
+			raise ValueError(f'The adjustment plan was not built for model {model.id}.')
+
+	def concentrations(self, c_dict):
+		"""
+		Concentrations per adjusted reaction.
+		:param c_dict: Dictionary of compartment to [NAD].
+		:return: Array of concentrations, aligned with reaction_ids.
+		"""
+		return np.array([c_dict[c] for c in self._comp_names], dtype=float)[self._comp_codes]
+
+	def rescale(self, low, high, c_old_dict, c_new_dict):
+		"""
+		Rescales reference fluxes or bounds with the ratio of Michaelis-Menten saturations at the new and old concentrations.
+		:param low: Lower reference values (fluxes, FVA minima or bounds), aligned with reaction_ids.
+		:param high: Upper reference values, aligned with reaction_ids.
+		:param c_old_dict: Dictionary of compartment to [NAD].
+		:param c_new_dict: Dictionary of compartment to [NAD].
+		:return: Tuple of arrays of new lower and upper bounds.
+		"""
+		km, c_old, c_new = self._saturation_inputs(c_old_dict, c_new_dict)
+		f_goal_low = np.asarray(low, dtype=float) * (c_new / (km + c_new)) * ((km + c_old) / c_old)
+		f_goal_high = np.asarray(high, dtype=float) * (c_new / (km + c_new)) * ((km + c_old) / c_old)
+		return np.minimum(f_goal_low, 0), np.maximum(f_goal_high, 0)
+
+	def factors(self, c_old_dict, c_new_dict):
+		"""
+		Michaelis-Menten factors the reference values are rescaled with, see rescale.
+		:param c_old_dict: Dictionary of compartment to [NAD].
+		:param c_new_dict: Dictionary of compartment to [NAD].
+		:return: Array of factors, aligned with reaction_ids.
+		"""
+		km, c_old, c_new = self._saturation_inputs(c_old_dict, c_new_dict)
+		return (c_new / (km + c_new)) * ((km + c_old) / c_old)
+
+	def _saturation_inputs(self, c_old_dict, c_new_dict):
+		"""
+		:param c_old_dict: Dictionary of compartment to [NAD].
+		:param c_new_dict: Dictionary of compartment to [NAD].
+		:return: Tuple of arrays of Kms, old and new concentrations, aligned with reaction_ids.
+		"""
+		km = self.kms
+		c_old = self.concentrations(c_old_dict)
+		c_new = self.concentrations(c_new_dict)
+		invalid = ((km + c_new) == 0) | (c_old == 0)
+		if invalid.any():
+			i = np.flatnonzero(invalid)[0]
+			raise ZeroDivisionError(f"ZeroDivisionError in {self.reaction_ids[i]} with KM {km[i]}, c' {c_new[i]} and c {c_old[i]}")
+		return km, c_old, c_new
+
+	def apply(self, model, lower, upper):
+		"""
+		Sets new bounds on all adjusted reactions of a model.
+		:param model: Model with the same reactions as the one the plan was built for.
+		:param lower: Array of lower bounds, aligned with reaction_ids.
+		:param upper: Array of upper bounds, aligned with reaction_ids.
+		"""
+		reactions = model.reactions
+		for i, lb, ub in zip(self.indices, np.asarray(lower).tolist(), np.asarray(upper).tolist()):
+			reactions[i].bounds = (lb, ub)
+
+
+def _compartment(rxn):
+	"""
+	Compartment used for the concentration of a reaction's cofactor.
+	Reactions spanning compartments use the alphabetically first one, so the choice does not depend on set ordering.
+	:param rxn: Reaction object.
+	:return: Compartment ID.
+	"""
+	return sorted(rxn.compartments)[0]
+
+
+class BoundVariant:
+	"""
+	New bounds for the adjusted reactions of a model, kept apart from the model itself.
+	Many variants can share one base model. Their bounds are only set while a variant is applied, or on an explicit copy.
+	"""
+
+	def __init__(self, model, plan, lower, upper):
+		"""
+		:param model: Base model the variant was created from.
+		:param plan: AdjustmentPlan of the base model.
+		:param lower: Array of new lower bounds, aligned with plan.reaction_ids.
+		:param upper: Array of new upper bounds, aligned with plan.reaction_ids.
+		"""
+		self.model = model
+		self.plan = plan
+		self.lower = np.asarray(lower, dtype=float)
+		self.upper = np.asarray(upper, dtype=float)
+
+	@property
+	def reaction_ids(self):
+		return self.plan.reaction_ids
+
+	@contextmanager
+	def applied(self, model=None):
+		"""
+		Sets the variant's bounds for the duration of a with-block and reverts them afterwards.
+		:param model: Model to set the bounds on. Defaults to the base model, other models need the same reactions.
+		:return: Context manager yielding the model with adapted boundaries.
+		"""
+		if model is None:
+			model = self.model
+		with model:
+			self.plan.apply(model, self.lower, self.upper)
+			yield model
+
+	def to_model(self):
+		"""
+		Materializes the variant as a copy of the base model.
+		:return: Model with adapted boundaries.
+		"""
+		model_new = deepcopy(self.model)
+		self.plan.apply(model_new, self.lower, self.upper)
+		return model_new
+
+	def bounds(self):
+		"""
+		:return: Dataframe of the new lower and upper bounds of the adjusted reactions.
+		"""
+		return pd.DataFrame({'lower_bound': self.lower, 'upper_bound': self.upper}, index=self.reaction_ids)
+
+	def __repr__(self):
+		return f'<BoundVariant of {self.model.id} adjusting {len(self.reaction_ids)} reactions>'
+
+
+def _plan(model, plan, mappings, kms, id_type, decision, preference):
+	"""
+	Builds an AdjustmentPlan unless one is passed already.
+	:param model: Model object to be used.
+	:param plan: AdjustmentPlan or None.
+	:param mappings: Dictionary associating reactions with their UniProt or EC identifiers.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex.
+	:param id_type: Type of ID used. Either 'ec' or 'up'
+	:param decision: How to choose one of the KMs. Callable or 'min', 'avg' or 'med'.
+	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
+	:return: AdjustmentPlan.
+	"""
+	if plan is None:
+		return AdjustmentPlan(model, _km_index(mappings, kms, id_type, decision, preference))
+	plan.check(model)
+	return plan
+
+
+def create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec', decision=min, preference=None, as_variant=False, plan=None, backend=None):
 	"""
 	Creates a model for the given NAD concentrations. Uses pFBA to update fluxes.
 	:param model: Model object to be used
 	:param mappings: Mappings of reactions to ECs or Uniprot IDs.
-	:param kms: Dataframe containing SabioRK or Brenda data.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Dictionary of compartment to [NAD].
 	:param c_new_dict: Dictionary of compartment to [NAD].
 	:param id_type: Identifier to use. 'ec' or 'up'.
 	:param decision: How to decide between multiple KMs. Defaults to min (picking minimal Km).
 	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
-	:return: Model with adapted boundaries.
+	:param as_variant: Return a BoundVariant sharing the input model instead of a copy of it.
+	:param plan: AdjustmentPlan of the model to reuse, replacing mappings, kms, id_type, decision and preference.
+	:param backend: Solver of the reference pFBA: None uses cobra, 'highs' a HighsLP built from the model's arrays.
+	:return: Model with adapted boundaries, or BoundVariant.
 	"""
-	model_new = deepcopy(model)
-	if not preference:
-		preference = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
-	sol = cobra.flux_analysis.parsimonious.pfba(model_new)
+	plan = _plan(model, plan, mappings, kms, id_type, decision, preference)
+	sol = _reference_solution(model, 'pfba', backend=backend)
+	flux = sol[plan.reaction_ids].to_numpy()
+	# set an ideal new flux using the old flux
+	lower, upper = plan.rescale(flux, flux, c_old_dict, c_new_dict)
+	variant = BoundVariant(model, plan, lower, upper)
 	
-	for rxn in model_new.reactions:
-		km = _get_km(kms, rxn.id, mappings, id_type, decision, preference)
-		if km is None:
-			continue
-		comp = rxn.get_compartments()[0]
-		c_old = c_old_dict[comp]
-		c_new = c_new_dict[comp]
-		flux = sol.fluxes[rxn.id]
-		try:
-			f_goal = flux * (c_new / (km + c_new)) * ((km + c_old) / c_old)  # set an ideal new flux using the old flux
-		except ZeroDivisionError:
-			raise ZeroDivisionError(f"ZeroDivisionError in {rxn.id} with KM {km}, c' {c_new} and c {c_old}")
-		if f_goal > 0:
-			rxn.upper_bound = f_goal
-			rxn.lower_bound = 0
-		else:
-			rxn.upper_bound = 0
-			rxn.lower_bound = f_goal
-	
-	return model_new
+	return variant if as_variant else variant.to_model()
 
 
-def create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec', decision=min, preference=None, obj_frac=.9, verbose=False):
+def create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec', decision=min, preference=None, obj_frac=.9, verbose=False, as_variant=False, fva_ranges=None, plan=None, backend=None):
 	"""
 	Creates a model for the given NAD concentrations. Uses flux variance to update fluxes.
 	:param model: Model object to be used
 	:param mappings: Mappings of reactions to ECs or Uniprot IDs.
-	:param kms: Dataframe containing SabioRK or Brenda data.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Dictionary of compartment to [NAD].
 	:param c_new_dict: Dictionary of compartment to [NAD].
 	:param id_type: Identifier to use. 'ec' or 'up'.
@@ -98,305 +459,939 @@ def create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec'
 	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
 	:param obj_frac: Fraction of optimal objective flux that needs to be retained. Float, defaults to 0.9 .
 	:param verbose: Print additional output for information.
-	:return: Model with adapted boundaries.
-	"""
-	model_new = deepcopy(model)
-	if not preference:
-		preference = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
-	sol = cobra.flux_analysis.flux_variability_analysis(model_new, fraction_of_optimum=obj_frac)
-	not_adjusted_rxns = []
-	adjusted_rxns = []
-	for rxn in model_new.reactions:
-		if verbose:
-			print(f'Adjusting reaction {rxn.id}')
-		km = _get_km(kms, rxn.id, mappings, id_type, decision, preference, verbose=verbose) # mM in the Brenda and SabioRK DBs
-		if km is None:
-			not_adjusted_rxns.append(rxn.id)
-			if verbose:
-				print('No Km found. Skipping {rxn.id}\n---\n')
-			continue
-		if verbose:
-			print(f'Picked Km {km}')
-		comp = rxn.get_compartments()[0]
-		if verbose:
-			print(f'Compartment used is {comp}')
-		c_old = c_old_dict[comp]
-		c_new = c_new_dict[comp]
-		if verbose:
-			print(f'Old and new concentrations are: {c_old} -- {c_new}')
-		flux_low = sol.loc[rxn.id, 'minimum']
-		flux_high = sol.loc[rxn.id, 'maximum']
-		if verbose:
-			print(f'FVA bounds are {flux_low:.2f} -- {flux_high:.2f}')
-		try:
-			f_goal_high = flux_high * (c_new / (km + c_new)) * ((km + c_old) / c_old)
-			f_goal_low = flux_low * (c_new / (km + c_new)) * ((km + c_old) / c_old)
-		except ZeroDivisionError:
-			raise ZeroDivisionError(f"ZeroDivisionError in {rxn.id} with KM {km}, c' {c_new} and c {c_old}")
-		
-		rxn.upper_bound = float(max(0, f_goal_high))
-		rxn.lower_bound = float(min(f_goal_low, 0))
-		if verbose:
-			print(f'New bounds are {rxn.lower_bound:.2f} -- {rxn.upper_bound:.2f}')
-			print('---\n')
-		adjusted_rxns.append(rxn.id)
+	:param as_variant: Return a BoundVariant sharing the input model instead of a copy of it.
+	:param fva_ranges: Precomputed FVA of the model instead of solving it here: dataframe with columns 'minimum' and
+		'maximum', or dictionary of fractions to such dataframes as returned by fva_fractions, of which the fraction
+		within TOLERANCE of obj_frac is used.
+	:param plan: AdjustmentPlan of the model to reuse, replacing mappings, kms, id_type, decision and preference.
+	:param backend: Solver of the reference FVA: None uses cobra, 'highs' a HighsLP built from the model's arrays.
+	:return: Model with adapted boundaries, or BoundVariant.
+	"""
+	plan = _plan(model, plan, mappings, kms, id_type, decision, preference)
+	km_index = plan.km_index
+	if fva_ranges is None:
+		# only the adjusted reactions' ranges are used
+		sol = _reference_solution(model, 'fva', obj_frac, plan.reaction_ids, backend)
+	elif isinstance(fva_ranges, dict):
+		# fractions are often computed, e.g. i / 100, so they are matched with a tolerance
+		fraction = min(fva_ranges, key=lambda f: abs(f - obj_frac))
+		if not np.isclose(fraction, obj_frac, rtol=0, atol=TOLERANCE):
+			raise KeyError(f'No flux ranges for obj_frac {obj_frac} in fva_ranges, the closest fraction is {fraction}.')
+		sol = fva_ranges[fraction]
+	else:
+		sol = fva_ranges
+	flux_low = sol.loc[plan.reaction_ids, 'minimum'].to_numpy()
+	flux_high = sol.loc[plan.reaction_ids, 'maximum'].to_numpy()
+	lower, upper = plan.rescale(flux_low, flux_high, c_old_dict, c_new_dict) # Kms are mM in the Brenda and SabioRK DBs
+	variant = BoundVariant(model, plan, lower, upper)
 	if verbose:
-		print(f'{len(adjusted_rxns)} reactions adjusted:')
-		print(adjusted_rxns)
+		c_old = plan.concentrations(c_old_dict)
+		c_new = plan.concentrations(c_new_dict)
+		for i, rxn_id in enumerate(plan.reaction_ids):
+			print(f'Adjusting reaction {rxn_id}')
+			print(f'Picking from Kms {sorted(km_index.values(rxn_id))} of {km_index.organism(rxn_id)}')
+			print(f'Picked Km {plan.kms[i]}')
+			print(f'Compartment used is {plan.compartments[i]}')
+			print(f'Old and new concentrations are: {c_old[i]} -- {c_new[i]}')
+			print(f'FVA bounds are {flux_low[i]:.2f} -- {flux_high[i]:.2f}')
+			print(f'New bounds are {lower[i]:.2f} -- {upper[i]:.2f}')
+			print('---\n')
+		adjusted_rxns = set(plan.reaction_ids)
+		not_adjusted_rxns = [r.id for r in model.reactions if r.id not in adjusted_rxns]
+		print(f'{len(plan.reaction_ids)} reactions adjusted:')
+		print(plan.reaction_ids)
 		print()
 		print(f'{len(not_adjusted_rxns)} reactions NOT adjusted:')
 		print(not_adjusted_rxns)
 
 	
-	return model_new
+	return variant if as_variant else variant.to_model()
 
-def create_models_bounds(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec', decision='min', preference=None, obj_frac=.9):
+def create_models_decisions(model, mappings, kms, c_old_dict, c_new_dict, decisions=('min', 'median', 'mean'), id_type='ec', preference=None, obj_frac=.9, method='fva', as_variant=False, fva_ranges=None, backend=None):
+	"""
+	Creates one model per Km decision function, e.g. to compare aggregation strategies.
+	The Kms of all decisions are resolved in one pass over the Km index (see KmIndex.with_decisions), and all models share
+	a single reference solution, as the adjusted reactions do not depend on the decision.
+	:param model: Model object to be used
+	:param mappings: Mappings of reactions to ECs or Uniprot IDs.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex replacing mappings, kms, id_type and preference.
+	:param c_old_dict: Dictionary of compartment to [NAD].
+	:param c_new_dict: Dictionary of compartment to [NAD].
+	:param decisions: Decisions to create models for, see cofactors.kms.resolve_decision. Callables, 'min', 'max',
+		'mean', 'median' or percentiles as 'pNN'. Defaults to min, median and mean.
+	:param id_type: Identifier to use. 'ec' or 'up'.
+	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
+	:param obj_frac: Fraction of optimal objective flux that needs to be retained by the FVA based integration.
+	:param method: Integration to use: 'fva' (create_models_fva), 'pfba' (create_models) or 'bounds'
+		(create_models_bounds). Defaults to 'fva'.
+	:param as_variant: Return BoundVariants sharing the input model instead of copies of it.
+	:param fva_ranges: Precomputed FVA of the model, see create_models_fva.
+	:param backend: Solver of the reference solution, see create_models_fva.
+	:return: Dictionary of decision names (strings as given, names of callables) to models or BoundVariants.
+	"""
+	creates = {'fva': create_models_fva, 'pfba': create_models, 'bounds': create_models_bounds}
+	if method not in creates:
+		raise ValueError(f'Unknown method {method!r}. Use one of {sorted(creates)}.')
+	kwargs = {'obj_frac': obj_frac, 'fva_ranges': fva_ranges} if method == 'fva' else {}
+	if method != 'bounds':
+		kwargs['backend'] = backend
+	km_index = _km_index(mappings, kms, id_type, min, preference)
+	plan = AdjustmentPlan(model, km_index)
+	models = {}
+	for name, index in km_index.with_decisions(decisions).items():
+		models[name] = creates[method](model, None, None, c_old_dict, c_new_dict, as_variant=as_variant, plan=plan.with_index(index), **kwargs)
+	return models
+
+
+def create_models_bounds(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec', decision='min', preference=None, obj_frac=.9, as_variant=False, plan=None):
 	"""
 	Creates a model for the given NAD concentrations. Uses flux variance to update fluxes.
 	:param model: Model object to be used
 	:param mappings: Mappings of reactions to ECs or Uniprot IDs.
-	:param kms: Dataframe containing SabioRK or Brenda data.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Dictionary of compartment to [NAD].
 	:param c_new_dict: Dictionary of compartment to [NAD].
 	:param id_type: Identifier to use. 'ec' or 'up'.
 	:param decision: How to decide between multiple KMs. Defaults to min (picking minimal Km).
 	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
 	:param obj_frac: Fraction of optimal objective flux that needs to be retained. Float, defaults to 0.9 .
-	:return: Model with adapted boundaries.
+	:param as_variant: Return a BoundVariant sharing the input model instead of a copy of it.
+	:param plan: AdjustmentPlan of the model to reuse, replacing mappings, kms, id_type, decision and preference.
+	:return: Model with adapted boundaries, or BoundVariant.
 	"""
-	model_new = deepcopy(model)
-	if not preference:
-		preference = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
+	plan = _plan(model, plan, mappings, kms, id_type, decision, preference)
+	lb = np.array([model.reactions[i].lower_bound for i in plan.indices], dtype=float)
+	ub = np.array([model.reactions[i].upper_bound for i in plan.indices], dtype=float)
+	lower, upper = plan.rescale(lb, ub, c_old_dict, c_new_dict)
+	variant = BoundVariant(model, plan, lower, upper)
 	
-	for rxn in model_new.reactions:
-		km = _get_km(kms, rxn.id, mappings, id_type, decision, preference)
-		if km is None:
-			continue
-		comp = rxn.get_compartments()[0]
-		c_old = c_old_dict[comp]
-		c_new = c_new_dict[comp]
-		ub = rxn.upper_bound
-		lb = rxn.lower_bound
-		try:
-			f_goal_high = ub * (c_new / (km + c_new)) * ((km + c_old) / c_old)
-			f_goal_low = lb * (c_new / (km + c_new)) * ((km + c_old) / c_old)
-		except ZeroDivisionError:
-			raise ZeroDivisionError(f"ZeroDivisionError in {rxn.id} with KM {km}, c' {c_new} and c {c_old}")
+	return variant if as_variant else variant.to_model()
+
+def _n_jobs(n_jobs, executor):
+	"""
+	Number of chunks a scan is split into.
+	:param n_jobs: Number of worker processes. -1 uses all cores.
+	:param executor: Optional executor, its worker count is used if n_jobs is not given.
+	:return: Integer.
+	"""
+	if n_jobs is None or n_jobs == 1:
+		n_jobs = getattr(executor, '_max_workers', 1) if executor is not None else 1
+	if n_jobs < 0:
+		n_jobs = os.cpu_count()
+	return max(1, n_jobs)
+
+
+def _scan_chunk(model, km_index, c_old_dict, fva, obj_frac, evaluate, ratios, persistent=False, backend=None):
+	"""
+	Builds the model for every concentration ratio and evaluates it.
+	:param model: Model object to be used.
+	:param km_index: KmIndex resolving reactions to Kms.
+	:param c_old_dict: Original concentrations. Dict with compartments as keys and concentrations as values.
+	:param fva: Boolean. Use FVA based integration.
+	:param obj_frac: Fraction of optimal objective flux retained by the FVA based integration.
+	:param evaluate: Function taking the model of one ratio and returning the result for that point.
+	:param ratios: Fractions of the original concentrations.
+	:param persistent: Evaluate all ratios on one warm-started PersistentLP. True uses the model's solver, a solver name
+		('highs', 'glpk', ...) picks one.
+	:param backend: Solver of the reference solution, see _reference_solution.
+	:return: List of results, one per ratio. Without persistent, pFBA based points match solving each point on its own
+		copy of the model, see _replay_reference. FVA based points start from the solver's initial basis instead of
+		repeating the full reference FVA, so only their objective values and total fluxes are guaranteed to match.
+	"""
+	results = []
+	lp = None
+	if persistent:
+		lp = PersistentLP(model, None if persistent is True else persistent)
+	plan = AdjustmentPlan(model, km_index)
+	reactions = [model.reactions[i] for i in plan.indices]
+	lower = np.array([rxn.lower_bound for rxn in reactions], dtype=float)
+	upper = np.array([rxn.upper_bound for rxn in reactions], dtype=float)
+	for ratio in ratios:
+		c_new_dict = {}
+		for comp in c_old_dict:
+			c_new_dict[comp] = c_old_dict[comp] * ratio
 		
-		rxn.upper_bound = max(0, f_goal_high)
-		rxn.lower_bound = min(f_goal_low, 0)
+		if fva:
+			variant = create_models_fva(model, None, None, c_old_dict, c_new_dict, obj_frac=obj_frac, as_variant=True, plan=plan, backend=backend)
+		else:
+			variant = create_models(model, None, None, c_old_dict, c_new_dict, as_variant=True, plan=plan, backend=backend)
+		if lp is not None:
+			lp.set_variant(variant)
+			results.append(evaluate(lp))
+			continue
+		with variant.applied() as model_new:
+			if fva:
+				_cold_start(model_new)
+			else:
+				_replay_reference(model_new, plan, lower, upper)
+			results.append(evaluate(model_new))
+	return results
+
+
+def _scan_worker(args):
+	"""
+	Runs one chunk of a scan in a worker process.
+	Model, Kms and reference solution arrive once per chunk, the workers' own FVA runs serially.
+	:param args: Tuple of the reference cache entries and the arguments of _scan_chunk.
+	:return: List of results, one per ratio.
+	"""
+	references, scan_args = args
+	cobra.Configuration().processes = 1
+	_reference_cache.update(references)
+	return _scan_chunk(*scan_args)
+
+
+def _run_scan(model, km_index, c_old_dict, fva, obj_frac, evaluate, ratios, n_jobs=1, executor=None, persistent=False, backend=None):
+	"""
+	Evaluates models over a range of NAD concentrations, optionally spread over several processes.
+	Ratios are split into contiguous chunks, one per worker, and results are returned in the order of the ratios.
+	:param model: Model object to be used.
+	:param km_index: KmIndex resolving reactions to Kms.
+	:param c_old_dict: Original concentrations. Dict with compartments as keys and concentrations as values.
+	:param fva: Boolean. Use FVA based integration.
+	:param obj_frac: Fraction of optimal objective flux retained by the FVA based integration.
+	:param evaluate: Picklable function taking the model of one ratio and returning the result for that point.
+	:param ratios: Fractions of the original concentrations.
+	:param n_jobs: Number of worker processes. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor (e.g. concurrent.futures.ProcessPoolExecutor) to run the chunks on.
+	:param persistent: Evaluate the ratios of each chunk on one warm-started PersistentLP, see _scan_chunk.
+	:param backend: Solver of the reference solution, see _reference_solution.
+	:return: List of results, one per ratio.
+	"""
+	ratios = list(ratios)
+	n_jobs = _n_jobs(n_jobs, executor)
+	if n_jobs == 1 and executor is None:
+		return _scan_chunk(model, km_index, c_old_dict, fva, obj_frac, evaluate, ratios, persistent, backend)
 	
-	return model_new
+	# solve the reference once and hand it to the workers instead of solving it in each of them
+	if fva:
+		reference = ('fva', obj_frac, AdjustmentPlan(model, km_index).reaction_ids)
+	else:
+		reference = ('pfba',)
+	references = {_reference_key(model, *reference, backend=backend): _reference_solution(model, *reference, backend=backend)}
+	
+	splits = np.array_split(np.arange(len(ratios)), min(n_jobs, len(ratios)))
+	chunks = [(references, (model, km_index, c_old_dict, fva, obj_frac, evaluate, ratios[i[0]:i[-1] + 1], persistent, backend)) for i in splits]
+	own_executor = executor is None
+	if own_executor:
+		executor = ProcessPoolExecutor(max_workers=len(chunks))
+	try:
+		return [result for chunk in executor.map(_scan_worker, chunks) for result in chunk]
+	finally:
+		if own_executor:
+			executor.shutdown()
+
+
+def _pfba(model, fraction_of_optimum=1.0, sensitivity=None):
+	"""
+	pFBA that also returns the solution of its first stage.
+	Same as cobra.flux_analysis.pfba, but the optimum it constrains the total flux minimization with comes from a full
+	FBA solution, so reduced costs and shadow prices need no separate solve.
+	:param model: Model object to be used, or a PersistentLP.
+	:param fraction_of_optimum: Fraction of the optimum that must be maintained.
+	:param sensitivity: Reaction indices to also return the bound sensitivities of both stages for, see _sensitivity.
+	:return: Tuple of the FBA and the pFBA solution, and the sensitivities if requested.
+	"""
+	if isinstance(model, PersistentLP):
+		sol = model.optimize()
+		sensitivities = _sensitivity(model, sensitivity, 'objective')
+		sol_p = model.minimize_total_flux(sol.objective_value * fraction_of_optimum)
+		sensitivities.update(_sensitivity(model, sensitivity, 'total_flux'))
+		return (sol, sol_p) if sensitivity is None else (sol, sol_p, sensitivities)
+	sol = model.optimize(raise_error=True)
+	sensitivities = _sensitivity(model, sensitivity, 'objective')
+	with model:
+		fix_objective_as_constraint(model, bound=sol.objective_value * fraction_of_optimum)
+		fixed = model.constraints[f'fixed_objective_{model.objective.name}']
+		variables = chain(*((rxn.forward_variable, rxn.reverse_variable) for rxn in model.reactions))
+		model.objective = model.problem.Objective(Zero, direction='min', sloppy=True, name='_pfba_objective')
+		model.objective.set_linear_coefficients({v: 1.0 for v in variables})
+		model.slim_optimize(error_value=None)
+		sol_p = get_solution(model)
+		sensitivities.update(_sensitivity(model, sensitivity, 'total_flux', fixed))
+	return (sol, sol_p) if sensitivity is None else (sol, sol_p, sensitivities)
+
+
+def _sensitivity(model, indices, key, fixed=None):
+	"""
+	Bound sensitivities of the last solution: derivatives of its objective value with respect to factors scaling all
+	bounds of some reactions, see lp.bound_sensitivity. Along a scan all rescaled bounds of a reaction move with its
+	Michaelis-Menten factor, so these give the slope of the (p)FBA objective in the factors while the basis stays the same.
+	:param model: Model object or PersistentLP that was just optimized.
+	:param indices: Reaction indices. None returns nothing.
+	:param key: Name of the stage, 'objective' (FBA) or 'total_flux' (pFBA).
+	:param fixed: Constraint keeping the FBA objective at its optimum in the pFBA stage of a model object.
+	:return: Dictionary of key to the array of sensitivities and, for the pFBA stage, 'objective_dual' to the dual value
+		of keeping the FBA objective.
+	"""
+	if indices is None:
+		return {}
+	if isinstance(model, PersistentLP):
+		result = {key: model.bound_sensitivity(indices)}
+		if key == 'total_flux':
+			result['objective_dual'] = model._objective_dual()
+		return result
+	result = {key: bound_sensitivity(model, indices)}
+	if key == 'total_flux':
+		result['objective_dual'] = fixed.dual
+	return result
+
+
+def _evaluate_point(model_new, outputs, fva_frac, fva_reactions, sensitivity=None):
+	"""
+	Collects the requested outputs from the model of one scan point.
+	:param model_new: Model with adapted boundaries, or a PersistentLP holding them.
+	:param outputs: Collection of ConcentrationScan.OUTPUTS.
+	:param fva_frac: Fractional optimality tolerated for the flux ranges.
+	:param fva_reactions: Reactions to compute flux ranges for. None for all.
+	:param sensitivity: Reaction indices to also return the 'sensitivity' of the (p)FBA objective values to, see
+		_sensitivity.
+	:return: Dictionary of outputs.
+	"""
+	persistent = isinstance(model_new, PersistentLP)
+	if persistent and model_new.highs is not None:
+		return _evaluate_arrays(model_new, outputs, fva_frac, fva_reactions, sensitivity)
+	result = {}
+	if {'fluxes', 'total_flux'} & set(outputs):
+		sol, sol_p, *sensitivities = _pfba(model_new, sensitivity=sensitivity)
+		result['fluxes'] = sol_p.fluxes
+		result['total_flux'] = sol_p.objective_value
+	elif {'objective', 'reduced_costs', 'shadow_prices'} & set(outputs) or sensitivity is not None:
+		sol = model_new.optimize() if persistent else model_new.optimize(raise_error=True)
+		sensitivities = [_sensitivity(model_new, sensitivity, 'objective')]
+	if sensitivity is not None:
+		result['sensitivity'] = sensitivities[0]
+	if 'objective' in outputs:
+		result['objective'] = sol.objective_value
+	if 'reduced_costs' in outputs:
+		result['reduced_costs'] = sol.reduced_costs
+	if 'shadow_prices' in outputs:
+		result['shadow_prices'] = sol.shadow_prices
+	if 'ranges' in outputs:
+		if persistent:
+			sol_fva = model_new.fva(fva_reactions, fraction_of_optimum=fva_frac)
+		else:
+			sol_fva = cobra.flux_analysis.flux_variability_analysis(model_new, fva_reactions, fraction_of_optimum=fva_frac)
+		result['minimum'] = sol_fva['minimum']
+		result['maximum'] = sol_fva['maximum']
+	return {key: value for key, value in result.items() if key in outputs or key in ('minimum', 'maximum', 'sensitivity')}
+
+
+def _evaluate_arrays(lp, outputs, fva_frac, fva_reactions, sensitivity=None):
+	"""
+	Same as _evaluate_point on a PersistentLP over HiGHS, but keeps every output a plain array. Labels are added once
+	for the whole scan, see ConcentrationScan._collect.
+	:param lp: PersistentLP holding a HighsLP.
+	:param outputs: Collection of ConcentrationScan.OUTPUTS.
+	:param fva_frac: Fractional optimality tolerated for the flux ranges.
+	:param fva_reactions: Reactions to compute flux ranges for. None for all.
+	:param sensitivity: Reaction indices to also return the 'sensitivity' of the (p)FBA objective values to, see
+		_sensitivity.
+	:return: Dictionary of outputs.
+	"""
+	highs = lp.highs
+	result = {}
+	if {'fluxes', 'total_flux', 'objective', 'reduced_costs', 'shadow_prices'} & set(outputs) or sensitivity is not None:
+		objective, fluxes, reduced_costs, shadow_prices = highs.fba()
+		result['objective'] = objective
+		result['reduced_costs'] = reduced_costs
+		result['shadow_prices'] = shadow_prices
+		sensitivities = _sensitivity(lp, sensitivity, 'objective')
+		if {'fluxes', 'total_flux'} & set(outputs):
+			highs._keep_objective(objective)
+			highs.set_total_flux_objective()
+			result['total_flux'], fluxes = highs.solve()[:2]
+			sensitivities.update(_sensitivity(lp, sensitivity, 'total_flux'))
+		result['fluxes'] = fluxes
+		if sensitivity is not None:
+			result['sensitivity'] = sensitivities
+	if 'ranges' in outputs:
+		indices = None if fva_reactions is None else [lp._index[r] for r in fva_reactions]
+		ranges = highs.fva(indices, fva_frac)
+		result['minimum'] = ranges[:, 0]
+		result['maximum'] = ranges[:, 1]
+	return {key: value for key, value in result.items() if key in outputs or key in ('minimum', 'maximum', 'sensitivity')}
+
+
+def _piece(point, factors, keys, indices=None):
+	"""
+	Linear model of the (p)FBA objective values around one scan point, in the Michaelis-Menten factors of the rescaled
+	reactions. Exact on the piece of the scan sharing the point's optimal basis, and an upper bound (lower bound, if
+	minimized) elsewhere, as the optimal value is concave in the bounds.
+	:param point: Result of _evaluate_point with 'objective', 'sensitivity' and, for pFBA, 'total_flux'.
+	:param factors: Array of the point's factors, see AdjustmentPlan.factors.
+	:param keys: Scalar outputs to model, 'objective' and optionally 'total_flux'.
+	:param indices: Positions of the factors' reactions in the sensitivities, if these cover further reactions.
+	:return: Dictionary of key to tuple of the value and the array of slopes in the factors.
+	"""
+	sensitivity = point['sensitivity']
+	select = slice(None) if indices is None else indices
+	slope = sensitivity['objective'][select] / factors
+	piece = {'objective': (point['objective'], slope)}
+	if 'total_flux' in keys:
+		# the pFBA stage keeps the objective at its optimum, so it also moves with the objective's slope
+		piece['total_flux'] = (point['total_flux'], sensitivity['total_flux'][select] / factors + sensitivity['objective_dual'] * slope)
+	return piece
+
+
+def _predict(piece, origin, factors, key):
+	"""
+	:param piece: Model returned by _piece.
+	:param origin: Factors of the point the piece was built at.
+	:param factors: Factors to predict at, one array or a matrix with one row per ratio.
+	:param key: Scalar output.
+	:return: Predicted value or array of values.
+	"""
+	value, slope = piece[key]
+	return value + (np.asarray(factors) - origin) @ slope
+
+
+def _on_piece(pieces, factors, points, owner, ratio, eps):
+	"""
+	:param pieces: Dictionary of evaluated ratios to their pieces, see _piece.
+	:param factors: Dictionary of evaluated ratios to their factors.
+	:param points: Dictionary of evaluated ratios to their outputs.
+	:param owner: Ratio of the piece.
+	:param ratio: Ratio to check.
+	:param eps: Dictionary of scalar outputs to their tolerated deviation.
+	:return: Whether the piece predicts all scalar outputs at the ratio.
+	"""
+	return all(abs(_predict(pieces[owner], factors[owner], factors[ratio], key) - points[ratio][key]) <= e for key, e in eps.items())
+
+
+def _intersection(pieces, factors, points, factor, a, b, eps):
+	"""
+	Ratio where the pieces of two points intersect, which is the breakpoint between them unless other pieces lie in
+	between. Uses the scalar output the pieces disagree on most.
+	:param pieces: Dictionary of evaluated ratios to their pieces, see _piece.
+	:param factors: Dictionary of evaluated ratios to their factors.
+	:param points: Dictionary of evaluated ratios to their outputs.
+	:param factor: Function returning the factors of a ratio.
+	:param a: Lower ratio.
+	:param b: Upper ratio.
+	:param eps: Dictionary of scalar outputs to their tolerated deviation.
+	:return: Ratio strictly between a and b, the midpoint if the pieces do not cross there.
+	"""
+	key = max(eps, key=lambda k: (
+		abs(_predict(pieces[a], factors[a], factors[b], k) - points[b][k]) +
+		abs(_predict(pieces[b], factors[b], factors[a], k) - points[a][k])) / eps[k])
+	difference = lambda r: _predict(pieces[a], factors[a], factor(r), key) - _predict(pieces[b], factors[b], factor(r), key)
+	ratio = (a + b) / 2
+	if difference(a) * difference(b) < 0:
+		ratio = brentq(difference, a, b)
+	return ratio if a < ratio < b else (a + b) / 2
+
+
+def _refinement(pieces, factors, points, factor, owner, a, b, allowed, samples=65):
+	"""
+	Ratios to evaluate so that linear interpolation of the scalar outputs between two points on one piece stays within
+	the tolerated errors. Errors and curvature are predicted by the piece, so this costs no solves. Interpolating over
+	a width h with curvature k is off by about h ** 2 * k / 8, so the ratios are spread evenly in the integral of
+	sqrt(k / 8 / allowed).
+	:param pieces: Dictionary of evaluated ratios to their pieces, see _piece.
+	:param factors: Dictionary of evaluated ratios to their factors.
+	:param points: Dictionary of evaluated ratios to their outputs.
+	:param factor: Function returning the factors of a ratio.
+	:param owner: Ratio whose piece covers the interval.
+	:param a: Lower ratio.
+	:param b: Upper ratio.
+	:param allowed: Dictionary of scalar outputs to their tolerated error.
+	:param samples: Number of ratios to check, including a and b.
+	:return: List of ratios between a and b, empty if interpolating between them is accurate enough.
+	"""
+	ratios = np.linspace(a, b, samples)
+	step = ratios[1] - ratios[0]
+	grid = np.array([factor(r) for r in ratios])
+	error = 0.
+	curvature = np.zeros(samples - 2)
+	for key, limit in allowed.items():
+		predicted = _predict(pieces[owner], factors[owner], grid, key)
+		line = points[a][key] + (ratios - a) / (b - a) * (points[b][key] - points[a][key])
+		error = max(error, np.abs(predicted - line).max() / limit)
+		curvature = np.maximum(curvature, np.abs(np.diff(predicted, 2)) / step ** 2 / limit)
+	if error <= 1:
+		return []
+	density = np.sqrt(np.concatenate([curvature[:1], curvature, curvature[-1:]]) / 8)
+	cumulative = np.concatenate([[0], np.cumsum((density[1:] + density[:-1]) / 2 * step)])
+	n = max(2, int(np.ceil(cumulative[-1])))
+	return list(np.interp(cumulative[-1] * np.arange(1, n) / n, cumulative, ratios))
+
+
+class _AdaptiveGrid:
+	"""
+	Evaluated ratios of an adaptive scan and the intervals between them, see ConcentrationScan.run_adaptive. Each round
+	adds the outputs of the ratios asked for by refine and returns the ratios of the next round.
+	An interval whose ends lie on one piece gets an owner, the end whose piece covers it, and is only split further to
+	keep linear interpolation accurate. Other intervals are split at the intersection of their ends' pieces, which is
+	the breakpoint if it lies on both pieces.
+	"""
+
+	def __init__(self, factor, keys, tol=1e-3, rtol=1e-4, indices=None):
+		"""
+		:param factor: Function returning the Michaelis-Menten factors of a ratio, see AdjustmentPlan.factors.
+		:param keys: Scalar outputs the pieces model, 'objective' and optionally 'total_flux'.
+		:param tol: Tolerated absolute interpolation error. With tol and rtol None, only breakpoints are located.
+		:param rtol: Tolerated interpolation error relative to the largest absolute value, added to tol.
+		:param indices: Positions of the factors' reactions in the sensitivities, see _piece.
+		"""
+		self.factor = factor
+		self.keys = keys
+		self.indices = indices
+		self.tol = tol
+		self.rtol = rtol
+		self.points = {}
+		self.factors = {}
+		self.pieces = {}
+		self.located = []
+		self.eps = {}
+		self.allowed = {}
+		self._owners = {} # intervals on one piece to a ratio whose piece it is
+		self._candidates = {} # intersections of the pieces of an interval's ends to the interval
+		self._splits = [] # intervals on one piece being refined, with their owner and new ratios
+		self._done = set()
+
+	def add(self, ratios, results):
+		"""
+		Adds evaluated ratios and checks the intersections and splits they were asked for.
+		:param ratios: Ratios asked for by the last refine, or the initial grid.
+		:param results: Their outputs, see _evaluate_point, with 'sensitivity'.
+		"""
+		for ratio, result in zip(ratios, results):
+			self.points[ratio] = result
+			self.factors[ratio] = self.factor(ratio)
+			self.pieces[ratio] = _piece(result, self.factors[ratio], self.keys, self.indices)
+		scale = {k: max(abs(p[k]) for p in self.points.values()) for k in self.keys}
+		self.eps = {k: TOLERANCE * max(1, scale[k]) for k in self.keys}
+		self.allowed = {k: max((self.tol or 0) + (self.rtol or 0) * scale[k], self.eps[k]) for k in self.keys}
+		for m in ratios:
+			if m in self._candidates:
+				a, b = self._candidates.pop(m)
+				if self._on_piece(a, m) and self._on_piece(b, m):
+					self.located.append(m)
+					self._owners[(a, m)] = a
+					self._owners[(m, b)] = b
+		for a, b, owner, ms in self._splits:
+			if all(self._on_piece(owner, m) for m in ms):
+				ends = [a] + ms + [b]
+				self._owners.update({(c, d): owner for c, d in zip(ends, ends[1:])})
+		self._splits = []
+
+	def refine(self):
+		"""
+		:return: List of the ratios to evaluate next, empty once all breakpoints are located and all intervals on one
+			piece interpolate accurately enough.
+		"""
+		ratios = sorted(self.points)
+		new = []
+		for a, b in zip(ratios, ratios[1:]):
+			if (a, b) in self._done:
+				continue
+			owner = self._owners.get((a, b))
+			# a point at a breakpoint may return either piece, one end predicting the other suffices
+			for end, other in ((a, b), (b, a)):
+				if owner is None and self._on_piece(end, other):
+					owner = self._owners[(a, b)] = end
+			if owner is None and b - a <= MIN_INTERVAL:
+				self.located.append(_intersection(self.pieces, self.factors, self.points, self.factor, a, b, self.eps))
+				self._done.add((a, b))
+			elif owner is None:
+				new.append(_intersection(self.pieces, self.factors, self.points, self.factor, a, b, self.eps))
+				self._candidates[new[-1]] = (a, b)
+			else:
+				refine = self.tol is not None or self.rtol is not None
+				ms = _refinement(self.pieces, self.factors, self.points, self.factor, owner, a, b, self.allowed) if refine else []
+				if not ms or b - a <= MIN_INTERVAL:
+					self._done.add((a, b))
+					continue
+				new.extend(ms)
+				self._splits.append((a, b, owner, ms))
+		return new
+
+	def _on_piece(self, owner, ratio):
+		return _on_piece(self.pieces, self.factors, self.points, owner, ratio, self.eps)
+
+
+def _breakpoints(plan, grid, reaction_ids):
+	"""
+	Attributes the located breakpoints of an adaptive scan to the bounds that start or stop limiting the solution there.
+	Limiting bounds have nonzero sensitivities. Reactions sharing a factor, like consecutive steps of a pathway, can
+	limit the solution through either one's bounds, so rescaled reactions are compared as a group. Bounds of zero have
+	no sensitivity, they limit the objective where their reaction has a nonzero reduced cost.
+	:param plan: AdjustmentPlan of the scan.
+	:param grid: _AdaptiveGrid after the last round, its points with 'reduced_costs' and the 'sensitivity' of all
+		reactions.
+	:param reaction_ids: IDs of all reactions of the model.
+	:return: Dataframe with columns 'ratio', 'lower', 'upper', 'reactions' and 'other', see ConcentrationScan.run_adaptive.
+	"""
+	ratios = sorted(grid.points)
+	adjusted = np.array(plan.reaction_ids)
+	reaction_ids = np.array(reaction_ids)
+	groups = np.unique(np.column_stack([plan.kms.astype(str), plan.compartments.astype(str)]), axis=0, return_inverse=True)[1].ravel()
+
+	def limiting(ratio):
+		point = grid.points[ratio]
+		sensitivities = [point['sensitivity'][k][grid.indices] for k in grid.keys]
+		sums = [np.bincount(groups, v, minlength=len(adjusted)) for v in sensitivities]
+		rescaled = np.array([np.abs(v) > grid.eps[k] for v, k in zip(sums + sensitivities, grid.keys * 2)])
+		bounds = [np.abs(point['sensitivity'][k]) > grid.eps[k] for k in grid.keys]
+		bounds.append(np.abs(np.asarray(point['reduced_costs'], dtype=float)) > TOLERANCE)
+		return rescaled, np.array(bounds)
+
+	breakpoints = []
+	for ratio in sorted(grid.located):
+		a = max(r for r in ratios if r < ratio)
+		b = min(r for r in ratios if r > ratio)
+		(rescaled_a, bounds_a), (rescaled_b, bounds_b) = limiting(a), limiting(b)
+		changed = rescaled_a != rescaled_b
+		n = len(grid.keys)
+		# a group is listed if it starts or stops limiting, or if its limiting bounds move from one member to another
+		moved = np.bincount(groups, changed[n:].any(axis=0), minlength=len(adjusted)) > 0
+		reactions = list(adjusted[(changed[:n].any(axis=0) | moved)[groups]])
+		other = [r for r in reaction_ids[(bounds_a != bounds_b).any(axis=0)] if r not in reactions]
+		breakpoints.append((ratio, a, b, reactions, other))
+	return pd.DataFrame(breakpoints, columns=['ratio', 'lower', 'upper', 'reactions', 'other'])
+
 
-def scan_reaction(model, rxn_id, mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None):
+class ConcentrationScan:
+	"""
+	Evaluates a model over a grid of NAD concentrations.
+	Each point's model is built once and every requested output is collected from it in the same pass.
+	"""
+
+	OUTPUTS = ('fluxes', 'total_flux', 'objective', 'reduced_costs', 'shadow_prices', 'ranges')
+	DEFAULT_RATIOS = tuple(i / 100 for i in range(1, 99))
+
+	def __init__(self, model, mappings, kms, c_old_dict, ratios=None, fva=False, obj_frac=.9, id_type='ec', decision='min', preference=None, backend=None):
+		"""
+		:param model: Model object to be used.
+		:param mappings: Mappings of reactions to identifiers.
+		:param kms: Dataframe containing Brenda or SabioRK data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
+		:param c_old_dict: Original concentrations. Dict with compartments as keys and concentrations as values.
+		:param ratios: Fractions of the original concentrations to evaluate. Defaults to 0.01 to 0.98 in steps of 0.01.
+		:param fva: Boolean. Use FVA based integration. Defaults to False.
+		:param obj_frac: Fraction of optimal objective flux retained by the FVA based integration. Defaults to 0.9 .
+		:param id_type: Type of identifier 'ec' or 'up'. Defaults to 'ec'.
+		:param decision: How to choose between multiple KMs. Defaults to 'min' (using the minimal Km found).
+		:param preference: Order of preference of species. List of scientific species names.
+		:param backend: Solver of the reference pFBA or FVA: None uses cobra, 'highs' a HighsLP. Defaults to None.
+		"""
+		self.model = model
+		self.km_index = _km_index(mappings, kms, id_type, decision, preference)
+		self.c_old_dict = c_old_dict
+		self.ratios = list(self.DEFAULT_RATIOS if ratios is None else ratios)
+		self.fva = fva
+		self.obj_frac = obj_frac
+		self.backend = backend
+
+	def run(self, outputs=('fluxes', 'objective'), fva_frac=.99, fva_reactions=None, n_jobs=1, executor=None, persistent=False):
+		"""
+		Runs the scan.
+		pFBA based scans give the same outputs as building a copy of the model per point. FVA based scans and persistent
+		mode only guarantee the same objective values and total fluxes, degenerate outputs can be other alternative optima.
+		:param outputs: Any of 'fluxes' (pFBA), 'total_flux' (pFBA objective), 'objective' (FBA), 'reduced_costs',
+			'shadow_prices' and 'ranges' (FVA).
+		:param fva_frac: Fractional optimality tolerated for the flux ranges. Defaults to 0.99 .
+		:param fva_reactions: Reaction IDs to compute flux ranges for. Defaults to all reactions.
+		:param n_jobs: Number of worker processes to spread the concentrations over. 1 runs serially, -1 uses all cores.
+		:param executor: Optional process based executor to run on instead of a new process pool.
+		:param persistent: Evaluate consecutive concentrations on one warm-started LP instead of solving each from scratch.
+			True uses the model's solver, 'highs' a direct HiGHS LP, other names switch the solver. Faster, but degenerate
+			outputs (fluxes, reduced costs, shadow prices) can be different alternative optima than in the default mode.
+		:return: Dictionary of outputs indexed by ratio. Series for 'total_flux' and 'objective', dataframes of points x
+			reactions (or metabolites) otherwise. 'ranges' is returned as 'minimum' and 'maximum'.
+		"""
+		self._check_outputs(outputs)
+		disk_cache = get_cache()
+		if disk_cache is not None:
+			key = content_hash('scan', self.model, self.km_index, self.c_old_dict, self.ratios, self.fva, self.obj_frac,
+				tuple(outputs), fva_frac, fva_reactions, persistent, self.backend)
+			results = disk_cache.get(key)
+			if results is not None:
+				return results
+		evaluate = partial(_evaluate_point, outputs=tuple(outputs), fva_frac=fva_frac, fva_reactions=fva_reactions)
+		points = _run_scan(self.model, self.km_index, self.c_old_dict, self.fva, self.obj_frac, evaluate, self.ratios, n_jobs, executor, persistent, self.backend)
+		results = self._collect(points, self.ratios, fva_reactions)
+		if disk_cache is not None:
+			disk_cache.put(key, results)
+		return results
+
+	def run_adaptive(self, outputs=('fluxes', 'objective'), lower=None, upper=None, n_initial=11, tol=1e-3, rtol=1e-4, max_points=1000, fva_frac=.99, fva_reactions=None, n_jobs=1, executor=None, persistent=False):
+		"""
+		Runs the scan on a coarse grid and only refines it where needed, locating its breakpoints exactly.
+		All rescaled bounds of a reaction move with its Michaelis-Menten factor, so the optimal objective and the minimal
+		total flux of pFBA are linear in the factors as long as the optimal basis stays the same. The reduced costs at
+		each point give this piece, see _piece. Unlike the fluxes, the values it describes are the same for all
+		alternative optima, so warm-started and cold-started scans find the same breakpoints. Where the pieces of two
+		neighbouring points disagree, the ratio at which they intersect is evaluated: if it lies on both pieces it is the
+		breakpoint, where a rescaled bound starts or stops limiting the solution, otherwise another piece lies in
+		between. Intervals on one piece are only refined while linear interpolation between their ends, as predicted by
+		the piece, is off by more than tol + rtol times the largest magnitude of the objective (and total flux). All
+		points of one round are evaluated together, on n_jobs processes or one persistent LP.
+		:param outputs: Same as in run.
+		:param lower: Smallest ratio. Defaults to the smallest of the scan's ratios.
+		:param upper: Largest ratio. Defaults to the largest of the scan's ratios.
+		:param n_initial: Number of evenly spaced ratios of the initial grid. Defaults to 11.
+		:param tol: Tolerated absolute error of linearly interpolating the objective and total flux between the evaluated
+			ratios. Defaults to 0.001 .
+		:param rtol: Tolerated interpolation error relative to their largest absolute value, added to tol. With tol and
+			rtol None, only the breakpoints are located. Defaults to 0.0001 .
+		:param max_points: Maximum number of evaluated ratios. Defaults to 1000.
+		:param fva_frac: Same as in run.
+		:param fva_reactions: Same as in run.
+		:param n_jobs: Same as in run.
+		:param executor: Same as in run.
+		:param persistent: Same as in run.
+		:return: Dictionary of outputs as returned by run, indexed by the evaluated ratios in ascending order. Key
+			'breakpoints' holds a dataframe of the breakpoints' 'ratio', the evaluated ratios around them ('lower' and
+			'upper') and the 'reactions' whose rescaled bounds start or stop limiting the objective or the total flux
+			there. Reactions with the same Km and compartment share a factor and are listed together, as the optimum
+			does not tell which of their bounds limits it. Breakpoints can also stem from bounds that are not rescaled,
+			e.g. a reaction's fixed uptake or its irreversibility: 'other' lists the further reactions whose bounds
+			start or stop limiting the objective or the total flux. Both lists are only empty where the pFBA stage
+			alone changes its basis through bounds of zero, which bends the total flux but not the objective. Until
+			max_points is reached, interpolate gives the objective and the total flux at any ratio within the tolerated
+			error tol + rtol * scale, scale being their largest absolute value in the scan.
+		"""
+		self._check_outputs(outputs)
+		lower = min(self.ratios) if lower is None else lower
+		upper = max(self.ratios) if upper is None else upper
+		plan = AdjustmentPlan(self.model, self.km_index)
+		keys = ['objective'] + (['total_flux'] if {'fluxes', 'total_flux'} & set(outputs) else [])
+		evaluated = tuple(outputs) + tuple(k for k in keys + ['reduced_costs'] if k not in outputs)
+		# sensitivities of all bounds, those of other reactions tell which of their bounds start or stop limiting
+		evaluate = partial(_evaluate_point, outputs=evaluated, fva_frac=fva_frac, fva_reactions=fva_reactions, sensitivity=tuple(range(len(self.model.reactions))))
+
+		def factor(ratio):
+			return plan.factors(self.c_old_dict, {c: v * ratio for c, v in self.c_old_dict.items()})
+
+		grid = _AdaptiveGrid(factor, keys, tol, rtol, np.array(plan.indices, dtype=int))
+		new = list(np.linspace(lower, upper, n_initial))
+		while new and len(grid.points) < max_points:
+			new = new[:max_points - len(grid.points)]
+			grid.add(new, _run_scan(self.model, self.km_index, self.c_old_dict, self.fva, self.obj_frac, evaluate, new, n_jobs, executor, persistent, self.backend))
+			new = grid.refine()
+
+		ratios = sorted(grid.points)
+		breakpoints = _breakpoints(plan, grid, [r.id for r in self.model.reactions])
+		points = [grid.points[r] for r in ratios]
+		for point in points:
+			del point['sensitivity']
+		results = self._collect(points, ratios, fva_reactions)
+		results = {k: v for k, v in results.items() if k in outputs or k in ('minimum', 'maximum')}
+		results['breakpoints'] = breakpoints
+		return results
+
+	@staticmethod
+	def interpolate(results, ratios):
+		"""
+		Linearly interpolates scan results, e.g. of run_adaptive, at other ratios.
+		:param results: Dictionary of outputs as returned by run or run_adaptive.
+		:param ratios: Ratios to interpolate at, within the range of the scanned ones.
+		:return: Dictionary of outputs indexed by ratios. 'breakpoints' is passed on unchanged.
+		"""
+		ratios = np.asarray(ratios, dtype=float)
+		index = pd.Index(ratios, name='ratio')
+		interpolated = {}
+		for key, values in results.items():
+			if key == 'breakpoints':
+				interpolated[key] = values
+				continue
+			x = values.index.to_numpy(dtype=float)
+			if isinstance(values, pd.DataFrame):
+				data = np.column_stack([np.interp(ratios, x, values[c].to_numpy(dtype=float)) for c in values.columns])
+				interpolated[key] = pd.DataFrame(data, index=index, columns=values.columns)
+			else:
+				interpolated[key] = pd.Series(np.interp(ratios, x, values.to_numpy(dtype=float)), index=index, name=key)
+		return interpolated
+
+	def _check_outputs(self, outputs):
+		"""
+		:param outputs: Requested outputs.
+		"""
+		unknown = set(outputs) - set(self.OUTPUTS)
+		if unknown:
+			raise ValueError(f'Unknown outputs {sorted(unknown)}. Use any of {self.OUTPUTS}.')
+
+	def _collect(self, points, ratios, fva_reactions=None):
+		"""
+		Stacks the results of all points.
+		:param points: List of dictionaries returned by _evaluate_point.
+		:param ratios: Ratios of the points.
+		:param fva_reactions: Reactions the flux ranges were computed for. None for all.
+		:return: Dictionary of Series and dataframes indexed by ratio.
+		"""
+		index = pd.Index(ratios, name='ratio')
+		reaction_ids = pd.Index([r.id for r in self.model.reactions])
+		# columns of outputs that arrive as plain arrays, see _evaluate_arrays
+		columns = {
+			'fluxes': reaction_ids,
+			'reduced_costs': reaction_ids,
+			'shadow_prices': pd.Index([m.id for m in self.model.metabolites]),
+			'minimum': reaction_ids if fva_reactions is None else pd.Index(fva_reactions),
+			'maximum': reaction_ids if fva_reactions is None else pd.Index(fva_reactions),
+		}
+		results = {}
+		for key in (points[0] if points else {}):
+			values = [point[key] for point in points]
+			if isinstance(values[0], pd.Series):
+				results[key] = pd.DataFrame(np.vstack([v.to_numpy() for v in values]), index=index, columns=values[0].index)
+			elif isinstance(values[0], np.ndarray):
+				results[key] = pd.DataFrame(np.vstack(values), index=index, columns=columns[key])
+			else:
+				results[key] = pd.Series(values, index=index, name=key)
+		return results
+
+
+def scan_reaction(model, rxn_id, mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None, n_jobs=1, executor=None, persistent=False, backend=None):
 	"""
 	Checks reaction activity and reduced cost over a wide range of NAD concentrations
 	:param model: Model object to be used.
 	:param rxn_id: ID of reaction to be tracked.
 	:param mappings: Mappings of reactions to identifiers.
-	:param kms: Dataframe containing Brenda or SabioRK data.
+	:param kms: Dataframe containing Brenda or SabioRK data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Orginal concentrations. Dict with compartments as keys and concentrations as values.
 	:param fva: Boolean. Use FVA based integration. Defaults to False.
 	:param id_type: Type of identifier 'ec' or 'up'. Defaults to 'ec'.
 	:param decision: How to choose between multiple KMs. Defaults to 'min' (using the minimal Km found).
 	:param preference: Order of preference of species. List of scientific species names.
+	:param n_jobs: Number of worker processes to spread the concentrations over. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param persistent: Evaluate consecutive concentrations on one warm-started LP. True uses the model's solver, 'highs' a direct HiGHS LP.
+	:param backend: Solver of the reference pFBA or FVA. None uses cobra, 'highs' a HighsLP.
 	:return: List of reaction fluxes.
 	"""
-	fluxes = []
-	reduced_costs = []
-	for i in range(1, 99):
-		ratio = i / 100
-		c_new_dict = {}
-		for comp in c_old_dict:
-			c_new_dict[comp] = c_old_dict[comp] * ratio
-		
-		if fva:
-			model_new = create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		else:
-			model_new = create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		sol_p = cobra.flux_analysis.parsimonious.pfba(model_new)
-		sol = model_new.optimize()
-		fluxes.append(sol_p.fluxes[rxn_id])
-		reduced_costs.append(sol.reduced_costs[rxn_id])
+	scan = ConcentrationScan(model, mappings, kms, c_old_dict, fva=fva, id_type=id_type, decision=decision, preference=preference, backend=backend)
+	results = scan.run(('fluxes', 'reduced_costs'), n_jobs=n_jobs, executor=executor, persistent=persistent)
+	fluxes = list(results['fluxes'][rxn_id])
+	reduced_costs = list(results['reduced_costs'][rxn_id])
 	
 	return fluxes, reduced_costs
 
 
-def scan_all_fluxes(model,  mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None):
+def scan_all_fluxes(model,  mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None, n_jobs=1, executor=None, persistent=False, backend=None):
 	"""
 	Checks reaction activity and reduced cost over a wide range of NAD concentrations
 	:param model: Model object to be used.
 	:param rxn_id: ID of reaction to be tracked.
 	:param mappings: Mappings of reactions to identifiers.
-	:param kms: Dataframe containing Brenda or SabioRK data.
+	:param kms: Dataframe containing Brenda or SabioRK data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Orginal concentrations. Dict with compartments as keys and concentrations as values.
 	:param fva: Boolean. Use FVA based integration. Defaults to False.
 	:param id_type: Type of identifier 'ec' or 'up'. Defaults to 'ec'.
 	:param decision: How to choose between multiple KMs. Defaults to 'min' (using the minimal Km found).
 	:param preference: Order of preference of species. List of scientific species names.
+	:param n_jobs: Number of worker processes to spread the concentrations over. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param persistent: Evaluate consecutive concentrations on one warm-started LP. True uses the model's solver, 'highs' a direct HiGHS LP.
+	:param backend: Solver of the reference pFBA or FVA. None uses cobra, 'highs' a HighsLP.
 	:return: List of reaction fluxes.
 	"""
-	fluxes = []
-	reduced_costs = []
-	dfs = []
-	for i in range(1, 99):
-		ratio = i / 100
-		c_new_dict = {}
-		for comp in c_old_dict:
-			c_new_dict[comp] = c_old_dict[comp] * ratio
-		
-		if fva:
-			model_new = create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		else:
-			model_new = create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		sol_p = cobra.flux_analysis.parsimonious.pfba(model_new)
-		dfs.append(sol_p.fluxes)
-	dfs = pd.concat(dfs, axis=1, sort=True)
-	dfs.columns = list(range(1, 99))
+	scan = ConcentrationScan(model, mappings, kms, c_old_dict, fva=fva, id_type=id_type, decision=decision, preference=preference, backend=backend)
+	dfs = scan.run(('fluxes',), n_jobs=n_jobs, executor=executor, persistent=persistent)['fluxes'].T.sort_index()
+	# columns are the ratios in percent, 1 to 98 for the default ratios
+	percent = [round(ratio * 100, 6) for ratio in scan.ratios]
+	dfs.columns = [int(p) if p.is_integer() else p for p in percent]
 	
 	return dfs
 
 
-def scan_total_flux(model, mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None):
+def scan_total_flux(model, mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None, n_jobs=1, executor=None, persistent=False, backend=None):
 	"""
 	Checks reaction activity for a range of different NAD concentrations.
 	:param model: Model object to be used.
 	:param mappings: Mappings of reactions to identifiers.
-	:param kms: Dataframe containing Brenda or SabioRK data.
+	:param kms: Dataframe containing Brenda or SabioRK data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Orginal concentrations. Dict with compartments as keys and concentrations as values.
 	:param fva: Boolean. Use FVA based integration. Defaults to False.
 	:param id_type: Type of identifier 'ec' or 'up'. Defaults to 'ec'.
 	:param decision: How to choose between multiple KMs. Defaults to 'min' (using the minimal Km found).
 	:param preference: Order of preference of species. List of scientific species names.
+	:param n_jobs: Number of worker processes to spread the concentrations over. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param persistent: Evaluate consecutive concentrations on one warm-started LP. True uses the model's solver, 'highs' a direct HiGHS LP.
+	:param backend: Solver of the reference pFBA or FVA. None uses cobra, 'highs' a HighsLP.
 	:return: List of total flux values.
 	"""
-	fluxes = []
-	for i in range(1, 99):
-		ratio = i / 100
-		c_new_dict = {}
-		for comp in c_old_dict:
-			c_new_dict[comp] = c_old_dict[comp] * ratio
-		
-		if fva:
-			model_new = create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		else:
-			model_new = create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		sol = cobra.flux_analysis.parsimonious.pfba(model_new)
-		fluxes.append(sol.objective_value)
+	scan = ConcentrationScan(model, mappings, kms, c_old_dict, fva=fva, id_type=id_type, decision=decision, preference=preference, backend=backend)
+	fluxes = list(scan.run(('total_flux',), n_jobs=n_jobs, executor=executor, persistent=persistent)['total_flux'])
 	
 	return fluxes
 
 
-def scan_all_reactions(model, mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None):
+def scan_all_reactions(model, mappings, kms, c_old_dict, fva=False, id_type='ec', decision='min', preference=None, n_jobs=1, executor=None, persistent=False, backend=None):
 	"""
 	Checks reaction activity and reduced cost over a wide range of NAD concentrations
 	:param model: Model object to be used.
 	:param mappings: Mappings of reactions to identifiers.
-	:param kms: Dataframe containing Brenda or SabioRK data.
+	:param kms: Dataframe containing Brenda or SabioRK data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Orginal concentrations. Dict with compartments as keys and concentrations as values.
 	:param fva: Boolean. Use FVA based integration. Defaults to False.
 	:param id_type: Type of identifier 'ec' or 'up'. Defaults to 'ec'.
 	:param decision: How to choose between multiple KMs. Defaults to 'min' (using the minimal Km found).
 	:param preference: Order of preference of species. List of scientific species names.
+	:param n_jobs: Number of worker processes to spread the concentrations over. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param persistent: Evaluate consecutive concentrations on one warm-started LP. True uses the model's solver, 'highs' a direct HiGHS LP.
+	:param backend: Solver of the reference pFBA or FVA. None uses cobra, 'highs' a HighsLP.
 	:return: List of reaction fluxes.
 	"""
-	fluxes = {}
-	reduced_costs = {}
-	rxns = [r.id for r in model.reactions]
-	for r in rxns:
-		fluxes[r] = []
-		reduced_costs[r] = []
-	for c in range(1, 99):
-		ratio = c / 100
-		c_new_dict = {}
-		for comp in c_old_dict:
-			c_new_dict[comp] = c_old_dict[comp] * ratio
-		
-		if fva:
-			model_new = create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		else:
-			model_new = create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		
-		sol_p = cobra.flux_analysis.parsimonious.pfba(model_new)
-		sol = model_new.optimize()
-		for r in rxns:
-			fluxes[r].append(sol_p.fluxes[r])
-			reduced_costs[r].append(sol.reduced_costs[r])
-	
-	fluxes = pd.DataFrame(fluxes)
-	#fluxes.index = [r.id for r in model.reactions]
-	reduced_costs = pd.DataFrame(reduced_costs)
-	#reduced_costs.index = [r.id for r in model.reactions]
+	scan = ConcentrationScan(model, mappings, kms, c_old_dict, fva=fva, id_type=id_type, decision=decision, preference=preference, backend=backend)
+	results = scan.run(('fluxes', 'reduced_costs'), n_jobs=n_jobs, executor=executor, persistent=persistent)
+	fluxes = results['fluxes'].reset_index(drop=True)
+	reduced_costs = results['reduced_costs'].reset_index(drop=True)
 	
 	return fluxes, reduced_costs
 
 
-def scan_reaction_variance(model, rxn_id, mappings, kms, c_old_dict, tol=.99, fva=False, id_type='ec', decision='min', preference=None):
+def scan_reaction_variance(model, rxn_id, mappings, kms, c_old_dict, tol=.99, fva=False, id_type='ec', decision='min', preference=None, n_jobs=1, executor=None, persistent=False, backend=None):
 	"""
 	Checks reaction activity and reduced cost over a wide range of NAD concentrations
 	:param model: Model object to be used.
 	:param rxn_id: ID of reaction to be tracked.
 	:param mappings: Mappings of reactions to identifiers.
-	:param kms: Dataframe containing Brenda or SabioRK data.
+	:param kms: Dataframe containing Brenda or SabioRK data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Original concentrations. Dict with compartments as keys and concentrations as values.
 	:param tol: Fractional optimality tolerated  for FVA.
 	:param fva: Boolean. Use FVA based integration. Defaults to False.
 	:param id_type: Type of identifier 'ec' or 'up'. Defaults to 'ec'.
 	:param decision: How to choose between multiple KMs. Defaults to 'min' (using the minimal Km found).
 	:param preference: Order of preference of species. List of scientific species names.
+	:param n_jobs: Number of worker processes to spread the concentrations over. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param persistent: Evaluate consecutive concentrations on one warm-started LP. True uses the model's solver, 'highs' a direct HiGHS LP.
+	:param backend: Solver of the reference pFBA or FVA. None uses cobra, 'highs' a HighsLP.
 	:return: List of reaction fluxes.
 	"""
-	upper = []
-	lower = []
-	for i in range(1, 99):
-		ratio = i / 100
-		c_new_dict = {}
-		for comp in c_old_dict:
-			c_new_dict[comp] = c_old_dict[comp] * ratio
-		
-		if fva:
-			model_new = create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		else:
-			model_new = create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		
-		sol_fva = cobra.flux_analysis.flux_variability_analysis(model_new, [rxn_id], fraction_of_optimum=tol)
-		upper.append(sol_fva.loc[rxn_id,  'maximum'])
-		lower.append(sol_fva.loc[rxn_id, 'minimum'])
+	scan = ConcentrationScan(model, mappings, kms, c_old_dict, fva=fva, id_type=id_type, decision=decision, preference=preference, backend=backend)
+	results = scan.run(('ranges',), fva_frac=tol, fva_reactions=[rxn_id], n_jobs=n_jobs, executor=executor, persistent=persistent)
+	upper = list(results['maximum'][rxn_id])
+	lower = list(results['minimum'][rxn_id])
 	
 	return upper, lower
 
 
-def scan_all_variance(model, mappings, kms, c_old_dict, tol=.99, fva=False, id_type='ec', decision='min', preference=None):
+def scan_all_variance(model, mappings, kms, c_old_dict, tol=.99, fva=False, id_type='ec', decision='min', preference=None, n_jobs=1, executor=None, persistent=False, backend=None):
 	"""
 	Checks reaction activity and reduced cost over a wide range of NAD concentrations
 	:param model: Model object to be used.
 	:param mappings: Mappings of reactions to identifiers.
-	:param kms: Dataframe containing Brenda or SabioRK data.
+	:param kms: Dataframe containing Brenda or SabioRK data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
 	:param c_old_dict: Original concentrations. Dict with compartments as keys and concentrations as values.
 	:param tol: Fractional optimality tolerated  for FVA.
 	:param fva: Boolean. Use FVA based integration. Defaults to False.
 	:param id_type: Type of identifier 'ec' or 'up'. Defaults to 'ec'.
 	:param decision: How to choose between multiple KMs. Defaults to 'min' (using the minimal Km found).
 	:param preference: Order of preference of species. List of scientific species names.
+	:param n_jobs: Number of worker processes to spread the concentrations over. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param persistent: Evaluate consecutive concentrations on one warm-started LP. True uses the model's solver, 'highs' a direct HiGHS LP.
+	:param backend: Solver of the reference pFBA or FVA. None uses cobra, 'highs' a HighsLP.
 	:return: List of reaction fluxes.
 	"""
+	scan = ConcentrationScan(model, mappings, kms, c_old_dict, fva=fva, id_type=id_type, decision=decision, preference=preference, backend=backend)
+	results = scan.run(('ranges',), fva_frac=tol, n_jobs=n_jobs, executor=executor, persistent=persistent)
 	values = {}
-	reactions = [r.id for r in model.reactions]
-	for r in reactions:
-		values[r] = []
-	for i in range(1, 99):
-		ratio = i / 100
-		c_new_dict = {}
-		for comp in c_old_dict:
-			c_new_dict[comp] = c_old_dict[comp] * ratio
-		
-		if fva:
-			model_new = create_models_fva(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		else:
-			model_new = create_models(model, mappings, kms, c_old_dict, c_new_dict, id_type, decision, preference)
-		
-		sol_fva = cobra.flux_analysis.flux_variability_analysis(model_new, fraction_of_optimum=tol)
-		for r in reactions:
-			values[r].append((sol_fva.loc[r, 'maximum'], sol_fva.loc[r, 'minimum']))
+	for r in results['maximum'].columns:
+		values[r] = list(zip(results['maximum'][r], results['minimum'][r]))
 	
-	return pd.DataFrame(values)
+	return pd.DataFrame(values)
\ No newline at end of file
@@ -0,0 +1,220 @@
+import re
+from statistics import median, mean
+
+DEFAULT_PREFERENCE = ['Homo sapiens', 'Sus scrofa', 'Bos taurus', 'Rattus norvegicus', 'Mus musculus']
+
+RE_PERCENTILE = re.compile(r'p(\d+(?:\.\d+)?)')
+
+DECISIONS = {
+	'min': min,
+	'max': max,
+	'avg': mean,
+	'mean': mean,
+	'med': median,
+	'median': median,
+}
+
+
+def percentile(q):
+	"""
+	Decision picking a percentile of the Kms, interpolating linearly between them like numpy.percentile.
+	:param q: Percentile between 0 and 100.
+	:return: Callable taking a list of floats.
+	"""
+	if not 0 <= q <= 100:
+		raise ValueError(f'Percentile {q} is not between 0 and 100.')
+
+	def decision(values):
+		values = sorted(values)
+		position = q / 100 * (len(values) - 1)
+		low = int(position)
+		high = min(low + 1, len(values) - 1)
+		return values[low] + (values[high] - values[low]) * (position - low)
+
+	decision.__name__ = f'p{q:g}'
+	return decision
+
+
+def resolve_decision(decision):
+	"""
+	Turns a decision into a callable picking one Km from a list of Kms.
+	:param decision: Callable taking a list of floats, one of 'min', 'max', 'avg'/'mean', 'med'/'median', or 'pNN' for
+		the NNth percentile (e.g. 'p25' or 'p2.5').
+	:return: Callable.
+	"""
+	if callable(decision):
+		return decision
+	try:
+		return DECISIONS[decision]
+	except KeyError:
+		pass
+	match = RE_PERCENTILE.fullmatch(str(decision))
+	if match:
+		return percentile(float(match.group(1)))
+	raise ValueError(f'Unknown decision {decision!r}. Use a callable, "pNN" or one of {sorted(DECISIONS)}.')
+
+
+def decision_name(decision):
+	"""
+	:param decision: Decision as taken by resolve_decision.
+	:return: Its name, the string itself or the callable's __name__.
+	"""
+	return decision if isinstance(decision, str) else getattr(decision, '__name__', repr(decision))
+
+
+class KmIndex:
+	"""
+	Resolves reactions to Kms in constant time.
+	Filtering the Km table, ranking organisms by preference and applying the decision function happens
+	once on construction, so the index can be shared by all models built from the same data.
+	Reactions whose Kms all stem from organisms not in the preference get no Km, like reactions without any Km, so their
+	bounds are not adjusted. They are listed in unranked along with those organisms.
+	"""
+
+	def __init__(self, kms, mappings, id_type='ec', decision=min, preference=None):
+		"""
+		:param kms: Dataframe containing SabioRK or Brenda data. Organisms as index, Km in column 'value'.
+		:param mappings: Dictionary associating reactions with their UniProt or EC identifiers.
+		:param id_type: Type of ID used. Either 'ec' or 'up'.
+		:param decision: How to choose one of the KMs. Callable or 'min', 'avg' or 'med'. Defaults to min.
+		:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
+		"""
+		if not preference:
+			preference = DEFAULT_PREFERENCE
+		self.id_type = id_type
+		self.decision = resolve_decision(decision)
+		self.preference = [o.lower() for o in preference]
+		self.mappings = mappings
+		self._values = {}
+		self._organisms = {}
+		self._kms = {}
+		self.unranked = {}
+
+		# identifier -> organism -> [(row, Km)], rows keep the order of the original table
+		by_id = {}
+		organisms = [str(o).lower() for o in kms.index]
+		for row, (org, identifier, value) in enumerate(zip(organisms, kms[id_type], kms['value'])):
+			by_id.setdefault(identifier, {}).setdefault(org, []).append((row, value))
+
+		for reaction, ids in mappings.items():
+			found = {}
+			for identifier in dict.fromkeys(ids):
+				for org, values in by_id.get(identifier, {}).items():
+					found.setdefault(org, []).extend(values)
+			for org in self.preference:
+				if org in found:
+					self._organisms[reaction] = org
+					self._values[reaction] = [float(v) for _, v in sorted(found[org])]
+					self._kms[reaction] = self.decision(self._values[reaction])
+					break
+			else:
+				if found:
+					self.unranked[reaction] = sorted(found)
+
+	@classmethod
+	def from_values(cls, values, decision=min, organisms=None, id_type='ec', preference=None):
+		"""
+		Creates an index from already resolved Kms, e.g. to reuse the values of another index with a different decision.
+		:param values: Dictionary of reaction IDs to lists of Kms.
+		:param decision: How to choose one of the KMs. Callable or 'min', 'avg' or 'med'. Defaults to min.
+		:param organisms: Optional dictionary of reaction IDs to the organism the Kms stem from.
+		:param id_type: Type of ID the Kms were mapped by.
+		:param preference: Preference the Kms were picked by.
+		:return: KmIndex.
+		"""
+		index = cls.__new__(cls)
+		index.id_type = id_type
+		index.decision = resolve_decision(decision)
+		index.preference = [o.lower() for o in (preference or DEFAULT_PREFERENCE)]
+		index.mappings = None
+		index._values = {r: list(v) for r, v in values.items() if len(v)}
+		index._organisms = dict(organisms) if organisms else {}
+		index._kms = {r: index.decision(v) for r, v in index._values.items()}
+		index.unranked = {}
+		return index
+
+	def with_decision(self, decision):
+		"""
+		Returns a new index over the same Kms using a different decision function.
+		:param decision: How to choose one of the KMs. Callable or 'min', 'avg' or 'med'.
+		:return: KmIndex.
+		"""
+		index = KmIndex.from_values(self._values, decision, self._organisms, self.id_type, self.preference)
+		index.mappings = self.mappings
+		index.unranked = self.unranked
+		return index
+
+	def with_decisions(self, decisions):
+		"""
+		New indices over the same Kms for several decision functions, all applied in one pass over the reactions.
+		:param decisions: List of decisions, see resolve_decision.
+		:return: Dictionary of decision names (see decision_name) to KmIndex objects.
+		"""
+		names = [decision_name(d) for d in decisions]
+		if len(set(names)) != len(names):
+			raise ValueError(f'Decisions need distinct names, got {names}.')
+		functions = [resolve_decision(d) for d in decisions]
+		kms = [{} for _ in functions]
+		for reaction, values in self._values.items():
+			for function, resolved in zip(functions, kms):
+				resolved[reaction] = function(values)
+		indices = {}
+		for name, function, resolved in zip(names, functions, kms):
+			index = KmIndex.__new__(KmIndex)
+			index.id_type = self.id_type
+			index.decision = function
+			index.preference = self.preference
+			index.mappings = self.mappings
+			index._values = self._values
+			index._organisms = self._organisms
+			index._kms = resolved
+			index.unranked = self.unranked
+			indices[name] = index
+		return indices
+
+	def get(self, reaction, default=None):
+		"""
+		Pulls the Km for a given reaction.
+		:param reaction: Reaction ID.
+		:param default: Returned if no Km is known for the reaction.
+		:return: A Km (float) or default.
+		"""
+		return self._kms.get(reaction, default)
+
+	def values(self, reaction):
+		"""
+		All Kms of the most preferred organism the decision picked from.
+		:param reaction: Reaction ID.
+		:return: List of floats. Empty if no Km is known.
+		"""
+		return list(self._values.get(reaction, []))
+
+	def organism(self, reaction):
+		"""
+		Organism the Km of a reaction stems from.
+		:param reaction: Reaction ID.
+		:return: Lowercase organism name or None.
+		"""
+		return self._organisms.get(reaction)
+
+	@property
+	def reactions(self):
+		return list(self._kms)
+
+	def items(self):
+		return self._kms.items()
+
+	def __getitem__(self, reaction):
+		return self._kms[reaction]
+
+	def __contains__(self, reaction):
+		return reaction in self._kms
+
+	def __iter__(self):
+		return iter(self._kms)
+
+	def __len__(self):
+		return len(self._kms)
+
+	def __repr__(self):
+		return f'<KmIndex with Kms for {len(self)} reactions ({self.id_type})>'
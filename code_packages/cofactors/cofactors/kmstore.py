@@ -0,0 +1,137 @@
+import json
+import os
+import tempfile
+import pandas as pd
+from pathlib import Path
+from cofactors.fetch import Manifest
+from cofactors.mapping import read_sabiork, read_brenda, _visible
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+	pq = None
+
+STORE_FORMAT = 1
+COLUMNS = ['organism', 'source', 'ec', 'up', 'species', 'value', 'unit', 'file']
+CATEGORICAL = ['organism', 'source', 'ec', 'up', 'species', 'unit', 'file']
+
+
+def _require_pyarrow():
+	if pq is None:
+		raise ImportError('The Km store requires pyarrow. Install it with "pip install pyarrow".')
+
+
+def build_km_store(path, sabio_files=(), brenda_files=(), species=None):
+	"""
+	Normalizes SabioRK and Brenda query files into one Parquet file.
+	Kms are converted to mM and only positive values are kept. Note that this drops Brenda's -999 sentinel rows ("no
+	value given"), which the raw tables of read_brenda keep: a KmIndex on the store resolves reactions whose minimal Km
+	was the sentinel to their smallest actual Km instead (e.g. MTHFD and MTHFDm of mitoCore get 0.022 mM instead of
+	-999), which changes the rescaled bounds of these reactions. Filter the raw tables with kms[kms.value > 0.], as the
+	notebooks do, to get the same Kms from both. Every row records the source and query file it stems from; fetch time
+	and hash of the files, as far as recorded in their folders' manifests, go into the file's metadata.
+	Organisms, ECs, UniProt IDs, species, units and files are stored dictionary-encoded.
+	:param path: Path of the Parquet file. Replaced atomically.
+	:param sabio_files: Paths to SabioRK query files.
+	:param brenda_files: Paths to Brenda query files.
+	:param species: List of species to keep from SabioRK, see read_sabiork.
+	:return: Dataframe as written, see read_km_store.
+	"""
+	_require_pyarrow()
+	path = Path(path)
+	frames = []
+	files = {}
+	for source, query_files in (('sabiork', sabio_files), ('brenda', brenda_files)):
+		for qf in _visible(query_files):
+			qf = Path(qf)
+			try:
+				df = read_sabiork([qf], species) if source == 'sabiork' else read_brenda([qf])
+			except pd.errors.EmptyDataError:
+				df = None
+			if df is not None:
+				df = df[df.value > 0.].reset_index().rename(columns={'animal': 'organism'})
+				df['source'] = source
+				df['file'] = qf.name
+				frames.append(df.reindex(columns=COLUMNS))
+			entry = Manifest(qf.parent).entries.get(qf.name, {})
+			files[qf.name] = {
+				'source': source,
+				'rows': 0 if df is None else len(df),
+				'fetched': entry.get('fetched'),
+				'sha256': entry.get('sha256'),
+			}
+	if frames:
+		kms = pd.concat(frames, ignore_index=True)
+	else:
+		kms = pd.DataFrame({c: pd.Series(dtype=float if c == 'value' else object) for c in COLUMNS})
+	kms['value'] = kms['value'].astype(float)
+	for column in CATEGORICAL:
+		kms[column] = kms[column].astype('category')
+
+	table = pa.Table.from_pandas(kms, preserve_index=False)
+	metadata = dict(table.schema.metadata or {})
+	metadata[b'cofactors'] = json.dumps({'format': STORE_FORMAT, 'files': files}).encode()
+	table = table.replace_schema_metadata(metadata)
+	path.parent.mkdir(parents=True, exist_ok=True)
+	fd, tmp = tempfile.mkstemp(suffix='.parquet', dir=path.parent)
+	os.close(fd)
+	try:
+		pq.write_table(table, tmp)
+		os.replace(tmp, path)
+	except BaseException:
+		os.unlink(tmp)
+		raise
+	return kms
+
+
+def read_km_store(path, columns=None, organisms=None, species=None, sources=None, ecs=None):
+	"""
+	Loads Kms from a store written by build_km_store. The file is memory-mapped and only the requested columns and
+	matching row groups are read, dictionary-encoded columns arrive as categoricals.
+	:param path: Path of the Parquet file.
+	:param columns: Columns to load besides 'organism'. Defaults to all.
+	:param organisms: Scientific names of the organisms to keep, case-insensitive. Defaults to all.
+	:param species: Species to keep, e.g. ['NAD+', 'NADH']. Defaults to all.
+	:param sources: Sources to keep, 'sabiork' and/or 'brenda'. Defaults to both.
+	:param ecs: EC numbers to keep. Defaults to all.
+	:return: Dataframe with the lowercase organisms as index named 'animal', like read_sabiork and read_brenda, so it can
+		be passed on to KmIndex and create_models_fva. Only positive Kms are stored, see build_km_store.
+	"""
+	_require_pyarrow()
+	if columns is not None:
+		columns = ['organism'] + [c for c in columns if c != 'organism']
+	filters = []
+	if organisms is not None:
+		filters.append(('organism', 'in', [o.lower() for o in organisms]))
+	if species is not None:
+		filters.append(('species', 'in', list(species)))
+	if sources is not None:
+		filters.append(('source', 'in', list(sources)))
+	if ecs is not None:
+		filters.append(('ec', 'in', list(ecs)))
+	table = pq.read_table(path, columns=columns, filters=filters or None, memory_map=True)
+	kms = table.to_pandas()
+	for column in CATEGORICAL:
+		if column in kms and isinstance(kms[column].dtype, pd.CategoricalDtype):
+			kms[column] = kms[column].cat.remove_unused_categories()
+	kms = kms.set_index('organism')
+	kms.index.name = 'animal'
+	return kms
+
+
+def km_store_provenance(path):
+	"""
+	:param path: Path of the Parquet file.
+	:return: Dataframe of the query files the store was built from, with their 'source', number of 'rows' kept, and
+		'fetched' time and 'sha256' as recorded by the download, indexed by file name.
+	"""
+	_require_pyarrow()
+	metadata = pq.read_schema(path).metadata or {}
+	info = json.loads(metadata.get(b'cofactors', b'{}'))
+	if info.get('format') != STORE_FORMAT:
+		raise ValueError(f'{path} is not a Km store of format {STORE_FORMAT}.')
+	files = pd.DataFrame.from_dict(info['files'], orient='index', columns=['source', 'rows', 'fetched', 'sha256'])
+	files.index.name = 'file'
+	return files
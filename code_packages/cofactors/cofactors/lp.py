@@ -0,0 +1,554 @@
+import numpy as np
+import pandas as pd
+from scipy import sparse
+from cobra import Solution
+from cobra.core import get_solution
+from cobra.exceptions import OptimizationError
+from cobra.util.solver import linear_reaction_coefficients, check_solver_status
+from optlang.symbolics import Zero
+
+try:
+	import highspy
+except ImportError:
+	highspy = None
+
+# dual value of the objective bound below which it counts as not binding in FVA sweeps
+FVA_DUAL_TOLERANCE = 1e-9
+
+
+class HighsLP:
+	"""
+	The LP of a model held directly in HiGHS, built from the sparse stoichiometric matrix and bound arrays once and
+	solved without going through cobra or optlang. Takes and returns plain arrays.
+	Like in cobra, every reaction has a forward and a reverse variable. Rows are the metabolites' mass balances plus one
+	row that can fix the objective, as needed by pFBA and FVA. HiGHS keeps its basis when bounds, costs or row bounds
+	change, so consecutive solves warm start.
+	"""
+
+	def __init__(self, model):
+		"""
+		:param model: Model object. Only stoichiometry, reaction bounds and a linear reaction objective are taken over.
+		"""
+		if highspy is None:
+			raise ImportError('HighsLP requires highspy. Install it with "pip install highspy".')
+		if len(model.constraints) != len(model.metabolites):
+			raise ValueError('HighsLP only supports models without constraints other than the mass balances.')
+		self.reaction_ids = [r.id for r in model.reactions]
+		self.metabolite_ids = [m.id for m in model.metabolites]
+		n = len(self.reaction_ids)
+		m = len(self.metabolite_ids)
+		self.stoichiometry = stoichiometric_matrix(model)
+		coefficients = linear_reaction_coefficients(model)
+		self.objective = np.array([coefficients.get(r, 0.) for r in model.reactions], dtype=float)
+		self.maximize = model.objective.direction == 'max'
+		self.lower = np.array([r.lower_bound for r in model.reactions], dtype=float)
+		self.upper = np.array([r.upper_bound for r in model.reactions], dtype=float)
+
+		matrix = sparse.vstack([
+			sparse.hstack([self.stoichiometry, -self.stoichiometry]),
+			sparse.csr_matrix(np.concatenate([self.objective, -self.objective])),
+		]).tocsc()
+		lp = highspy.HighsLp()
+		lp.num_col_ = 2 * n
+		lp.num_row_ = m + 1
+		lp.col_cost_ = np.zeros(2 * n)
+		col_lower, col_upper = _split_bounds(self.lower, self.upper)
+		lp.col_lower_ = col_lower
+		lp.col_upper_ = col_upper
+		lp.row_lower_ = np.concatenate([np.zeros(m), [-highspy.kHighsInf]])
+		lp.row_upper_ = np.concatenate([np.zeros(m), [highspy.kHighsInf]])
+		lp.a_matrix_.format_ = highspy.MatrixFormat.kColwise
+		lp.a_matrix_.start_ = matrix.indptr
+		lp.a_matrix_.index_ = matrix.indices
+		lp.a_matrix_.value_ = matrix.data
+		self._highs = highspy.Highs()
+		self._highs.setOptionValue('output_flag', False)
+		# changing the objective keeps the basis primal feasible, so primal simplex warm starts best
+		self._highs.setOptionValue('simplex_strategy', 4)
+		self._highs.passModel(lp)
+		self._objective_row = m
+		self.set_objective(self.objective, self.maximize)
+
+	def set_bounds(self, indices, lower, upper):
+		"""
+		Changes the bounds of some reactions.
+		:param indices: Reaction indices.
+		:param lower: New lower bounds.
+		:param upper: New upper bounds.
+		"""
+		indices = np.asarray(indices, dtype=np.int32)
+		if not len(indices):
+			return
+		lower = np.asarray(lower, dtype=float)
+		upper = np.asarray(upper, dtype=float)
+		self.lower[indices] = lower
+		self.upper[indices] = upper
+		col_lower, col_upper = _split_bounds(lower, upper)
+		n = len(self.reaction_ids)
+		columns = np.concatenate([indices, indices + n]).astype(np.int32)
+		self._highs.changeColsBounds(len(columns), columns, col_lower, col_upper)
+
+	def set_objective(self, coefficients, maximize=True):
+		"""
+		Sets a linear objective over the reactions' net fluxes.
+		:param coefficients: Array of objective coefficients, one per reaction.
+		:param maximize: Maximize (True) or minimize (False).
+		"""
+		coefficients = np.asarray(coefficients, dtype=float)
+		self._set_costs(np.concatenate([coefficients, -coefficients]), maximize)
+
+	def set_total_flux_objective(self):
+		"""
+		Minimizes the sum of all forward and reverse fluxes, as done by pFBA.
+		"""
+		self._set_costs(np.ones(2 * len(self.reaction_ids)), False)
+
+	def _set_costs(self, costs, maximize):
+		columns = np.arange(len(costs), dtype=np.int32)
+		self._highs.changeColsCost(len(costs), columns, costs)
+		self._highs.changeObjectiveSense(highspy.ObjSense.kMaximize if maximize else highspy.ObjSense.kMinimize)
+
+	def fix_objective(self, lower=None, upper=None):
+		"""
+		Bounds the model's original objective, e.g. to a fraction of its optimum. None removes the bound.
+		:param lower: Lower bound of the objective value.
+		:param upper: Upper bound of the objective value.
+		"""
+		lower = -highspy.kHighsInf if lower is None else lower
+		upper = highspy.kHighsInf if upper is None else upper
+		self._highs.changeRowBounds(self._objective_row, lower, upper)
+
+	def solve(self):
+		"""
+		Solves the LP with the current objective.
+		:return: Tuple of objective value, net fluxes, reduced costs and shadow prices (arrays).
+		"""
+		self._highs.run()
+		status = self._highs.getModelStatus()
+		if status != highspy.HighsModelStatus.kOptimal:
+			raise OptimizationError(f'HiGHS returned status {self._highs.modelStatusToString(status)}.')
+		n = len(self.reaction_ids)
+		solution = self._highs.getSolution()
+		x = np.asarray(solution.col_value)
+		col_dual = np.asarray(solution.col_dual)
+		row_dual = np.asarray(solution.row_dual)
+		objective_value = self._highs.getInfo().objective_function_value
+		return objective_value, x[:n] - x[n:], col_dual[:n] - col_dual[n:], row_dual[:self._objective_row]
+
+	def fba(self):
+		"""
+		FBA with the model's objective.
+		:return: Tuple of objective value, net fluxes, reduced costs and shadow prices (arrays).
+		"""
+		self.fix_objective()
+		self.set_objective(self.objective, self.maximize)
+		return self.solve()
+
+	def pfba(self, fraction_of_optimum=1.0):
+		"""
+		pFBA: minimizes the total flux while keeping the model's objective at a fraction of its optimum.
+		:param fraction_of_optimum: Fraction of the optimum that must be maintained.
+		:return: Tuple of the FBA objective value, the total flux and the pFBA net fluxes (array).
+		"""
+		objective_value = self.fba()[0]
+		self._keep_objective(objective_value * fraction_of_optimum)
+		self.set_total_flux_objective()
+		total_flux, fluxes = self.solve()[:2]
+		return objective_value, total_flux, fluxes
+
+	def fva(self, indices=None, fraction_of_optimum=1.0):
+		"""
+		Flux variability analysis, each min/max problem warm starting from the previous one.
+		Every solution is a feasible point, so a reaction whose flux already reached its lower (upper) bound in one of
+		them has that bound as minimum (maximum) and is not solved.
+		:param indices: Reaction indices to compute the ranges of. Defaults to all reactions.
+		:param fraction_of_optimum: Fraction of the optimum that must be maintained.
+		:return: Array of minima (first column) and maxima (second column), one row per index.
+		"""
+		if indices is None:
+			indices = np.arange(len(self.reaction_ids))
+		objective_value, fluxes = self.fba()[:2]
+		self._keep_objective(objective_value * fraction_of_optimum)
+		lowest = fluxes.copy()
+		highest = fluxes.copy()
+		ranges = np.zeros((len(indices), 2))
+		coefficients = np.zeros(len(self.reaction_ids))
+		for j, maximize in enumerate((False, True)):
+			for i, index in enumerate(indices):
+				if not maximize and lowest[index] <= self.lower[index]:
+					ranges[i, j] = self.lower[index]
+					continue
+				if maximize and highest[index] >= self.upper[index]:
+					ranges[i, j] = self.upper[index]
+					continue
+				coefficients[index] = 1.
+				self.set_objective(coefficients, maximize)
+				coefficients[index] = 0.
+				ranges[i, j], fluxes = self.solve()[:2]
+				np.minimum(lowest, fluxes, out=lowest)
+				np.maximum(highest, fluxes, out=highest)
+		return ranges
+
+	def _keep_objective(self, bound):
+		"""
+		Keeps the model's objective at least (or at most, if minimized) at a bound.
+		:param bound: Float.
+		"""
+		if self.maximize:
+			self.fix_objective(lower=bound)
+		else:
+			self.fix_objective(upper=bound)
+
+	def objective_dual(self):
+		"""
+		:return: Dual value of the row bounding the model's original objective in the last solution.
+		"""
+		return self._highs.getSolution().row_dual[self._objective_row]
+
+	def bound_sensitivity(self, indices):
+		"""
+		Derivative of the last solution's objective value with respect to a factor scaling all bounds of a reaction, see
+		bound_sensitivity.
+		:param indices: Reaction indices.
+		:return: Array aligned with indices.
+		"""
+		n = len(self.reaction_ids)
+		indices = np.asarray(indices, dtype=int)
+		solution = self._highs.getSolution()
+		x = np.asarray(solution.col_value)
+		dual = np.asarray(solution.col_dual)
+		return x[indices] * dual[indices] + x[indices + n] * dual[indices + n]
+
+	def solution(self):
+		"""
+		Solves the LP and wraps the result like cobra does.
+		:return: cobra.Solution.
+		"""
+		objective_value, fluxes, reduced_costs, shadow_prices = self.solve()
+		return Solution(
+			objective_value,
+			'optimal',
+			pd.Series(fluxes, index=self.reaction_ids, name='fluxes'),
+			pd.Series(reduced_costs, index=self.reaction_ids, name='reduced_costs'),
+			pd.Series(shadow_prices, index=self.metabolite_ids, name='shadow_prices'),
+		)
+
+
+class PersistentLP:
+	"""
+	One LP kept alive over many bound variants of the same model.
+	Only bounds that differ from the previous variant are passed to the solver, and objective switches between FBA, pFBA
+	and FVA only touch the changed coefficients. The solver keeps its last optimal basis, so each solve warm starts.
+	Works on an optlang copy of the model (GLPK warm starts natively) or directly on HiGHS.
+	"""
+
+	def __init__(self, model, solver=None):
+		"""
+		:param model: Model object. It is not modified.
+		:param solver: None keeps the model's solver, 'highs' uses a HighsLP, any other optlang solver name switches the
+			copy's solver to it.
+		"""
+		self.reaction_ids = [r.id for r in model.reactions]
+		self.base_lower = np.array([r.lower_bound for r in model.reactions], dtype=float)
+		self.base_upper = np.array([r.upper_bound for r in model.reactions], dtype=float)
+		self.lower = self.base_lower.copy()
+		self.upper = self.base_upper.copy()
+		self._index = {r: i for i, r in enumerate(self.reaction_ids)}
+		coefficients = linear_reaction_coefficients(model)
+		self._maximize = model.objective.direction == 'max'
+		if solver == 'highs':
+			self.model = None
+			self.highs = HighsLP(model)
+			return
+		self.highs = None
+		self.model = model.copy()
+		if solver is not None:
+			self.model.solver = solver
+		reactions = self.model.reactions
+		self._fba_coefficients = {}
+		for rxn, coefficient in coefficients.items():
+			rxn = reactions.get_by_id(rxn.id)
+			self._fba_coefficients[rxn.forward_variable] = coefficient
+			self._fba_coefficients[rxn.reverse_variable] = -coefficient
+		self._pfba_coefficients = {v: 1. for rxn in reactions for v in (rxn.forward_variable, rxn.reverse_variable)}
+		self._fix = self.model.problem.Constraint(Zero, lb=None, ub=None, name='_persistent_objective')
+		self.model.add_cons_vars(self._fix, sloppy=True)
+		self.model.solver.update()
+		self._fix.set_linear_coefficients(self._fba_coefficients)
+		self._coefficients = dict(self._fba_coefficients)
+
+	def set_bounds(self, indices, lower, upper):
+		"""
+		Sets reaction bounds, passing only the changed ones to the solver.
+		:param indices: Reaction indices in the model.
+		:param lower: Array of lower bounds, aligned with indices.
+		:param upper: Array of upper bounds, aligned with indices.
+		"""
+		indices = np.asarray(indices, dtype=int)
+		lower = np.asarray(lower, dtype=float)
+		upper = np.asarray(upper, dtype=float)
+		changed = (self.lower[indices] != lower) | (self.upper[indices] != upper)
+		indices, lower, upper = indices[changed], lower[changed], upper[changed]
+		self.lower[indices] = lower
+		self.upper[indices] = upper
+		if self.highs is not None:
+			self.highs.set_bounds(indices, lower, upper)
+			return
+		reactions = self.model.reactions
+		for i, lb, ub in zip(indices.tolist(), lower.tolist(), upper.tolist()):
+			reactions[i].bounds = (lb, ub)
+
+	def set_variant(self, variant):
+		"""
+		Sets the bounds of a BoundVariant of the model.
+		:param variant: BoundVariant, e.g. as returned by the create_models* functions with as_variant=True.
+		"""
+		self.set_bounds(variant.plan.indices, variant.lower, variant.upper)
+
+	def reset(self):
+		"""
+		Restores the bounds of the original model.
+		"""
+		self.set_bounds(np.arange(len(self.reaction_ids)), self.base_lower, self.base_upper)
+
+	def _set_objective(self, coefficients, direction):
+		"""
+		Sets the objective of the optlang copy, only changing coefficients that differ from the current ones.
+		:param coefficients: Dictionary of variables to coefficients. Variables missing get 0.
+		:param direction: 'max' or 'min'.
+		"""
+		update = {v: 0. for v in self._coefficients if v not in coefficients}
+		update.update({v: c for v, c in coefficients.items() if self._coefficients.get(v) != c})
+		if update:
+			self.model.solver.objective.set_linear_coefficients(update)
+		self._coefficients = coefficients
+		self.model.solver.objective.direction = direction
+
+	def _fix_objective(self, bound):
+		"""
+		Keeps the original objective at least (or at most, if minimized) at a bound. None releases it.
+		:param bound: Float or None.
+		"""
+		lower, upper = (bound, None) if self._maximize else (None, bound)
+		if self.highs is not None:
+			self.highs.fix_objective(lower, upper)
+			return
+		self._fix.lb = None
+		self._fix.ub = None
+		self._fix.lb = lower
+		self._fix.ub = upper
+
+	def optimize(self):
+		"""
+		FBA with the original objective.
+		:return: cobra.Solution.
+		"""
+		self._fix_objective(None)
+		if self.highs is not None:
+			self.highs.set_objective(self.highs.objective, self._maximize)
+			return self.highs.solution()
+		self._set_objective(self._fba_coefficients, 'max' if self._maximize else 'min')
+		self.model.slim_optimize()
+		check_solver_status(self.model.solver.status, raise_error=True)
+		return get_solution(self.model)
+
+	def pfba(self, fraction_of_optimum=1.0):
+		"""
+		pFBA, also returning the solution of its first stage.
+		:param fraction_of_optimum: Fraction of the optimum that must be maintained.
+		:return: Tuple of the FBA and the pFBA solution.
+		"""
+		sol = self.optimize()
+		return sol, self.minimize_total_flux(sol.objective_value * fraction_of_optimum)
+
+	def minimize_total_flux(self, bound):
+		"""
+		Second stage of pFBA: minimizes the sum of all forward and reverse fluxes while keeping the original objective at
+		least (or at most, if minimized) at a bound.
+		:param bound: Bound of the original objective.
+		:return: cobra.Solution.
+		"""
+		self._fix_objective(bound)
+		if self.highs is not None:
+			self.highs.set_total_flux_objective()
+			return self.highs.solution()
+		self._set_objective(self._pfba_coefficients, 'min')
+		self.model.slim_optimize()
+		check_solver_status(self.model.solver.status, raise_error=True)
+		return get_solution(self.model)
+
+	def minimize_flux(self, weights, bound):
+		"""
+		Minimizes the weighted sum of all forward and reverse fluxes while keeping the original objective at least (or at
+		most, if minimized) at a bound, as done by GIMME. Repeated calls with the same weights only move the bound.
+		:param weights: Array of weights, one per reaction, shared by its forward and reverse flux.
+		:param bound: Bound of the original objective.
+		:return: Array of net fluxes.
+		"""
+		weights = np.asarray(weights, dtype=float)
+		self._fix_objective(bound)
+		if self.highs is not None:
+			self.highs._set_costs(np.concatenate([weights, weights]), False)
+			return self.highs.solve()[1]
+		coefficients = {v: w for rxn, w in zip(self.model.reactions, weights.tolist()) if w
+			for v in (rxn.forward_variable, rxn.reverse_variable)}
+		self._set_objective(coefficients, 'min')
+		self.model.slim_optimize()
+		check_solver_status(self.model.solver.status, raise_error=True)
+		return get_solution(self.model).fluxes.to_numpy()
+
+	def fva(self, reaction_ids=None, fraction_of_optimum=1.0):
+		"""
+		Flux variability analysis on the persistent LP.
+		:param reaction_ids: Reaction IDs to compute the ranges of. Defaults to all reactions.
+		:param fraction_of_optimum: Fraction of the optimum that must be maintained.
+		:return: Dataframe with columns 'minimum' and 'maximum', reaction IDs as index.
+		"""
+		if reaction_ids is None:
+			reaction_ids = self.reaction_ids
+		if self.highs is not None:
+			ranges = self.highs.fva([self._index[r] for r in reaction_ids], fraction_of_optimum)
+			return pd.DataFrame(ranges, index=list(reaction_ids), columns=['minimum', 'maximum'])
+		sol = self.optimize()
+		self._fix_objective(sol.objective_value * fraction_of_optimum)
+		ranges = np.zeros((len(reaction_ids), 2))
+		for j, direction in enumerate(('min', 'max')):
+			for i, rxn_id in enumerate(reaction_ids):
+				ranges[i, j] = self._optimize_flux(self._index[rxn_id], direction)
+		return pd.DataFrame(ranges, index=list(reaction_ids), columns=['minimum', 'maximum'])
+
+	def fva_fractions(self, fractions, reaction_ids=None):
+		"""
+		Flux variability analysis for several fractions of the optimum in one sweep.
+		The optimum is solved once. Each reaction's flux is then minimized and maximized for all fractions in a row, from
+		the largest fraction down, only moving the bound on the original objective in between, so every solve warm starts
+		from the previous fraction. The optimal flux is a convex (min) or concave (max) and monotone function of the bound,
+		with the bound's dual as a subgradient. Once that dual is zero, the flux stays the same for all smaller fractions,
+		which are then not solved.
+		:param fractions: Fractions of the optimum that must be maintained.
+		:param reaction_ids: Reaction IDs to compute the ranges of. Defaults to all reactions.
+		:return: Dictionary of fractions to dataframes with columns 'minimum' and 'maximum', reaction IDs as index.
+		"""
+		if reaction_ids is None:
+			reaction_ids = self.reaction_ids
+		fractions = list(fractions)
+		order = sorted(range(len(fractions)), key=lambda k: fractions[k], reverse=True)
+		optimum = self.optimize().objective_value
+		ranges = np.zeros((len(fractions), len(reaction_ids), 2))
+		for i, rxn_id in enumerate(reaction_ids):
+			for j, direction in enumerate(('min', 'max')):
+				self._set_flux_objective(self._index[rxn_id], direction)
+				for n, k in enumerate(order):
+					bound = optimum * fractions[k]
+					self._fix_objective(bound)
+					ranges[k, i, j] = self._solve()
+					if abs(self._objective_dual()) <= FVA_DUAL_TOLERANCE:
+						ranges[order[n + 1:], i, j] = ranges[k, i, j]
+						break
+		return {fraction: pd.DataFrame(ranges[k], index=list(reaction_ids), columns=['minimum', 'maximum'])
+			for k, fraction in enumerate(fractions)}
+
+	def _optimize_flux(self, index, direction):
+		"""
+		Minimizes or maximizes the flux of one reaction.
+		:param index: Reaction index.
+		:param direction: 'min' or 'max'.
+		:return: Optimal flux.
+		"""
+		self._set_flux_objective(index, direction)
+		return self._solve()
+
+	def _set_flux_objective(self, index, direction):
+		"""
+		Makes the net flux of one reaction the objective.
+		:param index: Reaction index.
+		:param direction: 'min' or 'max'.
+		"""
+		if self.highs is not None:
+			coefficients = np.zeros(len(self.reaction_ids))
+			coefficients[index] = 1.
+			self.highs.set_objective(coefficients, direction == 'max')
+			return
+		rxn = self.model.reactions[index]
+		self._set_objective({rxn.forward_variable: 1., rxn.reverse_variable: -1.}, direction)
+
+	def bound_sensitivity(self, indices):
+		"""
+		Derivative of the last solution's objective value with respect to a factor scaling all bounds of a reaction, see
+		bound_sensitivity.
+		:param indices: Reaction indices.
+		:return: Array aligned with indices.
+		"""
+		if self.highs is not None:
+			return self.highs.bound_sensitivity(indices)
+		return bound_sensitivity(self.model, indices)
+
+	def _objective_dual(self):
+		"""
+		:return: Dual value of the bound on the original objective in the last solution.
+		"""
+		if self.highs is not None:
+			return self.highs.objective_dual()
+		return self._fix.dual
+
+	def _solve(self):
+		"""
+		:return: Optimal value of the current objective.
+		"""
+		if self.highs is not None:
+			return self.highs.solve()[0]
+		self.model.slim_optimize()
+		check_solver_status(self.model.solver.status, raise_error=True)
+		return self.model.solver.objective.value
+
+	def __repr__(self):
+		backend = 'highs' if self.highs is not None else self.model.problem.__name__.split('.')[-1]
+		return f'<PersistentLP over {len(self.reaction_ids)} reactions ({backend})>'
+
+
+def bound_sensitivity(model, indices):
+	"""
+	Derivative of the objective value of a model's last solution with respect to a factor scaling all bounds of a
+	reaction, at factor 1. Variables at a bound move with it, the others are basic and have no reduced cost, so it is the
+	sum of value times reduced cost of the reaction's forward and reverse variable. Exact while the optimal basis stays
+	the same.
+	:param model: Model object that was just optimized.
+	:param indices: Reaction indices.
+	:return: Array aligned with indices.
+	"""
+	reactions = model.reactions
+	values = np.zeros(len(indices))
+	for k, i in enumerate(indices):
+		rxn = reactions[i]
+		values[k] = rxn.forward_variable.primal * rxn.forward_variable.dual + rxn.reverse_variable.primal * rxn.reverse_variable.dual
+	return values
+
+
+def stoichiometric_matrix(model):
+	"""
+	Stoichiometric matrix of a model.
+	:param model: Model object.
+	:return: Sparse matrix (CSR) of metabolites x reactions.
+	"""
+	metabolites = {m.id: i for i, m in enumerate(model.metabolites)}
+	rows, cols, values = [], [], []
+	for j, rxn in enumerate(model.reactions):
+		for met, coefficient in rxn.metabolites.items():
+			rows.append(metabolites[met.id])
+			cols.append(j)
+			values.append(coefficient)
+	return sparse.csr_matrix((values, (rows, cols)), shape=(len(model.metabolites), len(model.reactions)))
+
+
+def _split_bounds(lower, upper):
+	"""
+	Splits reaction bounds into bounds of forward and reverse variables, the same way cobra does.
+	:param lower: Array of lower bounds.
+	:param upper: Array of upper bounds.
+	:return: Tuple of column lower and upper bounds, forward variables first.
+	"""
+	fwd_lower = np.maximum(lower, 0.)
+	fwd_upper = np.maximum(upper, 0.)
+	rev_lower = np.maximum(-upper, 0.)
+	rev_upper = np.maximum(-lower, 0.)
+	return np.concatenate([fwd_lower, rev_lower]), np.concatenate([fwd_upper, rev_upper])
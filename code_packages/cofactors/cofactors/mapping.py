@@ -1,16 +1,32 @@
 #!usr/bin/python
+import ast
+import hashlib
+import numpy as np
 import pandas as pd
 import cobra
 from os import listdir
 import xml.etree.ElementTree as et
 import re
 from pathlib import Path
+from cofactors.models import load_model
+
+# rules with more alternative complexes are evaluated as a tree instead of being expanded, see GPRProgram
+MAX_COMPLEXES = 256
+
+
+def _visible(query_files):
+	"""
+	:param query_files: Paths to query files.
+	:return: List of the paths whose file name does not start with a dot.
+	"""
+	return [qf for qf in query_files if not Path(qf).name.startswith('.')]
 
 
 def read_sabiork(query_files=None, species=None):
 	"""
 	Reads a number of SabioRK files and adds them all into a single dataframe.
 	:param query_files: List of paths to the SabioRK query files. Defaults to using the 'sabiork_queries' folder.
+		Hidden files like the folder's manifest are skipped.
 	:param species: List of strings for species to be used. Defaults to NAD(P) and NAD(P)H.
 	:return: Dataframe containing all relevant data: UniProt ID, EC, species, KM value, unit
 	"""
@@ -20,6 +36,7 @@ def read_sabiork(query_files=None, species=None):
 		query_files = ['./sabiork_queries/' / f for f in query_files]
 	if not species:
 		species = ['NAD+', 'NADH', 'NADP+', 'NADPH']
+	query_files = _visible(query_files)
 	dfs = []
 	# create dataframes from all files and add them to a list
 	for qf in query_files:
@@ -27,7 +44,7 @@ def read_sabiork(query_files=None, species=None):
 		df = df[df['parameter.type'] == 'Km']
 		df = df[df['parameter.associatedSpecies'].isin(species)]
 		# set species names into lowercase:
-		df.index = [x.lower() for x in list(df.index)]
+		df.index = df.index.str.lower()
 		dfs.append(df)
 	# vertically concatenate dataframes and rename:
 	df = pd.concat(dfs)
@@ -47,10 +64,12 @@ def read_brenda(query_files=None):
 	"""
 	Reads a number of Brenda files and adds them into a single dataframe.
 	:param query_files: List of paths to the Brenda query files. Defaults to using the 'brenda_queries' folder.
+		Hidden files like the folder's manifest are skipped.
 	:return: Dataframe containing all relevant data: EC, species, KM value, unit
 	"""
 	if not query_files:
 		query_files = ['./brenda_queries/' + f for f in listdir('./brenda_queries')]
+	query_files = _visible(query_files)
 	dfs = []
 	# create dataframes from all files and add them to a list
 	for qf in query_files:
@@ -58,7 +77,7 @@ def read_brenda(query_files=None):
 		df.columns = ['ec', 'value', 'species', 'commentary', 'ligand', 'literature']
 		df.drop(['commentary', 'ligand', 'literature'], axis=1, inplace=True)
 		# set species names into lowercase:
-		df.index = [x.lower() for x in list(df.index)]
+		df.index = df.index.str.lower()
 		dfs.append(df)
 	# vertically concatenate dataframes and rename:
 	df = pd.concat(dfs)
@@ -77,7 +96,7 @@ def create_mappings_ec_mitocore(model, species_tag='nad', save = False):
 	:return: Dictionary of associations. Reaction IDs as keys.
 	"""
 	# todo: current version of COBRApy completely killed this by not parsing EC in notes
-	model = cobra.io.read_sbml_model(model)
+	model = load_model(model)
 	rea_nad = [r for r in model.reactions if species_tag in r.build_reaction_string()]
 	associations = {}
 	err = 0
@@ -106,64 +125,160 @@ def create_mappings_ec_mitocore(model, species_tag='nad', save = False):
 	return associations
 
 
-def create_mappings_ec_mitocore_from_xml(modelFile, species_tag='nad', save_path = None, verbose = False):
-	re_ec = re.compile('[0-9]\.[0-9]+\.[0-9]+\.[0-9]+')
-	root = et.parse(modelFile).getroot() # parses XML
-	model = root[0]
-	rxns = model[4]
-	
-	mapping = {}
-	# iterate over reactions in ListOfReactions tag
-	nad_found = []
-	nad_not_found = []
-	for x in rxns:
-		rxn_id = x.attrib['id'][2:]
-		# find the notes section
-		note = x[3][0]
-		
-		# if reactions don't involve NAD we want to skip them
-		nad = False
-		for p in note:
-			if 'Description' in p.text:
-				if (species_tag.upper() in p.text) or (species_tag.lower() in p.text):
-					nad = True
-					nad_found.append(rxn_id)
-		# skip the reaction if NAD is not involved
-		if not nad:
-			nad_not_found.append(rxn_id)
+SBML_NAMESPACE = 'http://www.sbml.org/sbml/'
+XHTML_NAMESPACE = 'http://www.w3.org/1999/xhtml'
+RE_EC = re.compile(r'[0-9]\.[0-9]+\.[0-9]+\.[0-9]+')
+
+# results of read_sbml_reactions by file hash and species tag
+_sbml_reactions = {}
+
+
+def _local_name(tag):
+	"""
+	Splits an element tag into namespace and local name.
+	:param tag: Tag as given by ElementTree, e.g. '{http://www.sbml.org/sbml/level2}reaction'.
+	:return: Tuple of namespace (empty if there is none) and local name.
+	"""
+	if tag[0] == '{':
+		namespace, name = tag[1:].split('}', 1)
+		return namespace, name
+	return '', tag
+
+
+def _file_hash(file_path):
+	"""
+	:param file_path: Path to a file.
+	:return: SHA-256 hex digest of the file's content.
+	"""
+	h = hashlib.sha256()
+	with open(file_path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def read_sbml_reactions(modelFile, species_tag='nad'):
+	"""
+	Reads EC numbers, cofactor involvement and compartments of all reactions of an SBML file in one streaming pass.
+	Elements are looked up by namespace and name, not position, and discarded once read, so memory does not grow with
+	the file. Results are memoized by the file's hash.
+	EC numbers are taken from 'EC Number' note paragraphs and identifiers.org ec-code annotations. A reaction involves
+	the cofactor if its 'Description' note mentions the species tag in upper or lower case, or, for reactions without
+	description, if one of its species is the cofactor (e.g. M_nad_c for 'nad').
+	:param modelFile: Path to the SBML file.
+	:param species_tag: Tag to identify the cofactor by. Defaults to "nad".
+	:return: Dataframe indexed by reaction ID (without 'R_' prefix) with columns 'ecs' (list), 'cofactor' (bool) and
+		'compartments' (sorted list).
+	"""
+	key = (_file_hash(modelFile), species_tag)
+	if key in _sbml_reactions:
+		return _sbml_reactions[key].copy()
+
+	tags = (species_tag.upper(), species_tag.lower())
+	species_compartments = {}
+	records = {}
+	stack = []
+	for event, elem in et.iterparse(str(modelFile), events=('start', 'end')):
+		if event == 'start':
+			stack.append(elem)
 			continue
-		# finally find ECs
-		error_count = 0
-		
-		ec_found = False
-		for p in note:
-			if 'EC Number' in p.text:
-				ec_found = True
-				try:
-					ecs = re_ec.findall(p.text)
-					if not ecs: 
-						print(f'No mapping found for {rxn_id}')
-						continue
-					for ec in ecs:
-						try:
-							mapping[rxn_id].append(ec)
-						except KeyError:
-							mapping[rxn_id] = [ec]
-				except IndexError: # no ECs found
-					print(f'Invalid {p.text} in {rxn_id}')
-					error_count += 1
-		if verbose and not ec_found:
-			print(f'No EC annotation in reaction {rxn_id}')
+		stack.pop()
+		namespace, name = _local_name(elem.tag)
+		if not namespace.startswith(SBML_NAMESPACE):
+			continue
+		if name == 'species':
+			species_compartments[elem.get('id')] = elem.get('compartment')
+		elif name == 'reaction':
+			rxn_id = elem.get('id')
+			if rxn_id.startswith('R_'):
+				rxn_id = rxn_id[2:]
+			records[rxn_id] = _read_reaction(elem, species_compartments, species_tag, tags)
+		else:
+			continue
+		# drop what was read, keeping memory constant
+		elem.clear()
+		if stack:
+			stack[-1].remove(elem)
+
+	df = pd.DataFrame.from_dict(records, orient='index', columns=['ecs', 'cofactor', 'compartments'])
+	df.index.name = 'reaction'
+	_sbml_reactions[key] = df
+	return df.copy()
+
+
+def _read_reaction(elem, species_compartments, species_tag, tags):
+	"""
+	Extracts ECs, cofactor involvement and compartments from a reaction element.
+	:param elem: Reaction element.
+	:param species_compartments: Dictionary of species IDs to compartments.
+	:param species_tag: Tag to identify the cofactor by.
+	:param tags: Upper and lower case tag to look for in descriptions.
+	:return: Tuple of list of ECs, cofactor involvement and sorted list of compartments.
+	"""
+	ecs = []
+	description = None
+	species = []
+	for child in elem.iter():
+		namespace, name = _local_name(child.tag)
+		if namespace == XHTML_NAMESPACE and name == 'p':
+			text = ''.join(child.itertext())
+			if 'Description' in text:
+				description = (description or False) or any(t in text for t in tags)
+			if 'EC Number' in text:
+				ecs.extend(RE_EC.findall(text))
+		elif namespace.startswith(SBML_NAMESPACE) and name == 'speciesReference':
+			species.append(child.get('species'))
+		elif name == 'li':
+			resource = child.get('{http://www.w3.org/1999/02/22-rdf-syntax-ns#}resource', '')
+			if 'ec-code' in resource:
+				ecs.extend(RE_EC.findall(resource))
+	if description is None:
+		cofactor = any(_species_name(s) == species_tag.lower() for s in species)
+	else:
+		cofactor = description
+	compartments = sorted({species_compartments[s] for s in species if species_compartments.get(s)})
+	return list(dict.fromkeys(ecs)), cofactor, compartments
+
+
+def _species_name(species_id):
+	"""
+	:param species_id: SBML species ID, e.g. 'M_nad_c'.
+	:return: Lowercase ID without prefix and compartment suffix, e.g. 'nad'.
+	"""
+	if species_id.startswith('M_'):
+		species_id = species_id[2:]
+	return species_id.rsplit('_', 1)[0].lower()
+
+
+def create_mappings_ec_mitocore_from_xml(modelFile, species_tag='nad', save_path = None, verbose = False):
+	"""
+	Creates mapping of the reactions of an SBML model involving a cofactor onto ECs, see read_sbml_reactions.
+	:param modelFile: Path to model file.
+	:param species_tag: Tag to identify the cofactor by. Defaults to "nad".
+	:param save_path: Optional path to save the mapping to, as tab separated file readable by load_mappings.
+	:param verbose: Print reactions with and without the cofactor and those lacking EC annotations.
+	:return: Dictionary of associations. Reaction IDs as keys, lists of ECs as values.
+	"""
+	reactions = read_sbml_reactions(modelFile, species_tag)
+	involved = reactions[reactions.cofactor]
+	mapping = {rxn_id: ecs for rxn_id, ecs in involved.ecs.items() if ecs}
+	missing = [rxn_id for rxn_id, ecs in involved.ecs.items() if not ecs]
 	if verbose:
-		print(f'NAD found in {len(nad_found)} reactions:')
-		print(nad_found)
+		print(f'NAD found in {len(involved)} reactions:')
+		print(list(involved.index))
 		print()
-		print(f'NAD not found in {len(nad_not_found)} reactions:')
-		print(nad_not_found)
+		print(f'NAD not found in {len(reactions) - len(involved)} reactions:')
+		print(list(reactions.index[~reactions.cofactor]))
 		print()
-
+		for rxn_id in missing:
+			print(f'No EC annotation in reaction {rxn_id}')
+	
 	print('ECs found for {} reactions.'.format(len(mapping)))
-	print('No ECs found for {} reactions.'.format(error_count))
+	print('No ECs found for {} reactions.'.format(len(missing)))
+	
+	if save_path:
+		with open(save_path, 'w') as f:
+			f.write('\n'.join('{}\t{}'.format(rxn, '\t'.join(ecs)) for rxn, ecs in mapping.items()))
 	
 	return mapping
 
@@ -181,3 +296,160 @@ def load_mappings(file_name):
 			associations[line[0]] = line[1:]
 			
 	return associations
+
+
+def map_expression(model, expression, fill_value=None):
+	"""
+	Maps gene expression onto reactions through their gene-reaction rules, like mapExpressionToReactions of the COBRA
+	Toolbox. See GPRProgram, which can be kept to map further samples onto the same model.
+	:param model: Model object.
+	:param expression: Dataframe of expression values indexed by gene ID, one column per sample, or a Series.
+	:param fill_value: Value of reactions without rule or without measured genes. Defaults to NaN.
+	:return: Dataframe (or Series) of expression values indexed by reaction ID.
+	"""
+	return GPRProgram(model).map(expression, fill_value)
+
+
+class GPRProgram:
+	"""
+	The gene-reaction rules of a model compiled into one min/max program over a gene x sample matrix.
+	Rules are expanded into alternative complexes. A complex gets the lowest value of its measured genes, a reaction the
+	highest value of its complexes, as in mapExpressionToReactions of the COBRA Toolbox. Both levels are evaluated for all
+	reactions and samples at once, with np.fmin.reduceat over the genes of all complexes and np.fmax.reduceat over the
+	complexes of all reactions. Unmeasured genes (missing or NaN) are skipped.
+	Expanding a rule can take exponential time, e.g. an 'and' over many 'or' groups, so rules with more than
+	MAX_COMPLEXES complexes are evaluated on their tree instead, with the same result (see _gpr_evaluate).
+	"""
+
+	def __init__(self, model):
+		"""
+		:param model: Model object.
+		"""
+		self.reaction_ids = [r.id for r in model.reactions]
+		genes = {}
+		members = []
+		complex_starts = []
+		reaction_starts = []
+		reactions = []
+		self._trees = {}
+		for i, rxn in enumerate(model.reactions):
+			body = rxn.gpr.body
+			if body is not None and _gpr_count(body) > MAX_COMPLEXES:
+				self._trees[i] = body
+				for g in _gpr_genes(body):
+					genes.setdefault(g, len(genes))
+				continue
+			complexes = _gpr_complexes(body)
+			if not complexes:
+				continue
+			reactions.append(i)
+			reaction_starts.append(len(complex_starts))
+			for genes_and in complexes:
+				complex_starts.append(len(members))
+				members.extend(genes.setdefault(g, len(genes)) for g in genes_and)
+		self.gene_ids = list(genes)
+		self._members = np.array(members, dtype=np.intp)
+		self._complex_starts = np.array(complex_starts, dtype=np.intp)
+		self._reaction_starts = np.array(reaction_starts, dtype=np.intp)
+		self._reactions = np.array(reactions, dtype=np.intp)
+
+	def map(self, expression, fill_value=None):
+		"""
+		:param expression: Dataframe of expression values indexed by gene ID, one column per sample, or a Series. Genes
+			listed several times count with their lowest value.
+		:param fill_value: Value of reactions without rule or without measured genes. Defaults to NaN.
+		:return: Dataframe (or Series) of expression values indexed by reaction ID.
+		"""
+		series = isinstance(expression, pd.Series)
+		genes = expression.to_frame() if series else expression
+		genes = genes[genes.index.isin(self.gene_ids)]
+		if genes.index.has_duplicates:
+			genes = genes.groupby(level=0).min()
+		genes = genes.reindex(self.gene_ids)
+		mapped = np.full((len(self.reaction_ids), genes.shape[1]), np.nan)
+		if len(self._reactions):
+			values = genes.to_numpy(dtype=float)[self._members]
+			complexes = np.fmin.reduceat(values, self._complex_starts, axis=0)
+			mapped[self._reactions] = np.fmax.reduceat(complexes, self._reaction_starts, axis=0)
+		if self._trees:
+			values = genes.to_numpy(dtype=float)
+			index = {g: k for k, g in enumerate(self.gene_ids)}
+			for i, body in self._trees.items():
+				best, _ = _gpr_evaluate(body, values, index)
+				mapped[i] = np.where(best == -np.inf, np.nan, best)
+		if fill_value is not None:
+			mapped[np.isnan(mapped)] = fill_value
+		mapped = pd.DataFrame(mapped, index=pd.Index(self.reaction_ids, name='reaction'), columns=genes.columns)
+		return mapped.iloc[:, 0] if series else mapped
+
+	def __len__(self):
+		return len(self._reactions) + len(self._trees)
+
+	def __repr__(self):
+		return f'<GPRProgram of {len(self)} rules over {len(self.gene_ids)} genes>'
+
+
+def _gpr_complexes(node):
+	"""
+	Expands a gene-reaction rule into its alternative complexes (disjunctive normal form).
+	:param node: Body of a cobra GPR, i.e. an ast expression of gene names, 'and' and 'or', or None.
+	:return: List of lists of gene IDs.
+	"""
+	if node is None:
+		return []
+	if isinstance(node, ast.Name):
+		return [[node.id]]
+	parts = [_gpr_complexes(value) for value in node.values]
+	if isinstance(node.op, ast.Or):
+		return [c for part in parts for c in part]
+	complexes = [[]]
+	for part in parts:
+		complexes = [c + d for c in complexes for d in part]
+	return complexes
+
+
+def _gpr_count(node):
+	"""
+	:param node: Body of a cobra GPR.
+	:return: Number of complexes _gpr_complexes expands the rule into, without expanding it.
+	"""
+	if isinstance(node, ast.Name):
+		return 1
+	counts = [_gpr_count(value) for value in node.values]
+	return sum(counts) if isinstance(node.op, ast.Or) else int(np.prod(counts, dtype=object))
+
+
+def _gpr_genes(node):
+	"""
+	:param node: Body of a cobra GPR.
+	:return: List of the rule's gene IDs in order of appearance.
+	"""
+	if isinstance(node, ast.Name):
+		return [node.id]
+	return [g for value in node.values for g in _gpr_genes(value)]
+
+
+def _gpr_evaluate(node, values, index):
+	"""
+	Evaluates a gene-reaction rule on its tree, giving the maximum over its complexes of their minimum without expanding
+	it. Unmeasured genes are skipped as in GPRProgram, so each node keeps the best value of its complexes with a measured
+	gene and whether it has a complex without one: such a complex passes the other side's values through an 'and'.
+	:param node: Body of a cobra GPR.
+	:param values: Matrix of expression values, one row per gene and one column per sample, NaN where unmeasured.
+	:param index: Dictionary of gene IDs to their rows.
+	:return: Tuple of the array of best values (-inf where no complex has a measured gene) and the boolean array of
+		whether a complex has no measured gene.
+	"""
+	if isinstance(node, ast.Name):
+		value = values[index[node.id]]
+		empty = np.isnan(value)
+		return np.where(empty, -np.inf, value), empty
+	best, empty = _gpr_evaluate(node.values[0], values, index)
+	for value in node.values[1:]:
+		other, other_empty = _gpr_evaluate(value, values, index)
+		if isinstance(node.op, ast.Or):
+			best, empty = np.maximum(best, other), empty | other_empty
+		else:
+			passed = np.maximum(np.where(other_empty, best, -np.inf), np.where(empty, other, -np.inf))
+			best, empty = np.maximum(np.minimum(best, other), passed), empty & other_empty
+	return best, empty
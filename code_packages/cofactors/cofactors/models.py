@@ -0,0 +1,89 @@
+import hashlib
+import os
+import pickle
+import sys
+import tempfile
+import cobra
+from pathlib import Path
+
+CACHE_SUFFIX = '.pkl'
+CACHE_FORMAT = 1
+
+
+def load_model(file_path, cache=True):
+	"""
+	Reads an SBML model, keeping a binary copy of the parsed model next to the file.
+	Later calls load that copy instead of parsing the SBML again. It is used as long as the file's modification time and
+	size, or else its SHA-256, match the ones it was created from, and cobra and Python versions did not change.
+	:param file_path: Path to the SBML file.
+	:param cache: Use and create the binary copy. If False, the file is just parsed.
+	:return: Model object.
+	"""
+	file_path = Path(file_path)
+	if not cache:
+		return cobra.io.read_sbml_model(str(file_path))
+	cache_path = file_path.with_name(file_path.name + CACHE_SUFFIX)
+	stat = file_path.stat()
+	header = {
+		'format': CACHE_FORMAT,
+		'cobra': cobra.__version__,
+		'python': tuple(sys.version_info[:2]),
+		'mtime': stat.st_mtime_ns,
+		'size': stat.st_size,
+	}
+
+	model = None
+	digest = None
+	try:
+		with open(cache_path, 'rb') as f:
+			cached = pickle.load(f)
+			same = all(cached.get(k) == header[k] for k in ('format', 'cobra', 'python'))
+			if same and cached['mtime'] == header['mtime'] and cached['size'] == header['size']:
+				return pickle.load(f)
+			if same:
+				digest = _sha256(file_path)
+				if cached.get('sha256') == digest:
+					model = pickle.load(f)
+	except FileNotFoundError:
+		pass
+	except Exception:
+		# unreadable or incompatible cache, parse again
+		model = None
+
+	if model is None:
+		model = cobra.io.read_sbml_model(str(file_path))
+	header['sha256'] = digest or _sha256(file_path)
+	_write_cache(cache_path, header, model)
+	return model
+
+
+def _sha256(file_path):
+	"""
+	:param file_path: Path to a file.
+	:return: Hex digest of the file's content.
+	"""
+	h = hashlib.sha256()
+	with open(file_path, 'rb') as f:
+		for block in iter(lambda: f.read(1 << 20), b''):
+			h.update(block)
+	return h.hexdigest()
+
+
+def _write_cache(cache_path, header, model):
+	"""
+	Writes header and model to the cache file, replacing it atomically. Unwritable folders are skipped silently.
+	:param cache_path: Path of the cache file.
+	:param header: Dictionary identifying the SBML file and versions.
+	:param model: Model object.
+	"""
+	try:
+		fd, tmp = tempfile.mkstemp(suffix=CACHE_SUFFIX, dir=cache_path.parent)
+	except OSError:
+		return
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			pickle.dump(header, f, protocol=pickle.HIGHEST_PROTOCOL)
+			pickle.dump(model, f, protocol=pickle.HIGHEST_PROTOCOL)
+		os.replace(tmp, cache_path)
+	except OSError:
+		os.unlink(tmp)
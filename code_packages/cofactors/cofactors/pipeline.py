@@ -0,0 +1,505 @@
+import inspect
+import json
+import os
+import pickle
+import tempfile
+import cobra
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from pathlib import Path
+from cofactors.cache import content_hash
+from cofactors.gimme import gimme, gimme_threshold
+from cofactors.integration import create_models_fva, _n_jobs
+from cofactors.kmstore import read_km_store
+from cofactors.mapping import read_sabiork, read_brenda, create_mappings_ec_mitocore_from_xml, map_expression, _visible, _file_hash
+from cofactors.models import load_model
+from cofactors.helpers import read_subsystems
+from cofactors.results import ResultStore, EXPORTS
+
+PIPELINE_FORMAT = 2
+ARTIFACT_SUFFIX = '.pkl'
+OUTPUTS_SUFFIX = '.outputs.json'
+
+
+class Stage:
+	"""
+	One step of a Pipeline: a function of its parameters, input files and the artefacts of the stages it depends on.
+	"""
+
+	def __init__(self, name, function, params=None, dependencies=(), files=None, outputs=(), version=None):
+		"""
+		:param name: Unique name of the stage.
+		:param function: Picklable function taking the parameters (including the files) and the artefacts of the
+			dependencies in their order, and returning the stage's artefact.
+		:param params: Dictionary of parameters, anything content_hash accepts.
+		:param dependencies: Names of the stages whose artefacts are passed on.
+		:param files: Dictionary of parameter names to paths of files or folders the function reads. Their content, not
+			their path, is part of the stage's key.
+		:param outputs: Paths of files or folders the function writes besides its artefact. The stage is only up to date
+			while they exist with the content it wrote.
+		:param version: Optional version, part of the stage's key. The source of the function is part of the key
+			already, bump the version when code it calls changes the results.
+		"""
+		self.name = name
+		self.function = function
+		self.params = dict(params or {})
+		self.dependencies = list(dependencies)
+		self.files = {k: Path(v) for k, v in (files or {}).items()}
+		self.outputs = [Path(p) for p in outputs]
+		self.version = version
+
+	def __repr__(self):
+		return f'<Stage {self.name} <- {self.dependencies}>'
+
+
+class Pipeline:
+	"""
+	Stages forming a directed acyclic graph, each stage's artefact stored in a folder under a hash of everything it was
+	computed from: its function's source and version, parameters, the content of its input files and the keys of the
+	stages it depends on. Running the pipeline only executes stages without a stored artefact, i.e. those whose inputs
+	changed, or whose output files were deleted or changed since, and runs stages that do not depend on each other in
+	parallel.
+	"""
+
+	def __init__(self, stages, path):
+		"""
+		:param stages: List of Stage objects.
+		:param path: Folder of the artefacts. Created if missing.
+		"""
+		self.stages = {}
+		for stage in stages:
+			if stage.name in self.stages:
+				raise ValueError(f'Stage {stage.name!r} is defined twice.')
+			self.stages[stage.name] = stage
+		for stage in stages:
+			unknown = [d for d in stage.dependencies if d not in self.stages]
+			if unknown:
+				raise ValueError(f'Stage {stage.name!r} depends on unknown stages {unknown}.')
+		self.order = _topological_order(self.stages)
+		self.path = Path(path)
+
+	def keys(self):
+		"""
+		:return: Dictionary of stage names to the keys of their artefacts.
+		"""
+		keys = {}
+		for name in self.order:
+			stage = self.stages[name]
+			function = f'{stage.function.__module__}.{stage.function.__qualname__}'
+			files = {k: _content_hash(p) for k, p in stage.files.items()}
+			keys[name] = content_hash('stage', PIPELINE_FORMAT, name, function, _function_source(stage.function),
+				stage.version, stage.params, files, [keys[d] for d in stage.dependencies])
+		return keys
+
+	def status(self):
+		"""
+		:return: Dataframe of the stages in execution order with their 'key' and whether they are 'stored', i.e. have an
+			artefact and unchanged output files.
+		"""
+		keys = self.keys()
+		return pd.DataFrame({'key': [keys[n] for n in self.order], 'stored': [self._stored(n, keys[n]) for n in self.order]},
+			index=pd.Index(self.order, name='stage'))
+
+	def run(self, targets=None, n_jobs=1, executor=None, force=()):
+		"""
+		Brings the targets up to date.
+		Stages are run if they have no stored artefact, their output files are missing or changed, or they are forced,
+		and their result is needed by a target. Stored
+		artefacts are only loaded where a target or a stage to run needs them.
+		:param targets: Names of the stages to return. Defaults to the stages nothing depends on.
+		:param n_jobs: Number of worker processes. 1 runs serially, -1 uses all cores.
+		:param executor: Optional process based executor to run on instead of a new process pool.
+		:param force: Names of stages to run even if their artefact is stored.
+		:return: Dictionary of target names to artefacts.
+		"""
+		keys = self.keys()
+		if targets is None:
+			required = set(d for s in self.stages.values() for d in s.dependencies)
+			targets = [n for n in self.order if n not in required]
+		unknown = [t for t in list(targets) + list(force) if t not in self.stages]
+		if unknown:
+			raise ValueError(f'Unknown stages {unknown}.')
+		stale = set()
+		visit = list(targets)
+		while visit:
+			name = visit.pop()
+			if name in stale or (name not in force and self._stored(name, keys[name])):
+				continue
+			stale.add(name)
+			visit.extend(self.stages[name].dependencies)
+
+		self.path.mkdir(parents=True, exist_ok=True)
+		artefacts = {}
+
+		def arguments(name):
+			stage = self.stages[name]
+			inputs = []
+			for dependency in stage.dependencies:
+				if dependency not in artefacts:
+					artefacts[dependency] = self._load(keys[dependency])
+				inputs.append(artefacts[dependency])
+			params = dict(stage.params, **{k: str(p) for k, p in stage.files.items()})
+			return stage.function, params, inputs, self._file(keys[name]), stage.outputs
+
+		pending = [n for n in self.order if n in stale]
+		n_jobs = _n_jobs(n_jobs, executor)
+		if n_jobs == 1 and executor is None:
+			for name in pending:
+				artefacts[name] = _run_stage(arguments(name))
+		else:
+			own_executor = executor is None
+			if own_executor:
+				executor = ProcessPoolExecutor(max_workers=n_jobs)
+			try:
+				running = {}
+				while pending or running:
+					busy = set(pending) | set(running.values())
+					for name in [n for n in pending if not busy.intersection(self.stages[n].dependencies)]:
+						pending.remove(name)
+						running[executor.submit(_stage_worker, arguments(name))] = name
+					done, _ = wait(running, return_when=FIRST_COMPLETED)
+					for future in done:
+						artefacts[running.pop(future)] = future.result()
+			finally:
+				if own_executor:
+					executor.shutdown()
+		for name in targets:
+			if name not in artefacts:
+				artefacts[name] = self._load(keys[name])
+		return {name: artefacts[name] for name in targets}
+
+	def _file(self, key):
+		return self.path / f'{key}{ARTIFACT_SUFFIX}'
+
+	def _stored(self, name, key):
+		"""
+		:param name: Name of the stage.
+		:param key: Key of the stage.
+		:return: Whether the artefact is stored and the stage's output files are as it wrote them.
+		"""
+		file = self._file(key)
+		if not file.exists():
+			return False
+		outputs = self.stages[name].outputs
+		if not outputs:
+			return True
+		try:
+			with open(file.with_suffix(OUTPUTS_SUFFIX)) as f:
+				written = json.load(f)
+		except (OSError, ValueError):
+			return False
+		return all(p.exists() and written.get(str(p)) == _content_hash(p) for p in outputs)
+
+	def _load(self, key):
+		with open(self._file(key), 'rb') as f:
+			return pickle.load(f)
+
+	def __len__(self):
+		return len(self.stages)
+
+	def __repr__(self):
+		return f'<Pipeline of {len(self)} stages at {self.path}>'
+
+
+def _topological_order(stages):
+	"""
+	:param stages: Dictionary of names to Stage objects.
+	:return: List of stage names, each after its dependencies.
+	"""
+	order = []
+	state = {}
+	for root in stages:
+		stack = [(root, False)]
+		while stack:
+			name, expanded = stack.pop()
+			if expanded:
+				state[name] = 'done'
+				order.append(name)
+				continue
+			if state.get(name) == 'done':
+				continue
+			if state.get(name) == 'open':
+				raise ValueError(f'Stages depend on each other in a cycle through {name!r}.')
+			state[name] = 'open'
+			stack.append((name, True))
+			stack.extend((d, False) for d in reversed(stages[name].dependencies) if state.get(d) != 'done')
+	return order
+
+
+def _content_hash(path):
+	"""
+	:param path: Path to a file, or a folder whose visible files and subfolders are hashed by name and content.
+	:return: Hex digest.
+	"""
+	if path.is_dir():
+		return content_hash({f.name: _content_hash(f) for f in _visible(sorted(path.iterdir())) if f.is_file() or f.is_dir()})
+	return _file_hash(path)
+
+
+def _function_source(function):
+	"""
+	:param function: Function of a stage.
+	:return: Its source code, or its bytecode where the source is not available.
+	"""
+	try:
+		return inspect.getsource(function)
+	except (OSError, TypeError):
+		code = getattr(function, '__code__', None)
+		return code.co_code.hex() if code is not None else None
+
+
+def _run_stage(args):
+	"""
+	Runs a stage and stores its artefact, along with the hashes of its output files.
+	:param args: Tuple of function, parameters, input artefacts, path of the artefact and paths of the output files.
+	:return: Artefact.
+	"""
+	function, params, inputs, file, outputs = args
+	artefact = function(params, *inputs)
+	if outputs:
+		missing = [str(p) for p in outputs if not p.exists()]
+		if missing:
+			raise FileNotFoundError(f'The stage did not write its outputs {missing}.')
+		# recorded before the artefact, which marks the stage as done
+		_write_atomic(file.with_suffix(OUTPUTS_SUFFIX), json.dumps({str(p): _content_hash(p) for p in outputs}).encode())
+	_write_atomic(file, pickle.dumps(artefact, protocol=pickle.HIGHEST_PROTOCOL))
+	return artefact
+
+
+def _write_atomic(file, data):
+	"""
+	Replaces a file atomically.
+	:param file: Path of the file.
+	:param data: Bytes to write.
+	"""
+	fd, tmp = tempfile.mkstemp(suffix=file.suffix, dir=file.parent)
+	try:
+		with os.fdopen(fd, 'wb') as f:
+			f.write(data)
+		os.replace(tmp, file)
+	except BaseException:
+		os.unlink(tmp)
+		raise
+
+
+def _stage_worker(args):
+	"""
+	Runs a stage in a worker process, with cobra's own parallelism switched off.
+	:param args: See _run_stage.
+	:return: Artefact.
+	"""
+	cobra.Configuration().processes = 1
+	return _run_stage(args)
+
+
+def load_config(path):
+	"""
+	Reads a pipeline configuration. Relative paths in it are taken relative to the file's folder.
+	:param path: Path to a JSON file, see build_pipeline.
+	:return: Dictionary.
+	"""
+	path = Path(path)
+	with open(path) as f:
+		config = json.load(f)
+	config['base_path'] = str(path.parent)
+	return config
+
+
+def build_pipeline(config):
+	"""
+	Declares the integration of NAD concentrations into context models of several cell lines as a Pipeline.
+	Stages are the model, the EC mappings, the Kms, the expression mapped onto reactions, one GIMME model per cell line,
+	one create_models_fva model per cell line and condition, FBA/pFBA/FVA of every model and the export to a ResultStore
+	and its CSV view.
+	:param config: Dictionary, e.g. as read by load_config, with
+		'model': {'path', 'objective', optional 'name' (defaults to 'mitocore') and 'solver'},
+		'kms': {'source' ('brenda', 'sabiork' or 'store'), 'path' (query folder or Km store)},
+		'expression': {'path'} of a CSV of expression values indexed by gene ID,
+		'cell_lines': dictionary of cell line names to expression columns,
+		'gimme': optional {'fraction' (0.8), 'threshold' (see gimme_threshold), 'solver'},
+		'concentrations': {'reference': compartments to [NAD], 'conditions': names to compartments to [NAD]},
+		'integration': optional {'obj_frac' (0.8), 'decision' ('min'), 'id_type' ('ec'), 'preference'},
+		'fva_frac': optional fraction of the optimum for the FVA of the results (0.8),
+		'artifacts': folder of the artefacts, 'output': folder of the exported CSV files,
+		'store': optional folder of the ResultStore (defaults to 'store' in the output folder),
+		'subsystems': optional CSV of reaction subsystems, see read_subsystems,
+		and optionally 'base_path', the folder relative paths are resolved against.
+	:return: Pipeline.
+	"""
+	base = Path(config.get('base_path', '.'))
+	model = config['model']
+	name = model.get('name', 'mitocore')
+	kms = config['kms']
+	gimme_config = config.get('gimme', {})
+	integration = config.get('integration', {})
+	concentrations = config['concentrations']
+	cell_lines = config['cell_lines']
+
+	stages = [
+		Stage('model', _stage_model, {'objective': model['objective'], 'solver': model.get('solver')},
+			files={'path': base / model['path']}),
+		Stage('mappings', _stage_mappings, files={'path': base / model['path']}),
+		Stage('kms', _stage_kms, {'source': kms['source']}, files={'path': base / kms['path']}),
+		Stage('expression', _stage_expression, {'columns': list(cell_lines.values())}, ['model'],
+			files={'path': base / config['expression']['path']}),
+	]
+	tags = [name]
+	solved = [_solve_stage(name, 'model', config)]
+	for cell_line, column in cell_lines.items():
+		stages.append(Stage(f'gimme:{cell_line}', _stage_gimme, {
+			'name': cell_line,
+			'column': column,
+			'fraction': gimme_config.get('fraction', .8),
+			'threshold': gimme_config.get('threshold'),
+			'solver': gimme_config.get('solver'),
+		}, ['model', 'expression']))
+		tags.append(cell_line)
+		solved.append(_solve_stage(cell_line, f'gimme:{cell_line}', config))
+		for condition, c_new in concentrations['conditions'].items():
+			tag = f'{cell_line} + {condition}'
+			stages.append(Stage(f'integrate:{tag}', _stage_integrate, {
+				'name': tag,
+				'c_old': concentrations['reference'],
+				'c_new': c_new,
+				'obj_frac': integration.get('obj_frac', .8),
+				'decision': integration.get('decision', 'min'),
+				'id_type': integration.get('id_type', 'ec'),
+				'preference': integration.get('preference'),
+			}, [f'gimme:{cell_line}', 'mappings', 'kms']))
+			tags.append(tag)
+			solved.append(_solve_stage(tag, f'integrate:{tag}', config))
+	stages.extend(solved)
+	output = base / config['output']
+	store = base / config['store'] if 'store' in config else output / 'store'
+	files = {'subsystems': base / config['subsystems']} if 'subsystems' in config else {}
+	params = {'tags': tags, 'output': str(output), 'store': str(store), 'subsystems': None}
+	outputs = [output / 'objective.csv'] + [output / f for f in EXPORTS.values()] + [store]
+	stages.append(Stage('export', _stage_export, params, [stage.name for stage in solved], files=files, outputs=outputs))
+	return Pipeline(stages, base / config['artifacts'])
+
+
+def run_pipeline(config, targets=None, n_jobs=1, executor=None, force=()):
+	"""
+	Builds and runs the pipeline of a configuration, see build_pipeline and Pipeline.run.
+	:param config: Path to a JSON configuration or dictionary.
+	:param targets: Names of the stages to return. Defaults to 'export'.
+	:param n_jobs: Number of worker processes. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param force: Names of stages to run even if their artefact is stored.
+	:return: Dictionary of target names to artefacts. The export's artefact is a dictionary of the exported dataframes,
+		see ResultStore.to_csv.
+	"""
+	if not isinstance(config, dict):
+		config = load_config(config)
+	return build_pipeline(config).run(targets, n_jobs, executor, force)
+
+
+def _solve_stage(tag, dependency, config):
+	"""
+	:param tag: Name of the model in the results.
+	:param dependency: Stage providing the model.
+	:param config: Pipeline configuration.
+	:return: Stage solving the model.
+	"""
+	return Stage(f'solve:{tag}', _stage_solve, {'fva_frac': config.get('fva_frac', .8)}, [dependency])
+
+
+def _stage_model(params):
+	"""
+	:return: Model with the configured objective and solver.
+	"""
+	model = load_model(params['path'])
+	model.objective = params['objective']
+	if params['solver']:
+		model.solver = params['solver']
+	return model
+
+
+def _stage_mappings(params):
+	"""
+	:return: Dictionary of reactions involving NAD to ECs.
+	"""
+	return create_mappings_ec_mitocore_from_xml(params['path'])
+
+
+def _stage_kms(params):
+	"""
+	:return: Dataframe of positive Kms.
+	"""
+	source = params['source']
+	if source == 'store':
+		kms = read_km_store(params['path'])
+	elif source in ('brenda', 'sabiork'):
+		files = _visible(sorted(Path(params['path']).iterdir()))
+		kms = read_brenda(files) if source == 'brenda' else read_sabiork(files)
+	else:
+		raise ValueError(f'Unknown Km source {source!r}. Use "brenda", "sabiork" or "store".')
+	return kms[kms.value > 0.]
+
+
+def _stage_expression(params, model):
+	"""
+	:return: Dataframe of the cell lines' expression mapped onto the model's reactions.
+	"""
+	expression = pd.read_csv(params['path'], index_col=0)
+	return map_expression(model, expression[params['columns']])
+
+
+def _stage_gimme(params, model, expression):
+	"""
+	:return: GIMME model of one cell line.
+	"""
+	# one threshold for all cell lines, as in integration_gimme.m
+	threshold = params['threshold']
+	if threshold is None:
+		threshold = gimme_threshold(expression)
+	family = gimme(model, expression[[params['column']]], [params['fraction']], threshold, solver=params['solver'], tag='{condition}')
+	context = family.to_model(params['column'])
+	context.id = params['name']
+	return context
+
+
+def _stage_integrate(params, model, mappings, kms):
+	"""
+	:return: Model of one cell line with the bounds of one NAD condition, see create_models_fva.
+	"""
+	context = create_models_fva(model, mappings, kms, params['c_old'], params['c_new'], params['id_type'], params['decision'],
+		params['preference'], obj_frac=params['obj_frac'])
+	context.id = params['name']
+	return context
+
+
+def _stage_solve(params, model):
+	"""
+	:return: Dictionary of the FBA objective and shadow prices, pFBA fluxes, FVA ranges and bounds of a model.
+	"""
+	sol = model.optimize()
+	sol_pfba = cobra.flux_analysis.pfba(model)
+	sol_fva = cobra.flux_analysis.flux_variability_analysis(model, fraction_of_optimum=params['fva_frac'])
+	return {
+		'objective': sol.objective_value,
+		'shadow_prices': sol.shadow_prices,
+		'fluxes': sol_pfba.fluxes,
+		'minimum': sol_fva.minimum,
+		'maximum': sol_fva.maximum,
+		'lower_bound': pd.Series({r.id: r.lower_bound for r in model.reactions}),
+		'upper_bound': pd.Series({r.id: r.upper_bound for r in model.reactions}),
+	}
+
+
+def _stage_export(params, *solutions):
+	"""
+	Writes the results of all models to a ResultStore, replacing its previous conditions, and the store as CSV files with
+	one column per model.
+	:return: Dictionary of the exported dataframes.
+	"""
+	subsystems = None
+	if params['subsystems'] is not None:
+		subsystems = {r: s.strip() for r, s in read_subsystems(params['subsystems']).items()}
+	store = ResultStore(params['store'])
+	for condition in store.conditions:
+		if condition not in params['tags']:
+			store.remove(condition)
+	for tag, solution in zip(params['tags'], solutions):
+		store.append(tag, solution, subsystems, overwrite=True)
+	return store.to_csv(params['output'], params['tags'])
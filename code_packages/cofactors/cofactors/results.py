@@ -0,0 +1,275 @@
+import hashlib
+import json
+import os
+import tempfile
+import numpy as np
+import pandas as pd
+from pathlib import Path
+
+try:
+	import pyarrow as pa
+	import pyarrow.parquet as pq
+except ImportError:
+	pa = None
+	pq = None
+
+STORE_FORMAT = 1
+MANIFEST = 'store.json'
+REACTION_QUANTITIES = ('fluxes', 'minimum', 'maximum', 'lower_bound', 'upper_bound')
+METABOLITE_QUANTITIES = ('shadow_prices',)
+# CSV files of the quantities, as written by integration_nad.ipynb
+EXPORTS = {
+	'fluxes': 'fluxes_pfba.csv',
+	'shadow_prices': 'shadow_prices.csv',
+	'minimum': 'fluxes_fva_lower.csv',
+	'maximum': 'fluxes_fva_upper.csv',
+	'lower_bound': 'lower_bounds.csv',
+	'upper_bound': 'upper_bounds.csv',
+}
+COMPRESSION = 'zstd'
+
+
+def _require_pyarrow():
+	if pq is None:
+		raise ImportError('The result store requires pyarrow. Install it with "pip install pyarrow".')
+
+
+class ResultStore:
+	"""
+	Results of several models or conditions as one cube of reactions/metabolites x conditions x quantities.
+	Every condition is one compressed Parquet file per table, reactions (pFBA fluxes, FVA ranges, bounds) and metabolites
+	(shadow prices), named in a JSON manifest next to them. Reactions are written as one row group per subsystem, so
+	reads filtered by subsystem or condition only touch the matching files and row groups. Conditions can be added or
+	replaced without rewriting the others.
+	"""
+
+	def __init__(self, path):
+		"""
+		:param path: Folder of the store. Created if missing.
+		"""
+		_require_pyarrow()
+		self.path = Path(path)
+		self.path.mkdir(parents=True, exist_ok=True)
+		manifest = self.path / MANIFEST
+		if manifest.exists():
+			with open(manifest) as f:
+				self._manifest = json.load(f)
+			if self._manifest.get('format') != STORE_FORMAT:
+				raise ValueError(f'{self.path} is not a result store of format {STORE_FORMAT}.')
+		else:
+			self._manifest = {'format': STORE_FORMAT, 'conditions': {}}
+
+	@property
+	def conditions(self):
+		"""
+		Names of the stored conditions, in the order they were added.
+		"""
+		return list(self._manifest['conditions'])
+
+	def __len__(self):
+		return len(self._manifest['conditions'])
+
+	def __contains__(self, condition):
+		return condition in self._manifest['conditions']
+
+	def __repr__(self):
+		return f'<ResultStore {str(self.path)!r} with {len(self)} conditions>'
+
+	def append(self, condition, results, subsystems=None, overwrite=False):
+		"""
+		Adds the results of one condition.
+		:param condition: Name of the condition, e.g. '293 + low NAD'.
+		:param results: Dictionary of quantities to Series indexed by reaction or metabolite ID: 'fluxes', 'minimum',
+			'maximum', 'lower_bound', 'upper_bound' and 'shadow_prices'. Missing quantities are stored as NaN. An
+			'objective' value is kept in the manifest.
+		:param subsystems: Dictionary of reaction IDs to subsystems, see read_subsystems.
+		:param overwrite: Replace the condition if it is already stored. Otherwise that raises a ValueError.
+		"""
+		if condition in self and not overwrite:
+			raise ValueError(f'Condition {condition!r} is already stored, pass overwrite=True to replace it.')
+		unknown = set(results) - set(REACTION_QUANTITIES) - set(METABOLITE_QUANTITIES) - {'objective'}
+		if unknown:
+			raise ValueError(f'Unknown quantities {sorted(unknown)}.')
+		stem = hashlib.sha256(condition.encode()).hexdigest()[:16]
+
+		reactions = _frame(results, REACTION_QUANTITIES, 'reaction')
+		subsystems = subsystems or {}
+		reactions.insert(1, 'subsystem', reactions['reaction'].map(lambda r: subsystems.get(r)).astype(object))
+		reactions = reactions.sort_values(['subsystem', 'reaction'], na_position='last', kind='stable')
+		metabolites = _frame(results, METABOLITE_QUANTITIES, 'metabolite')
+		for table, frame in (('reactions', reactions), ('metabolites', metabolites)):
+			frame.insert(0, 'condition', condition)
+			_write(self.path / table / f'{stem}.parquet', frame, 'subsystem' if table == 'reactions' else None)
+
+		objective = results.get('objective')
+		self._manifest['conditions'][condition] = {
+			'file': f'{stem}.parquet',
+			'objective': None if objective is None or np.isnan(objective) else float(objective),
+		}
+		self._save()
+
+	def remove(self, condition):
+		"""
+		Deletes the results of one condition.
+		:param condition: Name of the condition.
+		"""
+		entry = self._manifest['conditions'].pop(condition)
+		self._save()
+		for table in ('reactions', 'metabolites'):
+			(self.path / table / entry['file']).unlink(missing_ok=True)
+
+	def objective(self, conditions=None):
+		"""
+		:param conditions: Conditions to return. Defaults to all.
+		:return: Series of the objective values of the conditions, NaN where none was stored.
+		"""
+		conditions = self._conditions(conditions)
+		values = [self._manifest['conditions'][c]['objective'] for c in conditions]
+		return pd.Series(values, index=conditions, name='objective', dtype=float)
+
+	def cube(self, quantities=None, conditions=None, subsystems=None):
+		"""
+		Loads part of the cube in long format. Only the files of the requested conditions, the columns of the requested
+		quantities and, for reactions, the row groups of the requested subsystems are read.
+		:param quantities: Quantities to load, either all of reactions or all of metabolites. Defaults to all reaction
+			quantities.
+		:param conditions: Conditions to load. Defaults to all.
+		:param subsystems: Subsystems of the reactions to load. Defaults to all.
+		:return: Dataframe indexed by condition and reaction (with a categorical 'subsystem' column) or metabolite, one
+			column per quantity.
+		"""
+		quantities = list(REACTION_QUANTITIES if quantities is None else quantities)
+		if set(quantities) <= set(REACTION_QUANTITIES):
+			table, key, extra = 'reactions', 'reaction', ['subsystem']
+		elif set(quantities) <= set(METABOLITE_QUANTITIES):
+			if subsystems is not None:
+				raise ValueError('Metabolites have no subsystems.')
+			table, key, extra = 'metabolites', 'metabolite', []
+		else:
+			raise ValueError(f'Quantities need to be all of {REACTION_QUANTITIES} or all of {METABOLITE_QUANTITIES}.')
+		conditions = self._conditions(conditions)
+		columns = ['condition', key] + extra + quantities
+		if not conditions:
+			return pd.DataFrame(columns=columns).set_index(['condition', key])
+
+		files = [str(self.path / table / self._manifest['conditions'][c]['file']) for c in conditions]
+		filters = [('subsystem', 'in', list(subsystems))] if subsystems is not None else None
+		frame = pq.read_table(files, columns=columns, filters=filters, memory_map=True).to_pandas()
+		frame['condition'] = pd.Categorical(frame['condition'], categories=conditions)
+		if extra:
+			frame['subsystem'] = frame['subsystem'].astype('category')
+		return frame.set_index(['condition', key])
+
+	def read(self, quantity, conditions=None, subsystems=None, subsystem_column=False):
+		"""
+		Loads one quantity in the layout of the CSV files, one column per condition.
+		:param quantity: Quantity to load, e.g. 'fluxes' or 'shadow_prices'.
+		:param conditions: Conditions to load. Defaults to all.
+		:param subsystems: Subsystems of the reactions to load. Defaults to all.
+		:param subsystem_column: Add a 'subsystem' column and sort the reactions by it.
+		:return: Dataframe indexed by reaction or metabolite ID. Reactions missing in a condition, like those removed
+			from a context model, are NaN.
+		"""
+		conditions = self._conditions(conditions)
+		cube = self.cube([quantity], conditions, subsystems)
+		key = cube.index.names[1]
+		wide = cube[quantity].unstack('condition').reindex(columns=conditions)
+		wide.columns = list(wide.columns)
+		wide.index.name = None
+		if subsystem_column and key == 'reaction':
+			names = cube['subsystem'].astype(object).groupby(level=key).first()
+			wide['subsystem'] = names.reindex(wide.index)
+			wide = wide.sort_values('subsystem', kind='stable')
+		else:
+			wide = wide.sort_index()
+		return wide
+
+	def to_csv(self, path, conditions=None, fill_value=None):
+		"""
+		Writes the stored results as the CSV files of integration_nad.ipynb, one per quantity, and objective.csv.
+		Reaction quantities get a 'subsystem' column and are sorted by it.
+		:param path: Folder to write to. Created if missing.
+		:param conditions: Conditions to write. Defaults to all.
+		:param fill_value: Value of reactions missing in a condition. Defaults to leaving them empty.
+		:return: Dictionary of quantities and 'objective' to the written dataframes.
+		"""
+		path = Path(path)
+		path.mkdir(parents=True, exist_ok=True)
+		tables = {'objective': self.objective(conditions)}
+		tables['objective'].to_csv(path / 'objective.csv')
+		for quantity, file in EXPORTS.items():
+			table = self.read(quantity, conditions, subsystem_column=quantity in REACTION_QUANTITIES)
+			if fill_value is not None:
+				values = table.columns.drop('subsystem', errors='ignore')
+				table[values] = table[values].fillna(fill_value)
+			table.to_csv(path / file)
+			tables[quantity] = table
+		return tables
+
+	def _conditions(self, conditions):
+		if conditions is None:
+			return self.conditions
+		conditions = list(conditions)
+		missing = [c for c in conditions if c not in self]
+		if missing:
+			raise KeyError(f'Conditions {missing} are not stored.')
+		return conditions
+
+	def _save(self):
+		"""
+		Replaces the manifest atomically.
+		"""
+		fd, tmp = tempfile.mkstemp(suffix='.json', dir=self.path)
+		try:
+			with os.fdopen(fd, 'w') as f:
+				json.dump(self._manifest, f, indent=1)
+			os.replace(tmp, self.path / MANIFEST)
+		except BaseException:
+			os.unlink(tmp)
+			raise
+
+
+def _frame(results, quantities, key):
+	"""
+	:param results: Dictionary of quantities to Series.
+	:param quantities: Quantities of one table.
+	:param key: Name of the ID column.
+	:return: Dataframe with the IDs and one float column per quantity, NaN where a quantity is missing.
+	"""
+	series = {q: pd.Series(results[q], dtype=float) for q in quantities if q in results}
+	index = pd.Index([], dtype=object)
+	for s in series.values():
+		index = index.union(s.index, sort=False)
+	frame = pd.DataFrame({q: series[q].reindex(index) if q in series else np.nan for q in quantities}, index=index, dtype=float)
+	frame.index = frame.index.astype(str)
+	return frame.rename_axis(key).reset_index()
+
+
+def _write(file, frame, group_by=None):
+	"""
+	Writes a dataframe as Parquet file atomically.
+	:param file: Path of the file.
+	:param frame: Dataframe, sorted by group_by if given.
+	:param group_by: Column to write one row group per value of, rows without value go into a last row group. Defaults to
+		a single row group.
+	"""
+	file.parent.mkdir(parents=True, exist_ok=True)
+	# IDs, subsystems and conditions as strings even if all missing, so the files of all conditions share one schema
+	schema = pa.schema([(c, pa.string() if frame[c].dtype == object else pa.float64()) for c in frame.columns])
+	table = pa.Table.from_pandas(frame, schema=schema, preserve_index=False)
+	fd, tmp = tempfile.mkstemp(suffix='.parquet', dir=file.parent)
+	os.close(fd)
+	try:
+		if group_by is None:
+			bounds = [0, len(frame)]
+		else:
+			# row groups start where the value of the sorted column changes
+			values = frame[group_by].fillna('').to_numpy()
+			bounds = [0] + [i for i in range(1, len(values)) if values[i] != values[i - 1]] + [len(frame)]
+		with pq.ParquetWriter(tmp, schema, compression=COMPRESSION) as writer:
+			for start, stop in zip(bounds[:-1], bounds[1:]):
+				writer.write_table(table.slice(start, stop - start))
+		os.replace(tmp, file)
+	except BaseException:
+		os.unlink(tmp)
+		raise
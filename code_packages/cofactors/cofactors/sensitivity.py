@@ -0,0 +1,92 @@
+import numpy as np
+import pandas as pd
+from cofactors.integration import create_models, create_models_fva, create_models_bounds, _cold_start, _plan
+
+# distance, relative to the bound, up to which a flux counts as sitting on it
+ACTIVE_TOLERANCE = 1e-9
+
+METHODS = {
+	'fva': create_models_fva,
+	'pfba': create_models,
+	'bounds': create_models_bounds,
+}
+
+
+def sensitivity(model, mappings, kms, c_old_dict, c_new_dict, id_type='ec', decision=min, preference=None, obj_frac=.9, method='fva', plan=None, fva_ranges=None):
+	"""
+	Local derivatives of the optimal objective of an integrated model with respect to the new concentrations and the Kms,
+	from a single FBA.
+	Each adjusted reaction's bounds are its reference values times the Michaelis-Menten factor
+	g = c'/(Km+c') * (Km+c)/c. Where a flux sits on such a bound, the reduced cost of the variable it bounds is the
+	derivative of the objective with respect to that bound. Chaining it with the bound's derivative with respect to g and
+	dg/dc' = Km/(Km+c')^2 * (Km+c)/c and dg/dKm = c'(c'-c)/(c(Km+c')^2) gives the sensitivities. Derivatives are one-sided
+	where the LP is degenerate, and only hold as long as the same bounds stay active, so this is meant for screening before
+	running scans.
+	:param model: Model object to be used.
+	:param mappings: Mappings of reactions to ECs or Uniprot IDs.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex replacing mappings, kms, id_type, decision and
+		preference.
+	:param c_old_dict: Dictionary of compartment to [NAD].
+	:param c_new_dict: Dictionary of compartment to [NAD] the derivatives are taken at.
+	:param id_type: Identifier to use. 'ec' or 'up'.
+	:param decision: How to decide between multiple KMs. Defaults to min (picking minimal Km).
+	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
+	:param obj_frac: Fraction of optimal objective flux retained by the FVA based integration.
+	:param method: Integration the bounds come from: 'fva' (create_models_fva), 'pfba' (create_models) or 'bounds'
+		(create_models_bounds). Defaults to 'fva'.
+	:param plan: AdjustmentPlan of the model to reuse, replacing mappings, kms, id_type, decision and preference.
+	:param fva_ranges: Precomputed FVA of the model, see create_models_fva.
+	:return: Dictionary with the 'objective' value, 'concentrations', a Series of d(objective)/dc' per compartment, and
+		'reactions', a dataframe of the adjusted reactions with their 'km', 'compartment', 'flux', new 'lower_bound' and
+		'upper_bound', the 'reduced_cost' of the active bound, i.e. d(objective)/d(bound), the 'active' bound ('lower',
+		'upper' or ''), d(objective)/dg as 'd_factor', d(objective)/dc' of the reaction's compartment through this
+		reaction as 'd_concentration' and d(objective)/dKm as 'd_km'.
+	"""
+	try:
+		create = METHODS[method]
+	except KeyError:
+		raise ValueError(f'Unknown method {method!r}. Use one of {sorted(METHODS)}.')
+	plan = _plan(model, plan, mappings, kms, id_type, decision, preference)
+	kwargs = {'obj_frac': obj_frac, 'fva_ranges': fva_ranges} if method == 'fva' else {}
+	variant = create(model, None, None, c_old_dict, c_new_dict, as_variant=True, plan=plan, **kwargs)
+	with variant.applied() as model_new:
+		_cold_start(model_new)
+		sol = model_new.optimize(raise_error=True)
+		# cobra's reduced costs are forward minus reverse variable duals, which counts a bound twice
+		reactions = model_new.reactions
+		forward_duals = np.array([reactions[i].forward_variable.dual for i in plan.indices], dtype=float)
+		reverse_duals = np.array([reactions[i].reverse_variable.dual for i in plan.indices], dtype=float)
+
+	km, c_old, c_new = plan._saturation_inputs(c_old_dict, c_new_dict)
+	factors = plan.factors(c_old_dict, c_new_dict)
+	lower = variant.lower
+	upper = variant.upper
+	flux = sol.fluxes.to_numpy()[plan.indices]
+	at_lower = np.abs(flux - lower) <= ACTIVE_TOLERANCE * np.maximum(1., np.abs(lower))
+	at_upper = np.abs(flux - upper) <= ACTIVE_TOLERANCE * np.maximum(1., np.abs(upper))
+	# bounds are reference values times g unless clipped to 0, so their derivative by g is bound / g
+	with np.errstate(divide='ignore', invalid='ignore'):
+		d_lower = np.where(lower < 0, lower / factors, 0.)
+		d_upper = np.where(upper > 0, upper / factors, 0.)
+	# the upper bound of a reaction bounds its forward variable, the lower one its reverse variable from above;
+	# a flux on both bounds means they coincide, and then they move together
+	reduced_costs = np.where(at_upper & (upper > 0), forward_duals, np.where(at_lower & (lower < 0), -reverse_duals, 0.))
+	d_factor = reduced_costs * np.where(at_upper & (upper > 0), d_upper, d_lower)
+	d_concentration = d_factor * km / (km + c_new)**2 * (km + c_old) / c_old
+	d_km = d_factor * c_new * (c_new - c_old) / (c_old * (km + c_new)**2)
+
+	reactions = pd.DataFrame({
+		'km': km,
+		'compartment': plan.compartments,
+		'flux': flux,
+		'lower_bound': lower,
+		'upper_bound': upper,
+		'reduced_cost': reduced_costs,
+		'active': np.where(at_upper & (upper > 0), 'upper', np.where(at_lower & (lower < 0), 'lower', '')),
+		'd_factor': d_factor,
+		'd_concentration': d_concentration,
+		'd_km': d_km,
+	}, index=pd.Index(plan.reaction_ids, name='reaction'))
+	concentrations = reactions.groupby('compartment')['d_concentration'].sum()
+	concentrations = concentrations.reindex(list(c_new_dict), fill_value=0.)
+	return {'objective': sol.objective_value, 'concentrations': concentrations, 'reactions': reactions}
@@ -0,0 +1,165 @@
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+from cobra.exceptions import OptimizationError
+from cofactors.integration import _plan, _reference_solution, _n_jobs
+from cofactors.lp import PersistentLP
+
+DISTRIBUTIONS = ('empirical', 'lognormal')
+
+
+def sample_kms(km_index, reaction_ids, n_samples, distribution='empirical', seed=None):
+	"""
+	Draws Kms per reaction from the values a KmIndex collected for it, instead of collapsing them with a decision.
+	:param km_index: KmIndex.
+	:param reaction_ids: Reactions to draw Kms for. All need Kms in the index.
+	:param n_samples: Number of draws.
+	:param distribution: 'empirical' picks one of the reaction's Kms uniformly, 'lognormal' draws from a log-normal
+		distribution fitted to them. Reactions with a single Km always get that Km.
+	:param seed: Seed or numpy Generator, for reproducible draws.
+	:return: Array of draws x reactions.
+	"""
+	if distribution not in DISTRIBUTIONS:
+		raise ValueError(f'Unknown distribution {distribution!r}. Use one of {DISTRIBUTIONS}.')
+	rng = np.random.default_rng(seed)
+	values = [np.asarray(km_index.values(r), dtype=float) for r in reaction_ids]
+	counts = np.array([len(v) for v in values])
+	if (counts == 0).any():
+		raise ValueError(f'No Kms known for reaction {reaction_ids[int(np.argmin(counts))]}.')
+	if distribution == 'empirical':
+		flat = np.concatenate(values)
+		offsets = np.concatenate([[0], np.cumsum(counts)[:-1]])
+		picks = offsets + (rng.random((n_samples, len(values))) * counts).astype(int)
+		return flat[picks]
+	if any((v <= 0).any() for v in values):
+		raise ValueError('Log-normal distributions need positive Kms.')
+	mu = np.array([np.log(v).mean() for v in values])
+	sigma = np.array([np.log(v).std() for v in values])
+	return np.exp(mu + sigma * rng.standard_normal((n_samples, len(values))))
+
+
+def monte_carlo(model, mappings, kms, c_old_dict, conditions, n_samples=1000, distribution='empirical', seed=0, id_type='ec', decision=min, preference=None, method='fva', obj_frac=.9, fluxes=True, solver=None, n_jobs=1, executor=None, plan=None, fva_ranges=None):
+	"""
+	Propagates the uncertainty of Kms to the integrated models by Monte Carlo sampling.
+	Kms are drawn once per reaction and draw (see sample_kms) and shared by all conditions. The rescaled bounds of all draws
+	are computed as one array and evaluated on a persistent, warm-started LP, one per worker process. Draws are made
+	before splitting the work, so results only depend on the seed.
+	:param model: Model object to be used.
+	:param mappings: Mappings of reactions to ECs or Uniprot IDs.
+	:param kms: Dataframe containing SabioRK or Brenda data, or a KmIndex replacing mappings, kms, id_type, decision and preference.
+	:param c_old_dict: Dictionary of compartment to [NAD].
+	:param conditions: Dictionary of condition names to dictionaries of compartment to new [NAD].
+	:param n_samples: Number of draws. Defaults to 1000.
+	:param distribution: 'empirical' or 'lognormal', see sample_kms.
+	:param seed: Seed of the draws. Defaults to 0.
+	:param id_type: Identifier to use. 'ec' or 'up'.
+	:param decision: Decision of the KmIndex. Only decides which reactions are adjusted, the Kms are sampled.
+	:param preference: List of scientific species names. How to rank the different species. First one is most preferred.
+	:param method: Reference the bounds are rescaled from: 'fva' (as create_models_fva), 'pfba' (as create_models) or
+		'bounds' (as create_models_bounds). Defaults to 'fva'.
+	:param obj_frac: Fraction of optimal objective flux retained by the FVA based integration.
+	:param fluxes: Also return pFBA fluxes of every draw. Defaults to True.
+	:param solver: Solver of the LP, see PersistentLP.
+	:param n_jobs: Number of worker processes. 1 runs serially, -1 uses all cores.
+	:param executor: Optional process based executor to run on instead of a new process pool.
+	:param plan: AdjustmentPlan of the model to reuse, replacing mappings, kms, id_type, decision and preference.
+	:param fva_ranges: Precomputed FVA of the model, see create_models_fva.
+	:return: Dictionary with the sampled 'kms' (dataframe of draws x adjusted reactions), the FBA 'objective' of every
+		draw (dataframe of draws x conditions, NaN if infeasible) and, if requested, the pFBA 'fluxes' (dictionary of
+		conditions to dataframes of draws x reactions).
+	"""
+	plan = _plan(model, plan, mappings, kms, id_type, decision, preference)
+	low, high = _reference_values(model, plan, method, obj_frac, fva_ranges)
+	km = sample_kms(plan.km_index, plan.reaction_ids, n_samples, distribution, seed)
+	c_old = plan.concentrations(c_old_dict)
+	if (c_old == 0).any():
+		raise ZeroDivisionError('Old concentrations need to be non-zero.')
+
+	names = list(conditions)
+	lower = np.empty((len(names) * n_samples, len(plan)))
+	upper = np.empty_like(lower)
+	for j, name in enumerate(names):
+		c_new = plan.concentrations(conditions[name])
+		factors = (c_new / (km + c_new)) * ((km + c_old) / c_old)
+		rows = slice(j * n_samples, (j + 1) * n_samples)
+		lower[rows] = np.minimum(low * factors, 0)
+		upper[rows] = np.maximum(high * factors, 0)
+
+	n_jobs = _n_jobs(n_jobs, executor)
+	splits = np.array_split(np.arange(len(lower)), min(n_jobs, len(lower)))
+	chunks = [(model, solver, plan.indices, lower[i], upper[i], fluxes) for i in splits]
+	if n_jobs == 1 and executor is None:
+		parts = [_evaluate_bounds(chunk) for chunk in chunks]
+	else:
+		own_executor = executor is None
+		if own_executor:
+			executor = ProcessPoolExecutor(max_workers=len(chunks))
+		try:
+			parts = list(executor.map(_evaluate_bounds, chunks))
+		finally:
+			if own_executor:
+				executor.shutdown()
+	objectives = np.concatenate([p[0] for p in parts])
+	flux = np.concatenate([p[1] for p in parts]) if fluxes else None
+	draws = pd.RangeIndex(n_samples, name='draw')
+
+	results = {
+		'kms': pd.DataFrame(km, index=draws, columns=plan.reaction_ids),
+		'objective': pd.DataFrame(objectives.reshape(len(names), n_samples).T, index=draws, columns=names),
+	}
+	if fluxes:
+		reaction_ids = [r.id for r in model.reactions]
+		results['fluxes'] = {name: pd.DataFrame(flux[j * n_samples:(j + 1) * n_samples], index=draws, columns=reaction_ids)
+			for j, name in enumerate(names)}
+	return results
+
+
+def _reference_values(model, plan, method, obj_frac, fva_ranges):
+	"""
+	Reference values the bounds of the adjusted reactions are rescaled from.
+	:param model: Model object.
+	:param plan: AdjustmentPlan of the model.
+	:param method: 'fva', 'pfba' or 'bounds'.
+	:param obj_frac: Fraction of optimal objective flux retained by FVA.
+	:param fva_ranges: Precomputed FVA of the model or None, see create_models_fva.
+	:return: Tuple of arrays of lower and upper reference values, aligned with plan.reaction_ids.
+	"""
+	if method == 'fva':
+		if fva_ranges is None:
+			sol = _reference_solution(model, 'fva', obj_frac, plan.reaction_ids)
+		else:
+			sol = fva_ranges[obj_frac] if isinstance(fva_ranges, dict) else fva_ranges
+		return sol.loc[plan.reaction_ids, 'minimum'].to_numpy(), sol.loc[plan.reaction_ids, 'maximum'].to_numpy()
+	if method == 'pfba':
+		flux = _reference_solution(model, 'pfba')[plan.reaction_ids].to_numpy()
+		return flux, flux
+	if method == 'bounds':
+		reactions = model.reactions
+		return np.array([reactions[i].lower_bound for i in plan.indices], dtype=float), \
+			np.array([reactions[i].upper_bound for i in plan.indices], dtype=float)
+	raise ValueError(f'Unknown method {method!r}. Use "fva", "pfba" or "bounds".')
+
+
+def _evaluate_bounds(args):
+	"""
+	Solves one chunk of bound sets on a persistent LP.
+	:param args: Tuple of model, solver, reaction indices, arrays of lower and upper bounds (bound sets x indices) and
+		whether to compute pFBA fluxes.
+	:return: Tuple of the array of objective values and the array of fluxes (bound sets x reactions) or None.
+	"""
+	model, solver, indices, lower, upper, fluxes = args
+	lp = PersistentLP(model, solver)
+	objectives = np.full(len(lower), np.nan)
+	flux = np.full((len(lower), len(lp.reaction_ids)), np.nan) if fluxes else None
+	for k in range(len(lower)):
+		lp.set_bounds(indices, lower[k], upper[k])
+		try:
+			if fluxes:
+				sol, sol_p = lp.pfba()
+				flux[k] = sol_p.fluxes.to_numpy()
+			else:
+				sol = lp.optimize()
+		except OptimizationError:
+			continue
+		objectives[k] = sol.objective_value
+	return objectives, flux
@@ -0,0 +1,304 @@
+"""
+Tests of the SabioRK and Brenda downloads against local stand-ins: a threaded HTTP server for SabioRK's REST export and a
+stub SOAP client for Brenda.
+"""
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from types import SimpleNamespace
+from urllib.parse import parse_qs, urlparse
+
+import pytest
+import requests
+from zeep.exceptions import Fault, TransportError
+
+from cofactors.fetch import MANIFEST_NAME, Manifest, RateLimiter, _retry, brenda_fetch, sabio_fetch
+
+ORGANISMS = ['Homo sapiens', 'Mus musculus', 'Rattus norvegicus', 'Bos taurus', 'Sus scrofa']
+
+
+class SabioStub:
+    """
+    SabioRK stand-in. Answers every query with a TSV naming the queried organism, after a delay, unless a scripted
+    action for the organism comes first: an HTTP status code, or 'drop' to close the connection without answering.
+    """
+
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.actions = {}
+        self.requests = []
+        self.active = 0
+        self.max_active = 0
+        self._lock = threading.Lock()
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                query = parse_qs(urlparse(self.path).query)
+                organism = query['q'][0].split(':', 1)[1].strip('"')
+                with stub._lock:
+                    stub.requests.append((time.monotonic(), organism))
+                    action = stub.actions.get(organism, [])
+                    action = action.pop(0) if action else 200
+                    stub.active += 1
+                    stub.max_active = max(stub.max_active, stub.active)
+                try:
+                    time.sleep(stub.delay)
+                    if action == 'drop':
+                        self.close_connection = True
+                        return
+                    body = b'' if action != 200 else f'EntryID\tOrganism\n1\t{organism}\n'.encode()
+                    self.send_response(action)
+                    self.send_header('Content-Length', str(len(body)))
+                    self.end_headers()
+                    self.wfile.write(body)
+                finally:
+                    with stub._lock:
+                        stub.active -= 1
+
+            def log_message(self, *args):
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.url = f'http://127.0.0.1:{self.server.server_address[1]}/kineticlawsExportTsv'
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def queried(self, organism):
+        return sum(1 for _, o in self.requests if o == organism)
+
+    def close(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class BrendaStub:
+    """
+    Stand-in for a zeep client of Brenda's WSDL. getKmValue returns one Km entry for the queried organism and cofactor,
+    unless a scripted exception for the pair comes first or a scripted response replaces it.
+    """
+
+    def __init__(self, delay=0.):
+        self.delay = delay
+        self.actions = {}
+        self.responses = {}
+        self.calls = []
+        self._lock = threading.Lock()
+        self.service = SimpleNamespace(getKmValue=self._get_km_value)
+
+    def _get_km_value(self, email, password, ec, km, km_max, substrate, commentary, organism, ligand, literature):
+        organism = organism.split('*', 1)[1]
+        cofactor = substrate.split('*', 1)[1]
+        with self._lock:
+            self.calls.append((organism, cofactor))
+            action = self.actions.get((organism, cofactor), [])
+            action = action.pop(0) if action else None
+        time.sleep(self.delay)
+        if action is not None:
+            raise action
+        if (organism, cofactor) in self.responses:
+            return self.responses[(organism, cofactor)]
+        return [{
+            'kmValue': '0.1', 'literature': [1, 2], 'organism': organism, 'ecNumber': '1.1.1.1',
+            'substrate': cofactor, 'ligandStructureId': 7, 'commentary': None,
+        }]
+
+    def called(self, organism, cofactor):
+        return self.calls.count((organism, cofactor))
+
+
+@pytest.fixture
+def sabio():
+    stub = SabioStub()
+    yield stub
+    stub.close()
+
+
+def test_sabio_concurrent_results_in_order(tmp_path, sabio):
+    sabio.delay = .2
+    files = sabio_fetch(tmp_path, ORGANISMS, max_workers=5, url=sabio.url)
+    assert [f.name for f in files] == [f'sabiork_{o.replace(" ", "_")}.tsv' for o in ORGANISMS]
+    for organism, file in zip(ORGANISMS, files):
+        assert file.read_text().splitlines()[1] == f'1\t{organism}'
+    assert sabio.max_active > 1
+
+
+@pytest.mark.parametrize('failures', [[503], [429], [503, 429], ['drop']])
+def test_sabio_retries_transient_errors(tmp_path, sabio, failures):
+    sabio.actions['Homo sapiens'] = list(failures)
+    files = sabio_fetch(tmp_path, ['Homo sapiens'], retries=3, backoff=.01, url=sabio.url)
+    assert sabio.queried('Homo sapiens') == len(failures) + 1
+    assert files[0].read_text().splitlines()[1] == '1\tHomo sapiens'
+
+
+def test_sabio_gives_up_after_retries(tmp_path, sabio):
+    sabio.actions['Homo sapiens'] = [503] * 3
+    with pytest.raises(requests.HTTPError):
+        sabio_fetch(tmp_path, ['Homo sapiens'], retries=2, backoff=.01, url=sabio.url)
+    assert sabio.queried('Homo sapiens') == 3
+
+
+@pytest.mark.parametrize('status', [400, 401, 404])
+def test_sabio_no_retry_on_client_errors(tmp_path, sabio, status):
+    sabio.actions['Homo sapiens'] = [status]
+    with pytest.raises(requests.HTTPError):
+        sabio_fetch(tmp_path, ['Homo sapiens'], retries=3, backoff=.01, url=sabio.url)
+    assert sabio.queried('Homo sapiens') == 1
+    assert not (tmp_path / 'sabiork_Homo_sapiens.tsv').exists()
+
+
+def test_sabio_rate_limit_spacing(tmp_path, sabio):
+    rate = 20.
+    sabio_fetch(tmp_path, ORGANISMS, max_workers=5, rate=rate, url=sabio.url)
+    starts = sorted(t for t, _ in sabio.requests)
+    assert len(starts) == len(ORGANISMS)
+    # requests leave the client 1 / rate apart, arrival can jitter slightly
+    assert min(b - a for a, b in zip(starts, starts[1:])) >= .5 / rate
+    assert starts[-1] - starts[0] >= (len(starts) - 1) * .9 / rate
+
+
+def test_sabio_resumes_interrupted_run(tmp_path, sabio):
+    sabio.actions['Rattus norvegicus'] = [400]
+    with pytest.raises(requests.HTTPError):
+        sabio_fetch(tmp_path, ORGANISMS, max_workers=1, url=sabio.url, max_age=3600)
+    manifest = Manifest(tmp_path)
+    assert sorted(manifest.entries) == ['sabiork_Homo_sapiens.tsv', 'sabiork_Mus_musculus.tsv']
+
+    files = sabio_fetch(tmp_path, ORGANISMS, max_workers=1, url=sabio.url, max_age=3600)
+    assert [sabio.queried(o) for o in ORGANISMS] == [1, 1, 2, 1, 1]
+    assert all(f.exists() for f in files)
+    entries = json.loads((tmp_path / MANIFEST_NAME).read_text())
+    assert sorted(entries) == sorted(f.name for f in files)
+    assert all(e['rows'] == 1 for e in entries.values())
+
+    # nothing left to fetch, unless the recorded queries are too old or their files changed
+    sabio_fetch(tmp_path, ORGANISMS, url=sabio.url, max_age=3600)
+    assert len(sabio.requests) == 6
+    files[0].write_text('truncated')
+    sabio_fetch(tmp_path, ORGANISMS, url=sabio.url, max_age=3600)
+    assert len(sabio.requests) == 7 and sabio.queried('Homo sapiens') == 2
+    sabio_fetch(tmp_path, ORGANISMS, url=sabio.url, max_age=None)
+    assert len(sabio.requests) == 12
+
+
+def test_sabio_refetches_same_size_corruption(tmp_path, sabio):
+    files = sabio_fetch(tmp_path, ['Homo sapiens'], url=sabio.url, max_age=3600)
+    text = files[0].read_text()
+    files[0].write_text(text.swapcase())
+    assert files[0].stat().st_size == len(text)
+    manifest = Manifest(tmp_path)
+    assert not manifest.is_fresh(files[0], manifest.entries[files[0].name]['params'], 3600)
+    sabio_fetch(tmp_path, ['Homo sapiens'], url=sabio.url, max_age=3600)
+    assert sabio.queried('Homo sapiens') == 2
+    assert files[0].read_text() == text
+
+
+def brenda(tmp_path, client, organisms, cofactors, **kwargs):
+    return brenda_fetch(organisms, cofactors, tmp_path, email='user@example.org', password='secret', client=client, **kwargs)
+
+
+def test_brenda_concurrent_results_in_order(tmp_path):
+    client = BrendaStub(delay=.1)
+    cofactors = ['NAD+', 'NADH']
+    files = brenda(tmp_path, client, ORGANISMS[:3], cofactors, max_workers=6)
+    queries = [(o, c) for o in ORGANISMS[:3] for c in cofactors]
+    assert [f.name for f in files] == [f'{c.lower()}_{o.replace(" ", "_")}_brenda.tsv' for o, c in queries]
+    for (organism, cofactor), file in zip(queries, files):
+        assert file.read_text() == f'1.1.1.1\t0.1\t{cofactor}\t\t{organism}\t7\t1,2'
+    assert sorted(client.calls) == sorted(queries)
+
+
+@pytest.mark.parametrize('error', [
+    TransportError(status_code=503), TransportError(status_code=429), requests.ConnectionError('reset')])
+def test_brenda_retries_transient_errors(tmp_path, error):
+    client = BrendaStub()
+    client.actions[('Homo sapiens', 'NAD+')] = [error, error]
+    files = brenda(tmp_path, client, ['Homo sapiens'], ['NAD+'], retries=3, backoff=.01)
+    assert client.called('Homo sapiens', 'NAD+') == 3
+    assert files[0].exists()
+
+
+@pytest.mark.parametrize('error', [Fault('Invalid credentials'), TransportError(status_code=403)])
+def test_brenda_no_retry_on_faults(tmp_path, error):
+    client = BrendaStub()
+    client.actions[('Homo sapiens', 'NAD+')] = [error]
+    with pytest.raises(type(error)):
+        brenda(tmp_path, client, ['Homo sapiens'], ['NAD+'], retries=3, backoff=.01)
+    assert client.called('Homo sapiens', 'NAD+') == 1
+
+
+def test_brenda_resumes_interrupted_run(tmp_path):
+    client = BrendaStub()
+    client.actions[('Mus musculus', 'NADH')] = [Fault('Server busy')]
+    with pytest.raises(Fault):
+        brenda(tmp_path, client, ORGANISMS[:2], ['NAD+', 'NADH'], max_workers=1, max_age=3600)
+    client.calls.clear()
+    brenda(tmp_path, client, ORGANISMS[:2], ['NAD+', 'NADH'], max_workers=1, max_age=3600)
+    assert client.calls == [('Mus musculus', 'NADH')]
+
+
+@pytest.mark.parametrize('response', [[], None])
+def test_brenda_empty_result_is_not_recorded(tmp_path, response):
+    client = BrendaStub()
+    client.responses[('Mus musculus', 'NAD+')] = response
+    with pytest.raises(ValueError, match='Mus musculus and NAD\\+'):
+        brenda(tmp_path, client, ORGANISMS[:2], ['NAD+'], max_workers=1, max_age=3600)
+    assert client.called('Mus musculus', 'NAD+') == 1
+    assert not (tmp_path / 'nad+_Mus_musculus_brenda.tsv').exists()
+    assert sorted(Manifest(tmp_path).entries) == ['nad+_Homo_sapiens_brenda.tsv']
+
+
+def test_brenda_skips_login_when_up_to_date(tmp_path, monkeypatch):
+    client = BrendaStub()
+    brenda(tmp_path, client, ['Homo sapiens'], ['NAD+'], max_age=3600)
+    monkeypatch.setattr('builtins.input', lambda prompt: pytest.fail('asked for credentials'))
+    brenda_fetch(['Homo sapiens'], ['NAD+'], tmp_path, client=client, max_age=3600)
+    assert len(client.calls) == 1
+
+
+def test_rate_limiter_spacing():
+    rate = 50.
+    limiter = RateLimiter(rate)
+    starts = []
+    lock = threading.Lock()
+
+    def worker():
+        for _ in range(5):
+            limiter.wait()
+            with lock:
+                starts.append(time.monotonic())
+
+    threads = [threading.Thread(target=worker) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    starts.sort()
+    assert len(starts) == 20
+    # starts are scheduled 1 / rate apart, waking the threads up adds some jitter to single gaps
+    assert min(b - a for a, b in zip(starts, starts[1:])) >= .5 / rate
+    assert starts[-1] - starts[0] >= 19 * .95 / rate
+
+
+def test_rate_limiter_without_rate_does_not_wait():
+    limiter = RateLimiter(None)
+    start = time.monotonic()
+    for _ in range(100):
+        limiter.wait()
+    assert time.monotonic() - start < .1
+
+
+def test_retry_backoff_doubles(monkeypatch):
+    sleeps = []
+    monkeypatch.setattr('cofactors.fetch.time.sleep', sleeps.append)
+    attempts = []
+
+    def fail():
+        attempts.append(1)
+        raise requests.ConnectionError()
+
+    with pytest.raises(requests.ConnectionError):
+        _retry(fail, retries=3, backoff=.5)
+    assert len(attempts) == 4
+    assert sleeps == [.5, 1., 2.]
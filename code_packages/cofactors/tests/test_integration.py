@@ -0,0 +1,229 @@
+"""
+Tests of the concentration scans against the original copy-per-point integration, on the E. coli core model and on
+mitoCore with the Brenda Kms shipped in generated_data.
+"""
+import contextlib
+import io
+from copy import deepcopy
+from pathlib import Path
+
+import cobra
+import numpy as np
+import pytest
+from scipy.optimize import brentq
+
+from cofactors.integration import (
+    MIN_INTERVAL, ConcentrationScan, _AdaptiveGrid, _reference_cache, clear_reference_cache, create_models_fva, fva_fractions)
+from cofactors.kms import KmIndex
+from cofactors.mapping import create_mappings_ec_mitocore_from_xml, read_brenda
+
+# Kms (mM) of the core model's NAD(P) dependent reactions
+KMS = {
+    'GAPD': [0.045, 0.09],
+    'MDH': [0.06],
+    'ICDHyr': [0.012],
+    'AKGDH': [0.07],
+    'PDH': [0.055],
+    'G6PDH2r': [0.015],
+    'GND': [0.02],
+    'ME1': [0.1],
+    'ME2': [0.03],
+    'ALCD2x': [0.2],
+    'ACALD': [0.15],
+    'LDH_D': [0.25],
+    'NADTRHD': [0.05],
+}
+C_OLD = {'c': .11, 'e': .11}
+RATIOS = (.01, .05, .1, .2, .35, .5, .75, .98)
+
+
+@pytest.fixture(scope='module')
+def model():
+    model = cobra.io.load_model('textbook')
+    # the ATP maintenance demand cannot be met once the NAD dependent fluxes shrink
+    model.reactions.ATPM.lower_bound = 0
+    return model
+
+
+@pytest.fixture(scope='module')
+def km_index():
+    return KmIndex.from_values(KMS)
+
+
+@pytest.fixture(autouse=True)
+def fresh_references():
+    clear_reference_cache()
+    yield
+    clear_reference_cache()
+
+
+def baseline_point(model, km_index, c_old_dict, ratio):
+    """
+    One scan point as the original integration computed it: reference pFBA on a copy of the model, bounds rescaled on
+    that copy, then pFBA and FBA of it.
+    """
+    model_new = deepcopy(model)
+    sol = cobra.flux_analysis.parsimonious.pfba(model_new)
+    for rxn in model_new.reactions:
+        km = km_index.get(rxn.id)
+        if km is None:
+            continue
+        c_old = c_old_dict[sorted(rxn.compartments)[0]]
+        c_new = c_old * ratio
+        f_goal = sol.fluxes[rxn.id] * (c_new / (km + c_new)) * ((km + c_old) / c_old)
+        if f_goal > 0:
+            rxn.upper_bound = f_goal
+            rxn.lower_bound = 0
+        else:
+            rxn.upper_bound = 0
+            rxn.lower_bound = f_goal
+    sol_p = cobra.flux_analysis.parsimonious.pfba(model_new)
+    return sol_p.fluxes, sol_p.objective_value, model_new.optimize().objective_value
+
+
+@pytest.fixture(scope='module')
+def baseline(model, km_index):
+    points = [baseline_point(model, km_index, C_OLD, ratio) for ratio in RATIOS]
+    fluxes = np.vstack([p[0].to_numpy() for p in points])
+    return fluxes, np.array([p[1] for p in points]), np.array([p[2] for p in points])
+
+
+def test_scan_reproduces_baseline_fluxes(model, km_index, baseline):
+    results = ConcentrationScan(model, None, km_index, C_OLD, ratios=RATIOS).run(('fluxes', 'total_flux', 'objective'))
+    fluxes, total_flux, objective = baseline
+    assert list(results['fluxes'].columns) == [r.id for r in model.reactions]
+    np.testing.assert_allclose(results['fluxes'].to_numpy(), fluxes, atol=1e-9)
+    np.testing.assert_allclose(results['total_flux'].to_numpy(), total_flux, atol=1e-9)
+    np.testing.assert_allclose(results['objective'].to_numpy(), objective, atol=1e-9)
+
+
+@pytest.mark.parametrize('persistent', [True, 'highs'])
+def test_persistent_scan_reproduces_baseline_objectives(model, km_index, baseline, persistent):
+    # warm starts can pick other alternative optimal fluxes, only the optimal values are pinned
+    results = ConcentrationScan(model, None, km_index, C_OLD, ratios=RATIOS).run(('total_flux', 'objective'), persistent=persistent)
+    _, total_flux, objective = baseline
+    np.testing.assert_allclose(results['total_flux'].to_numpy(), total_flux, atol=1e-6)
+    np.testing.assert_allclose(results['objective'].to_numpy(), objective, atol=1e-6)
+
+
+@pytest.mark.parametrize('fva', [False, True])
+def test_parallel_scan_shares_the_reference(model, km_index, fva):
+    scan = ConcentrationScan(model, None, km_index, C_OLD, ratios=RATIOS, fva=fva)
+    serial = scan.run(('fluxes', 'total_flux'))
+    parallel = scan.run(('fluxes', 'total_flux'), n_jobs=2)
+    # the workers got the reference the serial run solved, not another cache entry
+    assert len(_reference_cache) == 1
+    np.testing.assert_allclose(parallel['fluxes'].to_numpy(), serial['fluxes'].to_numpy(), atol=1e-9)
+    np.testing.assert_allclose(parallel['total_flux'].to_numpy(), serial['total_flux'].to_numpy(), atol=1e-9)
+
+
+def test_fva_ranges_matched_with_tolerance(model, km_index):
+    c_new = {c: v / 2 for c, v in C_OLD.items()}
+    ranges = fva_fractions(model, [i / 10 for i in range(1, 11)])
+    # 0.1 + 0.2 is not exactly 0.3
+    variant = create_models_fva(model, None, km_index, C_OLD, c_new, obj_frac=.1 + .2, as_variant=True, fva_ranges=ranges)
+    expected = create_models_fva(model, None, km_index, C_OLD, c_new, obj_frac=.3, as_variant=True, fva_ranges={.3: ranges[3 / 10]})
+    np.testing.assert_array_equal(variant.lower, expected.lower)
+    np.testing.assert_array_equal(variant.upper, expected.upper)
+    with pytest.raises(KeyError, match='closest fraction is 0.3'):
+        create_models_fva(model, None, km_index, C_OLD, c_new, obj_frac=.33, as_variant=True, fva_ranges=ranges)
+
+
+def synthetic_factor(ratio):
+    # one Michaelis-Menten factor with Km 0.1 and one linear in the ratio
+    return np.array([ratio / (.1 + ratio) * 1.1, ratio])
+
+
+def synthetic_point(ratio):
+    # concave and piecewise linear in the factors like an LP optimum, with a breakpoint where both pieces are equal
+    factors = synthetic_factor(ratio)
+    values = [3 * factors[0], 1 + factors[1]]
+    slopes = [np.array([3., 0.]), np.array([0., 1.])]
+    k = int(np.argmin(values))
+    return {'objective': values[k], 'sensitivity': {'objective': slopes[k] * factors}}
+
+
+def run_grid(grid, ratios):
+    while ratios:
+        grid.add(ratios, [synthetic_point(r) for r in ratios])
+        ratios = grid.refine()
+    return grid
+
+
+def test_adaptive_grid_locates_breakpoint():
+    grid = run_grid(_AdaptiveGrid(synthetic_factor, ['objective'], tol=None, rtol=None), list(np.linspace(.01, .98, 5)))
+    breakpoint = brentq(lambda r: 3 * synthetic_factor(r)[0] - 1 - r, .01, .98)
+    assert len(grid.located) == 1
+    assert grid.located[0] == pytest.approx(breakpoint, abs=MIN_INTERVAL)
+    # without refinement, only the intersection of the pieces is evaluated
+    assert len(grid.points) == 6
+
+
+def test_adaptive_grid_interpolates_within_tolerance():
+    tol = 1e-4
+    grid = run_grid(_AdaptiveGrid(synthetic_factor, ['objective'], tol=tol, rtol=None), list(np.linspace(.01, .98, 5)))
+    ratios = sorted(grid.points)
+    dense = np.linspace(.01, .98, 2001)
+    exact = [synthetic_point(r)['objective'] for r in dense]
+    interpolated = np.interp(dense, ratios, [grid.points[r]['objective'] for r in ratios])
+    assert np.abs(interpolated - exact).max() <= tol
+    assert len(grid.located) == 1
+    assert len(ratios) < 100
+
+
+def test_adaptive_scan_interpolates_full_scan(model, km_index):
+    tol, rtol = 1e-3, 1e-4
+    scan = ConcentrationScan(model, None, km_index, C_OLD)
+    full = scan.run(('total_flux', 'objective'))
+    adaptive = scan.run_adaptive(('total_flux', 'objective'), tol=tol, rtol=rtol)
+    interpolated = ConcentrationScan.interpolate(adaptive, scan.ratios)
+    # the stated accuracy: tol + rtol times the largest absolute value
+    for key in ('objective', 'total_flux'):
+        allowed = tol + rtol * full[key].abs().max()
+        assert (interpolated[key] - full[key].to_numpy()).abs().max() <= allowed
+    assert len(adaptive['objective']) < len(scan.ratios)
+    # every located breakpoint names the bounds that switch there
+    assert all(len(row.reactions) or len(row.other) for row in adaptive['breakpoints'].itertuples())
+
+
+REPO = Path(__file__).resolve().parents[3]
+MITOCORE = REPO / 'external_data' / 'mitocore' / 'mitocore_v1.01.xml'
+BRENDA = REPO / 'generated_data' / 'brenda_queries'
+
+
+@pytest.fixture(scope='module')
+def mitocore():
+    if not MITOCORE.exists() or not BRENDA.exists():
+        pytest.skip('mitoCore or the Brenda queries are not available')
+    model = cobra.io.read_sbml_model(str(MITOCORE))
+    model.objective = 'OF_ATP_MitoCore'
+    with contextlib.redirect_stdout(io.StringIO()):
+        mappings = create_mappings_ec_mitocore_from_xml(str(MITOCORE))
+    kms = read_brenda(sorted(BRENDA.glob('*')))
+    return model, KmIndex(kms[kms.value > 0], mappings)
+
+
+def test_mitocore_scan_reproduces_baseline_fluxes(mitocore):
+    # mitoCore's pFBA is degenerate, its alternative optimal fluxes depend on the solver state each point starts from
+    model, km_index = mitocore
+    c_old = {'Cytosol': .2, 'Mitochondrion': .2}
+    ratios = (.04, .11, .2, .5)
+    results = ConcentrationScan(model, None, km_index, c_old, ratios=ratios).run(('fluxes', 'total_flux'))
+    for ratio, (fluxes, total_flux, _) in zip(ratios, (baseline_point(model, km_index, c_old, r) for r in ratios)):
+        np.testing.assert_allclose(results['fluxes'].loc[ratio].to_numpy(), fluxes.to_numpy(), atol=1e-9)
+        assert results['total_flux'][ratio] == pytest.approx(total_flux, abs=1e-9)
+
+
+def test_mitocore_adaptive_scan_interpolates_full_scan(mitocore):
+    tol, rtol = 1e-3, 1e-4
+    model, km_index = mitocore
+    scan = ConcentrationScan(model, None, km_index, {'Cytosol': .2, 'Mitochondrion': .2})
+    full = scan.run(('total_flux', 'objective'))
+    adaptive = scan.run_adaptive(('total_flux', 'objective'), tol=tol, rtol=rtol)
+    interpolated = ConcentrationScan.interpolate(adaptive, scan.ratios)
+    for key in ('objective', 'total_flux'):
+        allowed = tol + rtol * full[key].abs().max()
+        assert (interpolated[key] - full[key].to_numpy()).abs().max() <= allowed
+    breakpoints = adaptive['breakpoints']
+    assert len(breakpoints)
+    assert all(len(row.reactions) or len(row.other) for row in breakpoints.itertuples())
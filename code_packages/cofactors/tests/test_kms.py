@@ -0,0 +1,32 @@
+"""
+Tests of resolving reactions to Kms.
+"""
+import pandas as pd
+
+from cofactors.kms import KmIndex
+
+KMS = pd.DataFrame({
+    'ec': ['1.1.1.1', '1.1.1.1', '1.1.1.1', '1.1.1.27', '1.1.1.37', '1.1.1.37'],
+    'value': [.5, .2, .3, .4, .6, .1],
+}, index=['Mus musculus', 'Homo sapiens', 'Homo sapiens', 'Escherichia coli', 'Sus scrofa', 'Escherichia coli'])
+MAPPINGS = {'ADH': ['1.1.1.1'], 'LDH': ['1.1.1.27'], 'MDH': ['1.1.1.37'], 'GAPD': ['1.2.1.12']}
+
+
+def test_most_preferred_organism_is_used():
+    index = KmIndex(KMS, MAPPINGS, preference=['Homo sapiens', 'Mus musculus', 'Sus scrofa'])
+    assert index['ADH'] == .2
+    assert index.values('ADH') == [.2, .3]
+    assert index.organism('ADH') == 'homo sapiens'
+    # organisms outside the preference are ignored
+    assert index['MDH'] == .6
+
+
+def test_reactions_with_unranked_organisms_only_get_no_km():
+    index = KmIndex(KMS, MAPPINGS, preference=['Homo sapiens', 'Mus musculus', 'Sus scrofa'])
+    assert index.get('LDH') is None
+    assert index.values('LDH') == []
+    assert index.unranked == {'LDH': ['escherichia coli']}
+    # reactions without any Km are not listed
+    assert index.get('GAPD') is None
+    assert index.reactions == ['ADH', 'MDH']
+    assert index.with_decision('max').unranked == index.unranked
@@ -0,0 +1,56 @@
+"""
+Tests of mapping gene expression onto reactions through their gene-reaction rules.
+"""
+import random
+import time
+
+import cobra
+import numpy as np
+import pandas as pd
+import pytest
+
+from cofactors import mapping
+from cofactors.mapping import GPRProgram
+
+
+def random_rule(rng, genes, depth):
+    if depth == 0 or rng.random() < .3:
+        return rng.choice(genes)
+    op = rng.choice([' and ', ' or '])
+    return '(' + op.join(random_rule(rng, genes, depth - 1) for _ in range(rng.randint(2, 3))) + ')'
+
+
+def rule_model(rules):
+    model = cobra.Model('rules')
+    for i, rule in enumerate(rules):
+        rxn = cobra.Reaction(f'R{i}')
+        model.add_reactions([rxn])
+        rxn.gene_reaction_rule = rule
+    return model
+
+
+def test_tree_evaluation_matches_expansion(monkeypatch):
+    rng = random.Random(0)
+    genes = [f'g{i}' for i in range(8)]
+    model = rule_model([random_rule(rng, genes, 4) for _ in range(200)] + ['', 'g0', 'g1 and g2', 'g3 or g4'])
+    # unmeasured genes, missing or NaN, are skipped
+    values = np.random.default_rng(0).random((7, 5))
+    values[np.random.default_rng(1).random(values.shape) < .3] = np.nan
+    expression = pd.DataFrame(values, index=genes[:7])
+    expanded = GPRProgram(model).map(expression)
+    monkeypatch.setattr(mapping, 'MAX_COMPLEXES', 0)
+    program = GPRProgram(model)
+    assert len(program._trees) == len(program) == 203
+    pd.testing.assert_frame_equal(program.map(expression), expanded)
+
+
+def test_large_rule_is_not_expanded():
+    # 2**40 complexes
+    rule = ' and '.join(f'(a{i} or b{i})' for i in range(40))
+    model = rule_model([rule, 'a0 and b0'])
+    expression = pd.Series({**{f'a{i}': 1. + i for i in range(40)}, **{f'b{i}': 2. + i for i in range(40)}})
+    start = time.perf_counter()
+    mapped = GPRProgram(model).map(expression)
+    assert time.perf_counter() - start < 1
+    assert mapped['R0'] == pytest.approx(2.)
+    assert mapped['R1'] == pytest.approx(1.)